@@ -27,7 +27,7 @@ lib_to_sys_path()
 from rt_m1_client.types import ResourceId, ApplicationId, ConsumptionReportingConfiguration, PolicyTemplate, MetricsReportingConfiguration
 from rt_m1_client.configuration import Configuration
 from rt_m1_client.session import M1Session
-from rt_m1_client.data_store import JSONFileDataStore
+from rt_m1_client.data_store import create_data_store
 from rt_m1_client.exceptions import M1Error
 
 config = Configuration()
@@ -47,17 +47,20 @@ def get_config():
 async def get_session(config: Configuration) -> M1Session:
     global _m1_session
     if _m1_session is None:
-        data_store_dir = config.get('data_store')
-        if data_store_dir is not None:
-            data_store = await JSONFileDataStore(config.get('data_store'))
-        else:
-            data_store = None
+        data_store = await create_data_store(config.get('data_store_class'), config.get('data_store'))
         _m1_session = await M1Session((config.get('m1_address', 'localhost'),
                                        config.get('m1_port',7777)),
                                        data_store,
-                                       config.get('certificate_signing_class'))
+                                       config.get('certificate_signing_class'),
+                                       config.get('certificate_reuse_min_days'),
+                                       prepare_certificate_signer=True)
     return _m1_session
 
+@app.on_event("shutdown")
+async def close_session():
+    if _m1_session is not None:
+        await _m1_session.aclose()
+
 # Error handling
 @app.exception_handler(M1Error)
 async def m1_error_handler(request: Request, exc: M1Error):
@@ -181,13 +184,18 @@ Path: /details
 Description: This endpoint will return all details for all active provisioning sessions
 """
 async def get_session_details(session, ps_id):
-    details = {"Certificates": {}}
+    details = {"Certificates": {}, "CertificateSummaries": {}}
     certs = await session.certificateIds(ps_id)
 
     for cert_id in certs:
         try:
             cert = await session.certificateGet(ps_id, cert_id)
             details["Certificates"][cert_id] = cert if cert else "Certificate not yet uploaded"
+            if cert:
+                try:
+                    details["CertificateSummaries"][cert_id] = await session.certificateSummary(ps_id, cert_id)
+                except ValueError as err:
+                    details["CertificateSummaries"][cert_id] = str(err)
         except Exception as err:
             details["Certificates"][cert_id] = f"Certificate not available: {str(err)}"
 
@@ -240,7 +248,7 @@ async def new_certificate(provisioning_session_id: str, csr: bool = Query(False)
             cert_id, csr_data = result
             return {"certificate_id": cert_id, "csr": csr_data}
         else:
-            cert_id = await session.createNewCertificate(provisioning_session_id, extra_domain_names=extra_domain_names)
+            cert_id = await session.createNewCertificate(provisioning_session_id, extra_domain_names=extra_domain_names, reuse=False)
             if cert_id is None:
                 raise HTTPException(status_code=400, detail='Failed to create certificate')
         return {"certificate_id": cert_id}
@@ -275,6 +283,23 @@ async def show_certificate(provisioning_session_id: str, certificate_id: str):
         raise HTTPException(status_code=404, detail="Certificate not found")
     return cert
 
+"""
+Endpoint: Show certificate summary for provisioning session
+HTTP Method: GET
+Path: /certificate_summary/{provisioning_session_id}/{certificate_id}
+Description: This endpoint will show the subject, SANs, issuer, validity and key type of a certificate for a particular provisioning session.
+"""
+@app.get("/certificate_summary/{provisioning_session_id}/{certificate_id}")
+async def certificate_summary(provisioning_session_id: str, certificate_id: str):
+    session = await get_session(config)
+    try:
+        summary = await session.certificateSummary(provisioning_session_id, certificate_id)
+    except ValueError as err:
+        raise HTTPException(status_code=422, detail=str(err))
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Certificate not found")
+    return summary
+
 """
 Endpoint: Show protocol for provisioning session
 HTTP Method: GET
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+#==============================================================================
+# 5G-MAG Reference Tools: Local CA key type benchmark
+#==============================================================================
+#
+# File: benchmarks/local_ca_key_types.py
+# License: 5G-MAG Public License (v1.0)
+# Author: David Waring
+# Copyright: (C) 2023 British Broadcasting Corporation
+#
+# For full license terms please see the LICENSE file distributed with this
+# program. If this file is missing then the license can be retrieved from
+# https://drive.google.com/file/d/1cinCiA778IErENZ3JN52VFW-1ffHpx7Z/view
+#
+#==============================================================================
+#
+# Local CA key type benchmark
+# ===========================
+#
+# This script compares the cost of CA generation and certificate signing for
+# each of the CA key types supported by LocalCACertificateSigner.
+#
+# Syntax: local_ca_key_types.py [-r <rounds>] [-n <certificates>]
+#
+'''5G-MAG Reference Tools: Local CA key type benchmark
+===================================================
+
+Compares the time taken to generate a temporary local CA and the signing
+throughput of `LocalCACertificateSigner` for RSA-2048, RSA-4096, ECDSA P-256
+and ECDSA P-384 CA keys.
+'''
+import argparse
+import asyncio
+import os.path
+import statistics
+import sys
+import time
+from typing import List, Tuple
+
+import OpenSSL
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'lib'))
+from rt_m1_client.certificates import LocalCACertificateSigner
+
+KEY_OPTIONS: List[Tuple[str, str, int]] = [
+        ('RSA-2048', 'rsa', 2048),
+        ('RSA-4096', 'rsa', 4096),
+        ('ECDSA P-256', 'ecdsa-p256', 0),
+        ('ECDSA P-384', 'ecdsa-p384', 0),
+        ]
+
+def make_csr(domain_name: str) -> str:
+    '''Make a CSR for the certificates to sign
+    '''
+    key = OpenSSL.crypto.PKey()
+    key.generate_key(OpenSSL.crypto.TYPE_RSA, 2048)
+    req = OpenSSL.crypto.X509Req()
+    req.get_subject().commonName = domain_name
+    req.add_extensions([OpenSSL.crypto.X509Extension(b'subjectAltName', False, f'DNS:{domain_name}'.encode('utf-8'))])
+    req.set_pubkey(key)
+    req.sign(key, 'sha256')
+    return OpenSSL.crypto.dump_certificate_request(OpenSSL.crypto.FILETYPE_PEM, req).decode('utf-8')
+
+async def benchmark(key_type: str, bits: int, csr: str, rounds: int, certs: int) -> Tuple[List[float], float]:
+    '''Benchmark one CA key type
+
+    :return: a tuple of the CA generation times and the signing rate in certificates per second.
+    '''
+    generation_times = []
+    signer = None
+    for _ in range(rounds):
+        signer = LocalCACertificateSigner(ca_key_type=key_type, ca_key_bits=bits or None, workers=1)
+        start = time.perf_counter()
+        # The first signing generates the temporary CA
+        await signer.signCertificate(csr)
+        generation_times += [time.perf_counter() - start]
+    start = time.perf_counter()
+    await signer.signCertificates([csr] * certs)
+    return generation_times, certs / (time.perf_counter() - start)
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark LocalCACertificateSigner CA key types')
+    parser.add_argument('-r', '--rounds', type=int, default=5, help='Number of CAs to generate for each key type')
+    parser.add_argument('-n', '--certificates', type=int, default=200, help='Number of certificates to sign for each key type')
+    args = parser.parse_args()
+
+    csr = make_csr('benchmark.example.com')
+    print(f'{"CA key":<12} {"CA generation (median)":>24} {"CA generation (max)":>21} {"signing rate":>16}')
+    for label, key_type, bits in KEY_OPTIONS:
+        generation_times, rate = await benchmark(key_type, bits, csr, args.rounds, args.certificates)
+        print(f'{label:<12} {statistics.median(generation_times)*1000:>21.1f} ms {max(generation_times)*1000:>18.1f} ms '
+              f'{rate:>10.1f} cert/s')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
@@ -28,6 +28,8 @@
 #
 # DefaultCertificateSigner - The default CertificateSigner used by the M1Session class, presently LocalCACertificateSigner.
 #
+# CertificateSummary - A compact summary of a public certificate, as returned by certificate_summary().
+#
 '''
 ======================================================
 5G-MAG Reference Tools: M1 Session Certificate Signing
@@ -40,6 +42,7 @@ This module defines some classes that can be used by the `M1Session` class to pr
 from .base import CertificateSigner
 from .local_ca_cert_signer import LocalCACertificateSigner
 from .acme_cert_signer import ACMECertificateSigner, LetsEncryptCertificateSigner, TestLetsEncryptCertificateSigner
+from .summary import CertificateSummary, certificate_summary, pem_digest
 
 DefaultCertificateSigner = LocalCACertificateSigner
 
@@ -50,4 +53,7 @@ __all__ = [
         "LetsEncryptCertificateSigner",
         "TestLetsEncryptCertificateSigner",
         "DefaultCertificateSigner",
+        "CertificateSummary",
+        "certificate_summary",
+        "pem_digest",
         ]
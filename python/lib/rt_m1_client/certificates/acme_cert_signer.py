@@ -38,12 +38,16 @@ certificate signing services which use an ACME service such as Let's Encrypt.
 
 # Python system modules
 import aiofiles
+import aiofiles.os
 import asyncio
+import contextlib
+from cryptography import x509
 from cryptography.hazmat.primitives.serialization import Encoding as cryptography_Encoding, PublicFormat as cryptography_PublicFormat
 import logging
 import os.path
 import re
-from typing import Optional, List, Tuple
+import signal
+from typing import AsyncIterator, Optional, List, Tuple
 
 # 3rd party modules
 import OpenSSL
@@ -59,6 +63,22 @@ class ACMECertificateSigner(CertificateSigner):
 
     Class to perform certificate signing using an ACME certificate signing service.
 
+    Each CSR is signed by running ``certbot``. Up to *certbot_workers* ``certbot`` processes are run at once, each run is
+    killed if it takes longer than *certbot_timeout* seconds and new ACME orders are limited to *rate_limit* per hour, with
+    bursts of up to *rate_burst* orders, to stay within the ACME service rate limits.
+
+    Only one ``certbot`` process can use a ``certbot`` configuration directory at a time, so when *certbot_workers* is more
+    than 1 each worker uses its own configuration, work and logs directories in *certbot_dir*. Each of these will register
+    its own ACME account, using *acme_email* as the contact address if given.
+
+    If *consolidate* is set then `M1Session.createNewCertificates` will combine the certificate requests for each
+    provisioning session into as few certificates as possible, with up to *max_sans* subjectAltNames in each, so that bulk
+    provisioning makes fewer ACME orders.
+
+    Before ``certbot`` is run, the docroot in *docroots_dir* for the commonName and each DNS subjectAltName in the CSR is given
+    a ``.well-known`` link to the ``.well-known`` directory in *default_docroot_dir*, where ``certbot`` places the HTTP-01
+    challenges, so that every domain name in the order can be validated.
+
     Constants
     =========
 
@@ -69,7 +89,7 @@ class ACMECertificateSigner(CertificateSigner):
     LetsEncryptStagingService: str = 'https://acme-staging-v02.api.letsencrypt.org/directory'
     LetsEncryptService: str = 'https://acme-v02.api.letsencrypt.org/directory'
 
-    def __init__(self, *args, acme_service: Optional[str] = None, docroots_dir: Optional[str] = None, default_docroot_dir: Optional[str] = None, data_store: Optional[DataStore] = None, **kwargs):
+    def __init__(self, *args, acme_service: Optional[str] = None, docroots_dir: Optional[str] = None, default_docroot_dir: Optional[str] = None, data_store: Optional[DataStore] = None, certbot_workers: int = 1, certbot_dir: Optional[str] = None, certbot_timeout: float = 300.0, acme_email: Optional[str] = None, rate_limit: float = 100.0, rate_burst: int = 10, consolidate: bool = False, max_sans: int = 100, **kwargs):
         '''Constructor
 
         :param acme_service: The URL of the ACME directory service to use for certificate signing.
@@ -77,7 +97,18 @@ class ACMECertificateSigner(CertificateSigner):
                              whose name is the FQDN of the virtual host.
         :param default_docroot_dir: The directory which is the docroot of the default virtual host.
         :param data_store: The persistent data store object to use for data persistence.
+        :param certbot_workers: The maximum number of ``certbot`` processes to run at once.
+        :param certbot_dir: The directory to keep the per-worker ``certbot`` directories in. Required if *certbot_workers* is
+                            more than 1.
+        :param certbot_timeout: The number of seconds to allow a ``certbot`` run before killing it, or 0 for no timeout.
+        :param acme_email: The contact email address for ACME accounts registered for the per-worker ``certbot`` directories.
+        :param rate_limit: The maximum number of new ACME orders per hour, or 0 for no limit.
+        :param rate_burst: The maximum number of ACME orders that can be made in a burst before *rate_limit* applies.
+        :param consolidate: Whether certificate requests in the same provisioning session should be combined into one
+                            certificate.
+        :param max_sans: The maximum number of subjectAltNames the ACME service allows in one certificate.
         '''
+        certbot_workers = int(certbot_workers)
         errs=[]
         if acme_service is None:
             errs += ['acme_service is None']
@@ -85,12 +116,25 @@ class ACMECertificateSigner(CertificateSigner):
             errs += ['docroots_dir is None']
         if default_docroot_dir is None:
             errs += ['default_docroot_dir is None']
+        if certbot_workers > 1 and certbot_dir is None:
+            errs += ['certbot_dir is None and certbot_workers is more than 1']
         if len(errs) != 0:
             raise RuntimeError(f'{self.__class__.__name__} instantiated without needed parameters: {", ".join(errs)}')
         super().__init__(*args, data_store=data_store, **kwargs)
         self.__acme_service: str = acme_service
         self.__docroots: str = docroots_dir
         self.__default_docroot: str = default_docroot_dir
+        self.__certbot_dir: Optional[str] = certbot_dir if certbot_workers > 1 else None
+        self.__certbot_timeout: Optional[float] = float(certbot_timeout) or None
+        self.__acme_email: Optional[str] = acme_email
+        self.__certbot_slots: asyncio.Queue = asyncio.Queue()
+        for slot in range(max(1, certbot_workers)):
+            self.__certbot_slots.put_nowait(slot)
+        self.__rate_limiter: Optional[_TokenBucket] = None
+        if float(rate_limit) > 0:
+            self.__rate_limiter = _TokenBucket(float(rate_limit) / 3600.0, int(rate_burst))
+        self.__consolidate: bool = str(consolidate).lower() in ['1', 'true', 'yes', 'on']
+        self.__max_sans: int = int(max_sans)
 
     async def asyncInit(self):
         '''Asynchronous object initialisation
@@ -101,6 +145,18 @@ class ACMECertificateSigner(CertificateSigner):
         '''
         return self
 
+    def consolidationLimit(self) -> int:
+        '''Get the maximum number of domain names to consolidate into one certificate
+
+        One subjectAltName in each certificate is taken by the canonical domain name of the Application Function, leaving
+        *max_sans* - 1 for extra domain names.
+
+        :return: the maximum number of extra domain names in a consolidated certificate, or 0 if *consolidate* is not set.
+        '''
+        if not self.__consolidate:
+            return 0
+        return max(0, self.__max_sans - 1)
+
     async def signCertificate(self, csr: str, *args, **kwargs) -> Optional[str]:
         '''Sign a CSR in PEM format and return the public X509 Certificate in PEM format
 
@@ -120,38 +176,161 @@ class ACMECertificateSigner(CertificateSigner):
         common_name = x509req.get_subject().commonName
         if isinstance(common_name,bytes):
             common_name = common_name.decode('utf-8')
-        domain_docroot = os.path.join(self.__docroots, common_name)
-        old_umask = os.umask(0)
+        for domain_name in _csr_domain_names(x509req):
+            await self.__linkChallengeDir(domain_name)
         try:
-            await aiofiles.os.makedirs(domain_docroot, mode=0o755, exist_ok=True)
-            if not os.path.lexists(os.path.join(domain_docroot, '.well-known')):
-                await aiofiles.os.symlink(os.path.join(self.__default_docroot, '.well-known'), os.path.join(domain_docroot, '.well-known'), target_is_directory=True)
+            async with self.__certbotSlot() as certbot_args, aiofiles.tempfile.TemporaryDirectory() as d:
+                if self.__rate_limiter is not None:
+                    await self.__rate_limiter.acquire()
+                try:
+                    result, output = await _run_certbot_app(['certonly', '--non-interactive', '--server', self.__acme_service, '--webroot', '--webroot-path', self.__default_docroot, '--csr', f.name, '--cert-path', os.path.join(d, 'certificate.pem'), '--fullchain-path', os.path.join(d, 'fullchain.pem'), '--chain-path', os.path.join(d, 'chain.pem')] + certbot_args, timeout=self.__certbot_timeout)
+                except asyncio.TimeoutError:
+                    LOGGER.error('certbot did not finish within %s seconds for %s', self.__certbot_timeout, common_name)
+                    return None
+                certdata = None
+                if result == 0:
+                    async with aiofiles.open(os.path.join(d, 'fullchain.pem'), 'r') as inpem:
+                        certdata = await inpem.read()
+                else:
+                    LOGGER.error('certbot failed with exit code %i: %s', result, output.decode('utf-8', errors='replace'))
         finally:
-            os.umask(old_umask)
-        async with aiofiles.tempfile.TemporaryDirectory() as d:
-            result, output = await _run_certbot_app(['certonly', '--server', self.__acme_service, '--webroot', '--webroot-path', self.__default_docroot, '--csr', f.name, '--cert-path', os.path.join(d, 'certificate.pem'), '--fullchain-path', os.path.join(d, 'fullchain.pem'), '--chain-path', os.path.join(d, 'chain.pem')])
-            certdata = None
-            if result == 0:
-                async with aiofiles.open(os.path.join(d, 'fullchain.pem'), 'r') as inpem:
-                    certdata = await inpem.read()
-            else:
-                log_error(f'certbot failed with exit code {result}: {output}')
-        await aiofiles.os.remove(f.name)
+            await aiofiles.os.remove(f.name)
         return certdata
 
-async def _run_certbot_app(cmd_args: List[str]) -> Tuple[int, bytes]:
+    async def __linkChallengeDir(self, domain_name: str) -> None:
+        '''Make the HTTP-01 challenge directory available in the docroot for a domain name
+
+        :meta private:
+        :param str domain_name: The domain name to link the ``.well-known`` directory for.
+        '''
+        domain_docroot = os.path.join(self.__docroots, domain_name)
+        await aiofiles.os.makedirs(domain_docroot, mode=0o755, exist_ok=True)
+        # The web server must be able to read the docroot whatever the umask
+        await asyncio.get_running_loop().run_in_executor(None, os.chmod, domain_docroot, 0o755)
+        try:
+            await aiofiles.os.symlink(os.path.join(self.__default_docroot, '.well-known'), os.path.join(domain_docroot, '.well-known'), target_is_directory=True)
+        except FileExistsError:
+            # Already linked, possibly by a concurrent request for the same domain name
+            pass
+
+    @contextlib.asynccontextmanager
+    async def __certbotSlot(self) -> AsyncIterator[List[str]]:
+        '''Wait for a free ``certbot`` worker slot
+
+        :meta private:
+        :return: an async context manager which yields the extra ``certbot`` arguments to use for the slot.
+        '''
+        slot = await self.__certbot_slots.get()
+        try:
+            if self.__certbot_dir is None:
+                yield []
+            else:
+                slot_dir = os.path.join(self.__certbot_dir, str(slot))
+                args = ['--config-dir', os.path.join(slot_dir, 'config'), '--work-dir', os.path.join(slot_dir, 'work'),
+                        '--logs-dir', os.path.join(slot_dir, 'logs'), '--agree-tos']
+                if self.__acme_email:
+                    args += ['-m', self.__acme_email]
+                else:
+                    args += ['--register-unsafely-without-email']
+                yield args
+        finally:
+            self.__certbot_slots.put_nowait(slot)
+
+class _TokenBucket:
+    '''Token bucket rate limiter
+    '''
+    def __init__(self, rate: float, burst: int):
+        '''Constructor
+
+        :param float rate: The number of tokens added to the bucket per second.
+        :param int burst: The maximum number of tokens the bucket can hold, the bucket starts full.
+        '''
+        self.__rate: float = rate
+        self.__burst: float = float(max(1, burst))
+        self.__tokens: float = self.__burst
+        self.__updated: Optional[float] = None
+        self.__lock: asyncio.Lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        '''Take a token from the bucket, waiting for one to become available if the bucket is empty
+        '''
+        async with self.__lock:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            if self.__updated is not None:
+                self.__tokens = min(self.__burst, self.__tokens + (now - self.__updated) * self.__rate)
+            self.__updated = now
+            if self.__tokens < 1.0:
+                delay = (1.0 - self.__tokens) / self.__rate
+                LOGGER.info('ACME rate limit reached, waiting %.1f seconds', delay)
+                await asyncio.sleep(delay)
+                self.__tokens = 1.0
+                self.__updated = loop.time()
+            self.__tokens -= 1.0
+
+def _csr_domain_names(x509req: OpenSSL.crypto.X509Req) -> List[str]:
+    '''Get the domain names which need HTTP-01 validation for a CSR
+
+    :param OpenSSL.crypto.X509Req x509req: The CSR.
+
+    :return: the commonName followed by the DNS subjectAltNames, without duplicates. Wildcard names and names which are not
+             usable as a docroot directory name are left out.
+    '''
+    names = [x509req.get_subject().commonName]
+    try:
+        sans = x509req.to_cryptography().extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+        names += sans.get_values_for_type(x509.DNSName)
+    except x509.ExtensionNotFound:
+        pass
+    domain_names = []
+    for name in names:
+        if isinstance(name, bytes):
+            name = name.decode('utf-8')
+        if not name or name in domain_names or name.startswith('*') or '/' in name or name in ('.', '..'):
+            continue
+        domain_names += [name]
+    return domain_names
+
+async def _run_certbot_app(cmd_args: List[str], timeout: Optional[float] = None) -> Tuple[int, bytes]:
     '''Run `certbot` using the given command line arguments
 
+    The output from `certbot` is read, and logged at debug level, as it is produced.
+
     :param cmd_args: The command line arguments for `certbot`.
+    :param timeout: The number of seconds to wait for `certbot` to finish, or ``None`` to wait forever.
 
-    :return: A tuple of the `certbot` process exit code and STDOUT from `certbot`.
+    :return: A tuple of the `certbot` process exit code and the combined STDOUT and STDERR from `certbot`.
+    :raise asyncio.TimeoutError: if `certbot` did not finish within *timeout* seconds, the `certbot` process and any child
+                                 processes are killed.
     '''
     LOGGER.debug('Executing: certbot %s', ' '.join(['\''+s+'\'' for s in cmd_args]))
-    proc = await asyncio.create_subprocess_exec('certbot', *cmd_args, stdout=asyncio.subprocess.PIPE)
-    await proc.wait()
+    proc = await asyncio.create_subprocess_exec('certbot', *cmd_args, stdin=asyncio.subprocess.DEVNULL,
+                                                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                                                start_new_session=True)
+    output: List[bytes] = []
+
+    async def read_output() -> int:
+        while True:
+            data = await proc.stdout.read(65536)
+            if not data:
+                break
+            output.append(data)
+            for line in data.decode('utf-8', errors='replace').splitlines():
+                LOGGER.debug('certbot[%i]: %s', proc.pid, line)
+        return await proc.wait()
+
+    try:
+        await asyncio.wait_for(read_output(), timeout)
+    except asyncio.TimeoutError:
+        # Kill the whole process group so that no child process is left holding the output pipe open
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+        raise
     LOGGER.debug('Command exited with code %i', proc.returncode)
-    data = await proc.stdout.read()
-    return (proc.returncode, data)
+    return (proc.returncode, b''.join(output))
 
 async def LetsEncryptCertificateSigner(*args, docroots_dir: Optional[str] = None, default_docroot_dir: Optional[str] = None, data_store: Optional[DataStore] = None, **kwargs) -> ACMECertificateSigner:
     '''Let's Encrypt ACMECertificateSigner factory function
@@ -29,10 +29,14 @@
 This module defines some classes that can be used by the `M1Session` class to provide certificate signing services.
 
 '''
-from typing import Optional
+import asyncio
+import logging
+from typing import List, Optional
 
 from ..data_store import DataStore
 
+LOGGER = logging.getLogger(__name__)
+
 class CertificateSigner:
     '''Base class for all CertificateSigner classes
     '''
@@ -58,6 +62,13 @@ class CertificateSigner:
         '''
         return self
 
+    async def aclose(self) -> None:
+        '''Release any resources held by the signer
+
+        Derived classes should override this if they hold resources, such as worker pools, which need to be released when the
+        signer is no longer needed. The signer should not be used after this has been awaited.
+        '''
+
     async def signCertificate(self, csr: str, *args, **kwargs) -> Optional[str]:
         '''Sign a CSR in PEM format and return the public X509 Certificate in PEM format
 
@@ -66,3 +77,39 @@ class CertificateSigner:
         :return: a public X509 certificate in PEM format.
         '''
         raise NotImplementedError('Class derived from CertificateSigner must implement this method')
+
+    def consolidationLimit(self) -> int:
+        '''Get the maximum number of domain names to consolidate into one certificate
+
+        If this returns a number greater than 0 then `M1Session.createNewCertificates` will combine requests for certificates
+        in the same provisioning session into as few certificates as possible, each with no more than this number of extra
+        domain names, so that fewer certificates need to be signed.
+
+        Derived classes should override this if combining certificates saves signing effort, e.g. where each signing is an
+        order with a rate limited service.
+
+        :return: the maximum number of extra domain names in a consolidated certificate, or 0 to disable consolidation.
+        '''
+        return 0
+
+    async def signCertificates(self, csrs: List[str], *args, **kwargs) -> List[Optional[str]]:
+        '''Sign several CSRs in PEM format and return the public X509 Certificates in PEM format
+
+        Derived classes can override this to sign a batch of CSRs more efficiently than one at a time. The default
+        implementation calls `signCertificate` for each of the *csrs* concurrently.
+
+        :param List[str] csrs: A list of CSRs in PEM format.
+
+        :return: a list of public X509 certificates in PEM format, in the same order as *csrs*, with ``None`` in place of any
+                 certificate which could not be signed.
+        '''
+        results = await asyncio.gather(*[self.signCertificate(csr, *args, **kwargs) for csr in csrs], return_exceptions=True)
+        certs = []
+        for result in results:
+            if isinstance(result, Exception):
+                LOGGER.error('Failed to sign certificate: %s', result)
+                result = None
+            elif isinstance(result, BaseException):
+                raise result
+            certs += [result]
+        return certs
@@ -29,18 +29,51 @@
 This module defines some classes that can be used by the `M1Session` class to provide certificate signing services.
 
 '''
-from typing import Optional, Tuple, List
+import asyncio
+import concurrent.futures
+import contextlib
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Optional, Tuple, List
 
 import OpenSSL
+from cryptography.hazmat.primitives.asymmetric import ec
 
 from .base import CertificateSigner
 from ..data_store import DataStore
 
+LOGGER = logging.getLogger(__name__)
+
 class LocalCACertificateSigner(CertificateSigner):
     '''CertificateSigner that uses a locally generated CA kept in the data store
+
+    The CPU intensive operations, CA key generation and certificate signing, are run in a pool of worker threads or
+    processes so that they do not block the asyncio event loop. The pool can be configured using the
+    *certificate_signing_class* configuration option, e.g.
+    ``rt_m1_client.certificates.LocalCACertificateSigner(workers=4, worker_type=process)``.
+
+    The CA key type is set by the *ca_key_type* argument, one of `CA_KEY_TYPES`. ECDSA keys are much quicker to generate than
+    RSA keys and ECDSA signatures are quicker to make, e.g.
+    ``rt_m1_client.certificates.LocalCACertificateSigner(ca_key_type=ecdsa-p256)``. A CA which has already been stored in
+    the data store is kept, whatever its key type, until it is removed from the data store.
+
+    If *key_pool* is set then a pool of that many CA keys is generated in the background, while the signer is otherwise idle,
+    so that creating a CA does not have to wait for key generation. The pool is shared by all `LocalCACertificateSigner`
+    objects in the process using the same CA key type and size, and is refilled as keys are taken from it. The pool starts
+    filling when the signer is created, which `M1Session` only does before it is needed if *prepare_certificate_signer* is set.
+
+    Each certificate issued, including the CA certificate, is given a unique serial number. The next serial number is kept in
+    the data store and serial numbers are reserved from it in blocks of *serial_block* numbers, so that signing a batch of
+    certificates does not need a data store write for each certificate. The blocks are reserved using `DataStore.update`, so
+    processes sharing the data store never reserve the same serial numbers. Serial numbers reserved but not used before the
+    program exits are skipped.
     '''
 
-    def __init__(self, *args, data_store: Optional[DataStore] = None, local_ca_days: int = 365, temp_ca_days: int = 1, local_cert_days: int = 30, **kwargs):
+    CA_KEY_TYPES: List[str] = ['rsa', 'ecdsa-p256', 'ecdsa-p384'] #: The CA key types which can be generated
+
+    def __init__(self, *args, data_store: Optional[DataStore] = None, local_ca_days: int = 365, temp_ca_days: int = 1,
+                 local_cert_days: int = 30, workers: Optional[int] = None, worker_type: str = 'thread', ca_key_type: str = 'rsa',
+                 ca_key_bits: Optional[int] = None, key_pool: int = 0, serial_block: int = 64, **kwargs):
         '''Constructor
 
         Create a CertificateSigner that uses a locally generated CA to sign certificates.
@@ -49,13 +82,64 @@ class LocalCACertificateSigner(CertificateSigner):
         :param int local_ca_days: The number of days before expiry of the local CA in the data store.
         :param int temp_ca_days: The number of days for the local CA if no DataStore is provided for persistence.
         :param int local_cert_days: The number of days before expiry of signed certificates.
+        :param int workers: The maximum number of worker threads or processes to use for key generation and signing. If
+                            not given then the Python default for the *worker_type* is used.
+        :param str worker_type: The type of worker pool to use, either ``thread`` or ``process``.
+        :param str ca_key_type: The type of key to generate for a new CA, one of `CA_KEY_TYPES`.
+        :param int ca_key_bits: The RSA key size for a new CA. If not given then 4096 bits are used for a CA kept in the
+                                *data_store* and 2048 bits for a temporary CA.
+        :param int key_pool: The number of CA keys to keep pre-generated, or 0 to generate CA keys only when needed.
+        :param int serial_block: The number of certificate serial numbers to reserve in the data store at a time.
+        :raise ValueError: if the *worker_type* or *ca_key_type* is not recognised.
         '''
         super().__init__(self, data_store=data_store)
-        self.__ca_key: Optional[OpenSSL.crypto.PKey] = None
-        self.__ca: Optional[OpenSSL.crypto.X509] = None
-        self.__local_ca_days: int = local_ca_days
-        self.__temp_ca_days: int = temp_ca_days
-        self.__local_cert_days: int = local_cert_days
+        self.__ca_key: Optional[str] = None
+        self.__ca: Optional[str] = None
+        self.__ca_lock: asyncio.Lock = asyncio.Lock()
+        self.__local_ca_days: int = int(local_ca_days)
+        self.__temp_ca_days: int = int(temp_ca_days)
+        self.__local_cert_days: int = int(local_cert_days)
+        self.__workers: Optional[int] = None
+        if workers is not None and len(str(workers)) > 0:
+            self.__workers = int(workers)
+        if worker_type not in ['thread', 'process']:
+            raise ValueError(f'Unknown worker_type {worker_type!r}, should be "thread" or "process"')
+        self.__worker_type: str = worker_type
+        if ca_key_type not in self.CA_KEY_TYPES:
+            raise ValueError(f'Unknown ca_key_type {ca_key_type!r}, should be one of: {", ".join(self.CA_KEY_TYPES)}')
+        self.__ca_key_type: str = ca_key_type
+        self.__ca_key_bits: Optional[int] = None
+        if ca_key_bits is not None and len(str(ca_key_bits)) > 0:
+            self.__ca_key_bits = int(ca_key_bits)
+        self.__key_pool_size: int = int(key_pool or 0)
+        self.__serials: _SerialAllocator = _SerialAllocator(data_store, int(serial_block))
+        self.__executor: Optional[concurrent.futures.Executor] = None
+        self.__busy: int = 0
+        self.__idle: asyncio.Event = asyncio.Event()
+        self.__idle.set()
+
+    async def asyncInit(self):
+        '''Asynchronous object initialisation
+
+        Starts filling the CA key pool, if one was requested.
+
+        :return: self
+        '''
+        if self.__key_pool_size > 0:
+            self.__keyPool().fill(self.__key_pool_size, self.__runInWorker, self.__idle)
+        return self
+
+    async def aclose(self) -> None:
+        '''Shut down the worker pool
+
+        Any CA key pool filling started by this signer is stopped and the worker threads or processes are shut down once they
+        have finished their current work.
+        '''
+        for pool in _key_pools.values():
+            pool.stopFilling(self.__runInWorker)
+        executor, self.__executor = self.__executor, None
+        if executor is not None:
+            await asyncio.get_running_loop().run_in_executor(None, executor.shutdown)
 
     async def signCertificate(self, csr: str, *args, **kwargs) -> Optional[str]:
         '''Sign a CSR in PEM format and return the public X509 Certificate in PEM format
@@ -67,91 +151,445 @@ class LocalCACertificateSigner(CertificateSigner):
         :param str csr: A CSR in PEM format.
 
         :return: a public X509 certificate in PEM format, or None on error.
+        :raise RuntimeError: if a serial number for the certificate could not be reserved in the data store.
+        '''
+        async with self.__signing():
+            # Get local CA
+            ca_key, ca = await self.__getLocalCA()
+            serial = await self.__serials.allocate()
+            return await self.__runInWorker(_sign_csr, csr, ca_key, ca, self.__local_cert_days, serial)
+
+    async def signCertificates(self, csrs: List[str], *args, **kwargs) -> List[Optional[str]]:
+        '''Sign several CSRs in PEM format and return the public X509 Certificates in PEM format
+
+        The *csrs* are divided between the workers in the pool and each worker signs its share of the CSRs in a single call,
+        only loading the CA key once.
+
+        :param List[str] csrs: A list of CSRs in PEM format.
+
+        :return: a list of public X509 certificates in PEM format, in the same order as *csrs*, with ``None`` in place of any
+                 CSR which could not be signed.
+        :raise RuntimeError: if serial numbers for the certificates could not be reserved in the data store.
+        '''
+        if len(csrs) == 0:
+            return []
+        async with self.__signing():
+            ca_key, ca = await self.__getLocalCA()
+            chunk_count = min(len(csrs), self.__workers or os.cpu_count() or 1)
+            chunk_size = -(-len(csrs) // chunk_count)
+            first_serial = await self.__serials.allocate(len(csrs))
+            results = await asyncio.gather(*[self.__runInWorker(_sign_csrs, csrs[i:i+chunk_size], ca_key, ca,
+                                                                self.__local_cert_days, first_serial + i)
+                                             for i in range(0, len(csrs), chunk_size)])
+        return [cert for chunk in results for cert in chunk]
+
+    @contextlib.asynccontextmanager
+    async def __signing(self):
+        '''Context manager to mark the signer as busy
+
+        The CA key pool is only refilled when the signer is not busy.
+
+        :meta private:
+        '''
+        self.__busy += 1
+        self.__idle.clear()
+        try:
+            yield
+        finally:
+            self.__busy -= 1
+            if self.__busy == 0:
+                self.__idle.set()
+
+    def __caKeyBits(self) -> int:
+        '''Get the key size to use for a new CA key
+
+        :meta private:
+        :return: the RSA key size or 0 for ECDSA keys, where the size is set by the curve.
+        '''
+        if self.__ca_key_type != 'rsa':
+            return 0
+        if self.__ca_key_bits is not None:
+            return self.__ca_key_bits
+        if self.data_store:
+            return 4096
+        return 2048
+
+    def __keyPool(self) -> '_KeyPool':
+        '''Get the shared CA key pool for the CA key type and size
+
+        :meta private:
+        :return: the key pool.
         '''
-        x509req: OpenSSL.crypto.X509Req = OpenSSL.crypto.load_certificate_request(OpenSSL.crypto.FILETYPE_PEM, csr.encode('utf-8'))
-        # Get local CA
-        ca_key, ca = await self.__getLocalCA()
-        # Convert CSR to X509 certificate
-        x509 = OpenSSL.crypto.X509()
-        x509.set_subject(x509req.get_subject())
-        x509.set_serial_number(1)
-        x509.gmtime_adj_notBefore(0)
-        x509.gmtime_adj_notAfter(self.__local_cert_days * 24 * 60 * 60)
-        x509.set_issuer(ca.get_subject())
-        x509.set_pubkey(x509req.get_pubkey())
-        # Copy any extensions we aren't replacing
-        for ext in x509req.get_extensions():
-            if ext.get_short_name() not in [b'subjectKeyIdentifier', b'authorityKeyIdentifier', b'basicConstraints']:
-                x509.add_extensions([ext])
-        x509.add_extensions([
-            OpenSSL.crypto.X509Extension(b'subjectKeyIdentifier', False, b'hash', subject=x509),
-            OpenSSL.crypto.X509Extension(b'authorityKeyIdentifier', False, b'keyid, issuer', issuer=ca),
-            OpenSSL.crypto.X509Extension(b'basicConstraints', True, b'CA:FALSE')
-            ])
-        x509.sign(ca_key, "sha256")
-        return OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, x509).decode('utf-8')
-
-    async def __makeCACert(self, key: OpenSSL.crypto.PKey, cn: str, days: int = 365) -> OpenSSL.crypto.X509:
-        '''Make a CA certificate
-
-        The CA certificate will use the provided *key* for its public key (if a private key is provided the pubilc key will be
-        extracted). The *cn* parameter defines the common name for the CA certificate. The *days* parameter is used to set the
-        expiry date on the CA certificate.
+        pool_id = (self.__ca_key_type, self.__caKeyBits())
+        if pool_id not in _key_pools:
+            _key_pools[pool_id] = _KeyPool(*pool_id)
+        return _key_pools[pool_id]
+
+    async def __newCA(self, cn: str, days: int) -> Tuple[str, str]:
+        '''Create a new CA
+
+        The CA key is taken from the key pool, if there is one, or generated.
 
         :meta private:
-        :param OpenSSL.crypto.PKey key: A public or private key to use for the public key of the CA certificate.
-        :param str cn: The commonName for the certificate subject and issuer.
+        :param str cn: The commonName for the CA certificate.
         :param int days: The number of days the CA certificate will be valid for.
+        :return: the CA key and CA public certificate in PEM format.
+        '''
+        serial = await self.__serials.allocate()
+        if self.__key_pool_size > 0:
+            pool = self.__keyPool()
+            ca_key_pem = await pool.take(self.__runInWorker)
+            pool.fill(self.__key_pool_size, self.__runInWorker, self.__idle)
+            return ca_key_pem, await self.__runInWorker(_make_ca_cert, ca_key_pem, cn, days, serial)
+        return await self.__runInWorker(_generate_ca, self.__ca_key_type, self.__caKeyBits(), cn, days, serial)
+
+    async def __runInWorker(self, func, *args):
+        '''Run a function in the worker pool
 
-        :return: a self signed X509 CA certificate.
-        :rtype: OpenSSL.crypto.X509
-        '''
-        ca = OpenSSL.crypto.X509()
-        ca_name = ca.get_subject()
-        # TODO: Get these values from configured values
-        ca_name.organizationName = '5G-MAG'
-        ca_name.commonName = cn
-        ca.set_issuer(ca_name)
-        # TODO: increment serial number from data-store
-        ca.set_serial_number(1)
-        ca.gmtime_adj_notBefore(0)
-        ca.gmtime_adj_notAfter(days*24*60*60)
-        ca.set_pubkey(key)
-        ca.add_extensions([
-            OpenSSL.crypto.X509Extension(b'basicConstraints', True, b'CA:TRUE,pathlen:1'),
-            OpenSSL.crypto.X509Extension(b'subjectKeyIdentifier', False, b'hash', subject=ca),
-            OpenSSL.crypto.X509Extension(b'authorityKeyIdentifier', False, b'keyid, issuer:always', issuer=ca),
-            ])
-        ca.sign(key, 'sha256')
-        return ca
-
-    async def __getLocalCA(self) -> Tuple[OpenSSL.crypto.PKey, OpenSSL.crypto.X509]:
+        :meta private:
+        :param func: The module level function to call.
+        :param args: The arguments to pass to *func*. These must be picklable if a process pool is in use.
+        :return: the return value from *func*.
+        '''
+        if self.__executor is None:
+            if self.__worker_type == 'process':
+                self.__executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.__workers)
+            else:
+                self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.__workers,
+                                                                        thread_name_prefix='local-ca')
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, func, *args)
+
+    async def __getLocalCA(self) -> Tuple[str, str]:
         '''Get the locally generated CA
 
         This will create the locally generated CA if it doesn't already exist.
 
         :meta private:
-        :return: the CA key and CA public certificate.
-        :rtype: Tuple[OpenSSL.crypto.PKey, OpenSSL.crypto.X509]
-        '''
-        if self.__ca_key is None or self.__ca is None:
-            if self.data_store:
-                ca_key_pem = await self.data_store.get('ca-private')
-                if ca_key_pem is not None:
-                    self.__ca_key = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, ca_key_pem)
-                else:
-                    self.__ca_key = OpenSSL.crypto.PKey()
-                    self.__ca_key.generate_key(OpenSSL.crypto.TYPE_RSA, 4096)
-                    await self.data_store.set('ca-private', OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM, self.__ca_key).decode('utf-8'))
-                ca_pem = await self.data_store.get('ca-public')
-                if ca_pem is not None:
-                    self.__ca = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, ca_pem)
+        :return: the CA key and CA public certificate in PEM format.
+        :rtype: Tuple[str, str]
+        '''
+        async with self.__ca_lock:
+            if self.__ca_key is None or self.__ca is None:
+                if self.data_store:
+                    ca_key_pem = await self.data_store.get('ca-private')
+                    ca_pem = await self.data_store.get('ca-public')
+                    if ca_key_pem is None:
+                        ca_key_pem, ca_pem = await self.__newCA('5G-MAG Reference Tools Local CA', self.__local_ca_days)
+                        await self.data_store.set('ca-private', ca_key_pem)
+                        await self.data_store.set('ca-public', ca_pem)
+                    elif ca_pem is None:
+                        ca_pem = await self.__runInWorker(_make_ca_cert, ca_key_pem, '5G-MAG Reference Tools Local CA',
+                                                          self.__local_ca_days, await self.__serials.allocate())
+                        await self.data_store.set('ca-public', ca_pem)
+                    self.__ca_key, self.__ca = ca_key_pem, ca_pem
                 else:
-                    self.__ca = await self.__makeCACert(self.__ca_key, '5G-MAG Reference Tools Local CA', days=self.__local_ca_days)
-                    await self.data_store.set('ca-public', OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, self.__ca).decode('utf-8'))
-            else:
-                self.__ca_key = OpenSSL.crypto.PKey()
-                self.__ca_key.generate_key(OpenSSL.crypto.TYPE_RSA, 2048)
-                self.__ca = await self.__makeCACert(self.__ca_key, 'Temporary Demo CA', days=self.__temp_ca_days)
+                    self.__ca_key, self.__ca = await self.__newCA('Temporary Demo CA', self.__temp_ca_days)
 
         return self.__ca_key, self.__ca
+
+class _KeyPool:
+    '''A pool of pre-generated private keys of one type and size
+
+    The keys are held in PEM format so that the pool is not tied to any one worker pool or event loop.
+    '''
+    def __init__(self, key_type: str, bits: int):
+        '''Constructor
+
+        :param str key_type: The type of key held in the pool.
+        :param int bits: The size of RSA keys held in the pool.
+        '''
+        self.__key_type: str = key_type
+        self.__bits: int = bits
+        self.__keys: List[str] = []
+        self.__size: int = 0
+        self.__filler: Optional[asyncio.Future] = None
+        self.__filler_run_in_worker: Optional[Callable[..., Awaitable]] = None
+        self.__generating: Optional[asyncio.Future] = None
+
+    def fill(self, size: int, run_in_worker: Callable[..., Awaitable], idle: asyncio.Event) -> None:
+        '''Start filling the pool in the background
+
+        :param int size: The number of keys to keep in the pool. The pool keeps the largest size requested.
+        :param run_in_worker: The function used to run key generation in a worker.
+        :param asyncio.Event idle: Key generation waits for this to be set before generating each key.
+        '''
+        self.__size = max(self.__size, size)
+        if len(self.__keys) < self.__size and (self.__filler is None or self.__filler.done()):
+            self.__filler = asyncio.ensure_future(self.__fill(run_in_worker, idle))
+            self.__filler_run_in_worker = run_in_worker
+
+    def stopFilling(self, run_in_worker: Callable[..., Awaitable]) -> None:
+        '''Stop filling the pool if it is being filled using a worker function
+
+        A key already being generated is still available to `take` once it is ready.
+
+        :param run_in_worker: The worker function which is no longer available.
+        '''
+        if self.__filler is not None and self.__filler_run_in_worker == run_in_worker:
+            self.__filler.cancel()
+            self.__filler = None
+            self.__filler_run_in_worker = None
+
+    async def take(self, run_in_worker: Callable[..., Awaitable]) -> str:
+        '''Take a key from the pool
+
+        If the pool is empty then the key currently being generated to fill the pool is taken when it is ready. If no key is
+        being generated then a new key is generated.
+
+        :param run_in_worker: The function used to run key generation in a worker if the pool is empty.
+        :return: a private key in PEM format.
+        '''
+        if len(self.__keys) > 0:
+            return self.__keys.pop(0)
+        generating = self.__generating
+        if generating is not None and generating.get_loop() is asyncio.get_running_loop():
+            # Claim the key being generated so that the filler does not add it to the pool
+            self.__generating = None
+            try:
+                return await asyncio.shield(generating)
+            except Exception: # pylint: disable=broad-except
+                pass
+        return await run_in_worker(_generate_key_pem, self.__key_type, self.__bits)
+
+    async def __fill(self, run_in_worker: Callable[..., Awaitable], idle: asyncio.Event) -> None:
+        '''Generate keys until the pool is full
+
+        :meta private:
+        '''
+        try:
+            while len(self.__keys) < self.__size:
+                await idle.wait()
+                generating = asyncio.ensure_future(run_in_worker(_generate_key_pem, self.__key_type, self.__bits))
+                self.__generating = generating
+                key = await asyncio.shield(generating)
+                # Only add the key if take() has not already claimed it
+                if self.__generating is generating:
+                    self.__generating = None
+                    self.__keys += [key]
+        except Exception as err: # pylint: disable=broad-except
+            self.__generating = None
+            LOGGER.error('Failed to pre-generate CA key: %s', err)
+
+_key_pools: Dict[Tuple[str, int], _KeyPool] = {}
+
+class _SerialAllocator:
+    '''Allocates certificate serial numbers
+
+    The next unreserved serial number is kept in the data store. Serial numbers are reserved in blocks and handed out from the
+    reserved block, so the data store is only written when a block is used up. Blocks are reserved with an atomic
+    `DataStore.update` so that other processes using the same data store reserve different blocks.
+    '''
+
+    # Serial number 1 was used for every certificate issued before serial numbers were allocated
+    FIRST_SERIAL: int = 2
+
+    def __init__(self, data_store: Optional[DataStore], block_size: int):
+        '''Constructor
+
+        :param DataStore data_store: The DataStore to keep the next unreserved serial number in, or ``None`` to only allocate
+                                     serial numbers for the lifetime of this object.
+        :param int block_size: The number of serial numbers to reserve at a time.
+        '''
+        self.__data_store: Optional[DataStore] = data_store
+        self.__block_size: int = max(1, block_size)
+        self.__next: Optional[int] = None
+        self.__limit: int = 0
+        self.__lock: asyncio.Lock = asyncio.Lock()
+
+    async def allocate(self, count: int = 1) -> int:
+        '''Allocate consecutive serial numbers
+
+        :param int count: The number of serial numbers to allocate.
+        :return: the first of *count* consecutive serial numbers which have not been allocated before.
+        :raise RuntimeError: if a new block of serial numbers could not be reserved in the data store.
+        '''
+        async with self.__lock:
+            if self.__next is None or self.__next + count > self.__limit:
+                block = max(self.__block_size, count)
+                if self.__data_store is not None:
+                    # Any serial numbers left in the current block are skipped if they are too few for this allocation
+                    self.__limit = await self.__data_store.update('ca-serial',
+                                                                  lambda start: max(start or 0, self.FIRST_SERIAL) + block)
+                    self.__next = self.__limit - block
+                else:
+                    if self.__next is None:
+                        self.__next = self.FIRST_SERIAL
+                    self.__limit = self.__next + block
+            serial = self.__next
+            self.__next += count
+        return serial
+
+_EC_CURVES = {
+        'ecdsa-p256': ec.SECP256R1,
+        'ecdsa-p384': ec.SECP384R1,
+        }
+
+# Worker functions
+#
+# These are run in the worker pool and so only take and return picklable values, with keys and certificates in PEM format.
+
+def _make_ca_cert_x509(key: OpenSSL.crypto.PKey, cn: str, days: int = 365, serial: int = 1) -> OpenSSL.crypto.X509:
+    '''Make a CA certificate
+
+    The CA certificate will use the provided *key* for its public key (if a private key is provided the pubilc key will be
+    extracted). The *cn* parameter defines the common name for the CA certificate. The *days* parameter is used to set the
+    expiry date on the CA certificate.
+
+    :param OpenSSL.crypto.PKey key: A private key to use for the public key of the CA certificate and to sign it with.
+    :param str cn: The commonName for the certificate subject and issuer.
+    :param int days: The number of days the CA certificate will be valid for.
+    :param int serial: The serial number for the CA certificate.
+
+    :return: a self signed X509 CA certificate.
+    :rtype: OpenSSL.crypto.X509
+    '''
+    ca = OpenSSL.crypto.X509()
+    ca_name = ca.get_subject()
+    # TODO: Get these values from configured values
+    ca_name.organizationName = '5G-MAG'
+    ca_name.commonName = cn
+    ca.set_issuer(ca_name)
+    ca.set_serial_number(serial)
+    ca.gmtime_adj_notBefore(0)
+    ca.gmtime_adj_notAfter(days*24*60*60)
+    ca.set_pubkey(key)
+    ca.add_extensions([
+        OpenSSL.crypto.X509Extension(b'basicConstraints', True, b'CA:TRUE,pathlen:1'),
+        OpenSSL.crypto.X509Extension(b'subjectKeyIdentifier', False, b'hash', subject=ca),
+        OpenSSL.crypto.X509Extension(b'authorityKeyIdentifier', False, b'keyid, issuer:always', issuer=ca),
+        ])
+    ca.sign(key, _signing_digest(key))
+    return ca
+
+def _make_ca_cert(key_pem: str, cn: str, days: int = 365, serial: int = 1) -> str:
+    '''Make a CA certificate for an existing private key
+
+    :param str key_pem: The CA private key in PEM format.
+    :param str cn: The commonName for the certificate subject and issuer.
+    :param int days: The number of days the CA certificate will be valid for.
+    :param int serial: The serial number for the CA certificate.
+
+    :return: the self signed CA certificate in PEM format.
+    '''
+    key = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, key_pem)
+    return OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, _make_ca_cert_x509(key, cn, days, serial)).decode('utf-8')
+
+def _generate_key(key_type: str, bits: int) -> OpenSSL.crypto.PKey:
+    '''Generate a new private key
+
+    :param str key_type: The type of key to generate, one of `LocalCACertificateSigner.CA_KEY_TYPES`.
+    :param int bits: The size of the key to generate for RSA keys.
+
+    :return: the new private key.
+    '''
+    if key_type in _EC_CURVES:
+        return OpenSSL.crypto.PKey.from_cryptography_key(ec.generate_private_key(_EC_CURVES[key_type]()))
+    key = OpenSSL.crypto.PKey()
+    key.generate_key(OpenSSL.crypto.TYPE_RSA, bits)
+    return key
+
+def _generate_key_pem(key_type: str, bits: int) -> str:
+    '''Generate a new private key in PEM format
+
+    :param str key_type: The type of key to generate, one of `LocalCACertificateSigner.CA_KEY_TYPES`.
+    :param int bits: The size of the key to generate for RSA keys.
+
+    :return: the new private key in PEM format.
+    '''
+    return OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM, _generate_key(key_type, bits)).decode('utf-8')
+
+def _signing_digest(key: OpenSSL.crypto.PKey) -> str:
+    '''Choose the digest to sign with for a key
+
+    :param OpenSSL.crypto.PKey key: The private key that will be used for signing.
+
+    :return: the digest name, ``sha384`` for ECDSA keys larger than 256 bits or ``sha256`` otherwise.
+    '''
+    if key.type() == OpenSSL.crypto.TYPE_EC and key.bits() > 256:
+        return 'sha384'
+    return 'sha256'
+
+def _generate_ca(key_type: str, bits: int, cn: str, days: int = 365, serial: int = 1) -> Tuple[str, str]:
+    '''Generate a new CA private key and certificate
+
+    :param str key_type: The type of key to generate, one of `LocalCACertificateSigner.CA_KEY_TYPES`.
+    :param int bits: The size of the key to generate for RSA keys.
+    :param str cn: The commonName for the certificate subject and issuer.
+    :param int days: The number of days the CA certificate will be valid for.
+    :param int serial: The serial number for the CA certificate.
+
+    :return: a tuple of the CA private key and CA certificate in PEM format.
+    '''
+    key = _generate_key(key_type, bits)
+    return (OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM, key).decode('utf-8'),
+            OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, _make_ca_cert_x509(key, cn, days, serial)).decode('utf-8'))
+
+def _sign_csr(csr: str, ca_key_pem: str, ca_pem: str, days: int, serial: int) -> str:
+    '''Sign a CSR using the CA
+
+    :param str csr: The CSR in PEM format.
+    :param str ca_key_pem: The CA private key in PEM format.
+    :param str ca_pem: The CA certificate in PEM format.
+    :param int days: The number of days the new certificate will be valid for.
+    :param int serial: The serial number for the new certificate.
+
+    :return: the signed X509 certificate in PEM format.
+    '''
+    ca_key = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, ca_key_pem)
+    ca = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, ca_pem)
+    return _sign_x509req(csr, ca_key, ca, days, serial)
+
+def _sign_x509req(csr: str, ca_key: OpenSSL.crypto.PKey, ca: OpenSSL.crypto.X509, days: int, serial: int) -> str:
+    '''Sign a CSR using the loaded CA key and certificate
+
+    :param str csr: The CSR in PEM format.
+    :param OpenSSL.crypto.PKey ca_key: The CA private key.
+    :param OpenSSL.crypto.X509 ca: The CA certificate.
+    :param int days: The number of days the new certificate will be valid for.
+    :param int serial: The serial number for the new certificate.
+
+    :return: the signed X509 certificate in PEM format.
+    '''
+    x509req: OpenSSL.crypto.X509Req = OpenSSL.crypto.load_certificate_request(OpenSSL.crypto.FILETYPE_PEM, csr.encode('utf-8'))
+    # Convert CSR to X509 certificate
+    x509 = OpenSSL.crypto.X509()
+    x509.set_subject(x509req.get_subject())
+    x509.set_serial_number(serial)
+    x509.gmtime_adj_notBefore(0)
+    x509.gmtime_adj_notAfter(days * 24 * 60 * 60)
+    x509.set_issuer(ca.get_subject())
+    x509.set_pubkey(x509req.get_pubkey())
+    # Copy any extensions we aren't replacing
+    for ext in x509req.get_extensions():
+        if ext.get_short_name() not in [b'subjectKeyIdentifier', b'authorityKeyIdentifier', b'basicConstraints']:
+            x509.add_extensions([ext])
+    x509.add_extensions([
+        OpenSSL.crypto.X509Extension(b'subjectKeyIdentifier', False, b'hash', subject=x509),
+        OpenSSL.crypto.X509Extension(b'authorityKeyIdentifier', False, b'keyid, issuer', issuer=ca),
+        OpenSSL.crypto.X509Extension(b'basicConstraints', True, b'CA:FALSE')
+        ])
+    x509.sign(ca_key, _signing_digest(ca_key))
+    return OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, x509).decode('utf-8')
+
+def _sign_csrs(csrs: List[str], ca_key_pem: str, ca_pem: str, days: int, first_serial: int) -> List[Optional[str]]:
+    '''Sign several CSRs using the CA
+
+    :param List[str] csrs: The CSRs in PEM format.
+    :param str ca_key_pem: The CA private key in PEM format.
+    :param str ca_pem: The CA certificate in PEM format.
+    :param int days: The number of days the new certificates will be valid for.
+    :param int first_serial: The serial number for the first new certificate, the following certificates use consecutive
+                             serial numbers.
+
+    :return: the signed X509 certificates in PEM format, in the same order as *csrs*, with ``None`` for any CSR which could not
+             be signed.
+    '''
+    ca_key = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, ca_key_pem)
+    ca = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, ca_pem)
+    certs = []
+    for serial, csr in enumerate(csrs, first_serial):
+        try:
+            certs += [_sign_x509req(csr, ca_key, ca, days, serial)]
+        except (OpenSSL.crypto.Error, ValueError):
+            certs += [None]
+    return certs
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+#==============================================================================
+# 5G-MAG Reference Tools: M1 Client Certificate Summaries
+#==============================================================================
+#
+# File: rt_m1_client/certificates/summary.py
+# License: 5G-MAG Public License (v1.0)
+# Author: David Waring
+# Copyright: (C) 2023 British Broadcasting Corporation
+#
+# For full license terms please see the LICENSE file distributed with this
+# program. If this file is missing then the license can be retrieved from
+# https://drive.google.com/file/d/1cinCiA778IErENZ3JN52VFW-1ffHpx7Z/view
+#
+#==============================================================================
+#
+# M1 Client Certificate Summaries
+# ===============================
+#
+# This module provides compact summaries of X509 public certificates which
+# can be kept alongside the PEM data so that it does not need to be decoded
+# every time the certificate details are displayed or checked.
+#
+'''
+=================================================
+5G-MAG Reference Tools: M1 Certificate Summaries
+=================================================
+
+The `certificate_summary` function parses a PEM encoded X509 public certificate
+into a `CertificateSummary`. Each summary records the SHA-256 digest of the PEM
+data it was made from, see `pem_digest`, so that a summary kept alongside the
+PEM data can be checked against it. `M1Session.certificateSummary` keeps the
+summary of each certificate in its certificate cache in this way.
+'''
+
+import datetime
+import hashlib
+from typing import List, Optional, TypedDict
+
+import OpenSSL
+
+class CertificateSummary(TypedDict):
+    '''A compact summary of an X509 public certificate
+    '''
+    digest: str
+    serialNumber: int
+    subject: str
+    subjectKeyIdentifier: Optional[str]
+    issuer: str
+    authorityKeyIdentifier: Optional[str]
+    subjectAltNames: List[str]
+    notBefore: Optional[datetime.datetime]
+    notAfter: Optional[datetime.datetime]
+    keyType: str
+    keyBits: int
+
+def pem_digest(pem: str) -> str:
+    '''Get the digest which identifies the PEM data a summary was made from
+
+    :param pem: The PEM data.
+    :return: the hexadecimal SHA-256 digest of the *pem*.
+    '''
+    return hashlib.sha256(pem.encode('utf-8')).hexdigest()
+
+def certificate_summary(pem: str) -> CertificateSummary:
+    '''Get the summary of a PEM encoded X509 public certificate
+
+    :param pem: The PEM data for the public certificate.
+    :return: the `CertificateSummary` for the certificate.
+    :raise ValueError: if the *pem* cannot be parsed as an X509 certificate.
+    '''
+    try:
+        x509 = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, pem)
+    except OpenSSL.crypto.Error as err:
+        raise ValueError(f'Certificate not understood as PEM data: {err}') from err
+    return _summarise_x509(x509, pem_digest(pem))
+
+def _format_x509_name(x509name: OpenSSL.crypto.X509Name) -> str:
+    '''Format an X509Name as a comma separated list of DN fields
+
+    :param x509name: The X509Name to format.
+    :return: a ``str`` version of the X509 Name as comma separated DN fields.
+    '''
+    return ",".join([f"{name.decode('utf-8')}={value.decode('utf-8')}" for name,value in x509name.get_components()])
+
+def _summarise_x509(x509: OpenSSL.crypto.X509, digest: str) -> CertificateSummary:
+    '''Create a summary from a parsed X509 certificate
+    '''
+    subject_key = None
+    issuer_key = None
+    sans = []
+    for ext_num in range(x509.get_extension_count()):
+        ext = x509.get_extension(ext_num)
+        ext_name = ext.get_short_name().decode('utf-8')
+        if ext_name == "subjectKeyIdentifier":
+            subject_key = str(ext)
+        elif ext_name == "authorityKeyIdentifier":
+            issuer_key = str(ext)
+        elif ext_name == "subjectAltName":
+            sans += [s.strip() for s in str(ext).split(',')]
+    pkey = x509.get_pubkey()
+    key_type = {OpenSSL.crypto.TYPE_RSA: 'RSA', OpenSSL.crypto.TYPE_DSA: 'DSA', OpenSSL.crypto.TYPE_EC: 'EC'}.get(pkey.type(),
+                                                                                                            'unknown')
+    if key_type == 'EC':
+        key_type = f'EC/{pkey.to_cryptography_key().curve.name}'
+    return CertificateSummary(digest=digest, serialNumber=x509.get_serial_number(), subject=_format_x509_name(x509.get_subject()),
+                              subjectKeyIdentifier=subject_key, issuer=_format_x509_name(x509.get_issuer()),
+                              authorityKeyIdentifier=issuer_key, subjectAltNames=sans,
+                              notBefore=_asn1_time(x509.get_notBefore()), notAfter=_asn1_time(x509.get_notAfter()),
+                              keyType=key_type, keyBits=pkey.bits())
+
+def _asn1_time(value: Optional[bytes]) -> Optional[datetime.datetime]:
+    '''Convert an ASN.1 GENERALIZEDTIME to a datetime
+    '''
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return datetime.datetime.strptime(value, '%Y%m%d%H%M%SZ').replace(tzinfo=datetime.timezone.utc)
+
+__all__ = [
+        # Classes
+        'CertificateSummary',
+        # Functions
+        'certificate_summary',
+        'pem_digest',
+        ]
@@ -23,12 +23,26 @@
 '''5G-MAG Reference Tools: M1 Session Configuration
 ================================================
 
+The `Configuration` class holds the application configuration.
+
+Configuration options which select a Python class, such as
+*certificate_signing_class* and *data_store_class*, take a full Python class
+name optionally followed by constructor keyword arguments in brackets, e.g.
+``rt_m1_client.data_store.JSONFileDataStore(mmap_threshold=65536)``. The
+`load_class_spec` function converts these strings into the class and its
+arguments.
+
+The *certificate_reuse_min_days* option sets how many days an existing
+certificate must remain valid for it to be reused instead of creating a new
+certificate with the same domain names. It is empty by default, which means
+that new certificates are always created.
 '''
 import configparser
+import importlib
 import os
 import os.path
 
-from typing import List
+from typing import Any, Dict, List, Tuple
 
 class Configuration:
     '''Application configuration container
@@ -44,11 +58,13 @@ class Configuration:
     [m1-client]
     log_level = info
     data_store = %(state_dir)s/m1-client
+    data_store_class = rt_m1_client.data_store.JSONFileDataStore
     m1_address = 127.0.0.23
     m1_port = 7777
     asp_id =
     external_app_id = please-change-this
     certificate_signing_class = rt_m1_client.certificates.DefaultCertificateSigner
+    certificate_reuse_min_days =
     ''' #: The default configuration
 
     def __init__(self):
@@ -173,7 +189,32 @@ class Configuration:
         '''
         return f'Configuration(config="{self}")'
 
+def load_class_spec(class_spec: str) -> Tuple[Any, Dict[str,str]]:
+    '''Load a class from a class specification string
+
+    The *class_spec* is a full Python class name, including the module path, optionally followed by a comma separated list of
+    ``name=value`` keyword arguments in brackets, e.g. ``mymodule.MyClass(arg1=value1, arg2=value2)``. The argument values
+    are always passed as strings.
+
+    :param str class_spec: The class specification string.
+
+    :return: a tuple of the class object (or other module attribute) named and a `dict` of keyword arguments.
+    :raise ImportError: if the module cannot be imported.
+    :raise AttributeError: if the class is not found in the module.
+    '''
+    class_args = {}
+    if '(' in class_spec:
+        class_spec, args_str = class_spec.split('(',1)
+        args_str = args_str.rstrip()[:-1].strip()
+        if len(args_str) > 0:
+            class_args = dict([tuple([p.strip() for p in kv.split('=',1)]) for kv in args_str.split(',')])
+    class_mod_name, class_name = class_spec.strip().rsplit('.', 1)
+    class_mod = importlib.import_module(class_mod_name)
+    return getattr(class_mod, class_name), class_args
+
 __all__ = [
         # Classes
         'Configuration',
+        # Functions
+        'load_class_spec',
         ]
@@ -20,29 +20,100 @@
 # This module contains classes to implement a persistent data store for use by
 # the M1Session class.
 #
-# There are 2 classes DataStore is the base class and JSONFileDataStore is an
-# implementation which stores the persistent data objects as JSON objects.
+# DataStore is the base class, JSONFileDataStore is an implementation which
+# stores the persistent data objects as JSON objects in files and
+# InMemoryDataStore is an implementation which keeps the data objects in memory
+# for the lifetime of the process.
+#
+# The create_data_store function will create a DataStore from a class
+# specification string, as found in the data_store_class configuration option.
 #
 '''5G-MAG Reference Tools: M1 Session DataStore classes
 ====================================================
 
 The DataStore class provides a base class for storing persistent data using
 a key string. This data can then be retrieved later so that the application can carry on where it left off.
+Stored values carry a schema version and migration functions can be registered
+to upgrade values stored by older versions as they are read.
 
 The JSONFileDataStore class is an implementation that stores the data being
-represented in JSON notation as a set of files.
+represented in JSON notation as a set of files. Large files are read through a
+memory map and decoded piecewise, and a *path* of sub-keys can be given to `get`
+to retrieve just part of a stored value without decoding the rest of it.
+
+Key names may be namespaced using ``/`` as a separator, e.g.
+``provisioning-sessions/<id>``. The `DataStore.listKeys` method lists keys by
+prefix and `DataStore.delete` removes keys that are no longer needed. The
+`DataStore.update` method replaces a value atomically, even between processes
+sharing a JSONFileDataStore directory.
+
+The InMemoryDataStore class is an implementation that holds the data in memory
+only. This is useful for tests and benchmarks where persistence is not needed
+and disk I/O would get in the way.
+
+The `create_data_store` function creates a DataStore from the class
+specification used by the *data_store_class* configuration option.
 '''
 import aiofiles
 import aiofiles.os
+import asyncio
+import contextlib
+import copy
+import fcntl
+import fnmatch
+import hashlib
+import inspect
 import json
 import logging
+import mmap
 import os
 import os.path
-from typing import Any
+import re
+import stat
+import tempfile
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Set, Tuple, Union
+import urllib.parse
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .configuration import load_class_spec
+
+DataStorePath = Sequence[Union[str,int]]
 
 class DataStore:
     '''DataStore base class
+
+    Values are held in an envelope which records the schema version of the stored value. When the layout of a value needs to
+    change, a migration function can be registered for the key, using `registerMigration`, to convert values stored using an
+    older schema version. Migrations are applied lazily when an out of date value is read and the migrated value is then
+    written back to the store in the background, so an upgrade never has to rewrite the whole store before it can be used.
+    Values stored before schema versioning was introduced are treated as schema version 0.
+
+    The `update` method replaces a value using a function of its current value, atomically with respect to other updates of
+    the same key. Implementations which can be shared between processes should override `_lockRecord` so that this also holds
+    for updates made by other processes.
+
+    Implementations store the envelopes by overriding the `_getRecord`, `_setRecord` and `_deleteRecord` methods, and
+    override `listKeys`.
     '''
+    def __init__(self):
+        '''Constructor
+
+        Derived classes must call this constructor.
+        '''
+        self.__log = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__migrations: List[Tuple[str, int, Callable[[Any], Any]]] = []
+        self.__write_backs: Dict[str, asyncio.Future] = {}
+        # Count of changes to each key, so that a write-back does not replace a value set after the migrated value was read
+        self.__generations: Dict[str, int] = {}
+        # Count of sets and deletes of each key which have started but not yet finished storing
+        self.__in_flight: Dict[str, int] = {}
+        self.__update_locks: Dict[str, asyncio.Lock] = {}
+
     def __await__(self):
         '''Implement ``await`` on object creation
 
@@ -66,40 +137,359 @@ class DataStore:
         '''
         return self
 
-    async def get(self, key: str, default: Any = None) -> Any:
+    def registerMigration(self, key_pattern: str, from_version: int, migration: Callable[[Any], Any]) -> None:
+        '''Register a value migration function
+
+        The *migration* function is called with a value, for a key matching *key_pattern*, which was stored with schema
+        version *from_version* and should return the value converted to schema version *from_version* + 1. The function may
+        also be a coroutine function.
+
+        The current schema version for a key is one more than the highest *from_version* registered for a matching key pattern,
+        or 0 if there are no migrations registered for the key. Values are always stored using the current schema version. If
+        there is no migration registered for a step between the stored schema version and the current schema version then the
+        value is left unchanged by that step.
+
+        :param str key_pattern: A shell-style wildcard pattern (see `fnmatch`) matched against key names. Note that ``*``
+                                also matches ``/`` in namespaced key names.
+        :param int from_version: The schema version the *migration* function converts from.
+        :param migration: The function to convert a value from *from_version* to *from_version* + 1.
+        :raise ValueError: if *from_version* is negative.
+        '''
+        if from_version < 0:
+            raise ValueError('DataStore schema versions cannot be negative')
+        self.__migrations += [(key_pattern, from_version, migration)]
+
+    def schemaVersion(self, key: str) -> int:
+        '''Get the current schema version for a key
+
+        :param str key: The key name to get the current schema version for.
+
+        :return: the schema version that values for *key* are stored with.
+        '''
+        return max([from_version + 1 for pattern, from_version, _ in self.__migrations if fnmatch.fnmatchcase(key, pattern)],
+                   default=0)
+
+    async def get(self, key: str, default: Any = None, path: Optional[DataStorePath] = None) -> Any:
         '''Get a persisted value by key name
 
+        If *path* is given then it is a sequence of sub-keys, object member names as `str` and array indexes as `int`, which
+        are followed from the top of the stored value to find the part of the value to return. For example, a *path* of
+        ``['sessions', 'abc']`` applied to the stored value ``{"sessions": {"abc": 1}}`` will return ``1``.
+
+        If the stored value has an older schema version than the current schema version for the *key* then the registered
+        migrations are applied before the value is returned and the migrated value is written back in the background.
+
         :param str key: The key name to retrieve the `DataStore` value for.
         :param default: The default value to return if the key does not exist in the `DataStore`.
+        :param path: An optional sequence of sub-keys to follow into the stored value.
 
-        :return: The value of the retrieved key or the *default* value.
+        :return: The value of the retrieved key, or part of it if *path* is given, or the *default* value if the key or path
+                 does not exist.
         '''
-        raise NotImplementedError('DataStore implementation should override this method')
+        await self.__waitForWriteBack(key)
+        generation = self.__generations.get(key, 0)
+        settled = self.__in_flight.get(key, 0) == 0
+        current = self.schemaVersion(key)
+        record = await self._getRecord(key, path)
+        if record is None:
+            return default
+        schema, found, value = record
+        if schema < current:
+            if path is not None:
+                # Need the whole value to migrate it
+                record = await self._getRecord(key, None)
+                if record is None:
+                    return default
+                schema, found, value = record
+            # A set or delete in progress while the value was read may have stored its value before or after the read, so
+            # the value read may already be stale and must not be written back
+            settled = settled and self.__in_flight.get(key, 0) == 0
+            value = await self.__migrate(key, schema, current, value)
+            if settled:
+                self.__writeBack(key, current, copy.deepcopy(value), generation)
+            found, value = _follow_path(value, path)
+        elif schema > current:
+            self.__log.warning('DataStore value for %r has schema version %i, newer than the current version %i', key,
+                               schema, current)
+        if not found:
+            return default
+        return value
 
     async def set(self, key: str, value: Any) -> bool:
         '''Store a persisted value using the key name
 
+        The value is stored with the current schema version for the *key*.
+
         :param str key: The key name to set a value for.
         :param value: The value to set.
 
         :return: ``True`` if the value was set in the `DataStore` or ``False`` if there was a failure.
         '''
+        self.__startChange(key)
+        try:
+            await self.__waitForWriteBack(key)
+            return await self._setRecord(key, self.schemaVersion(key), value)
+        finally:
+            self.__endChange(key)
+
+    async def delete(self, key: str) -> bool:
+        '''Remove a persisted value
+
+        :param str key: The key name to remove from the `DataStore`.
+
+        :return: ``True`` if the key was removed or ``False`` if the key did not exist.
+        '''
+        self.__startChange(key)
+        try:
+            await self.__waitForWriteBack(key)
+            return await self._deleteRecord(key)
+        finally:
+            self.__endChange(key)
+
+    async def update(self, key: str, update: Callable[[Any], Any], default: Any = None) -> Any:
+        '''Atomically replace a persisted value using a function of its current value
+
+        The *update* function is called with the current value for *key*, or *default* if there is no value, and the value it
+        returns is stored. No other `update` of the *key*, in this process or, where the implementation supports it, in another
+        process sharing the same store, can happen between the value being read and the new value being stored.
+
+        :param str key: The key name to update.
+        :param update: The function to call with the current value to get the new value.
+        :param default: The value to pass to *update* if the key does not exist in the `DataStore`.
+
+        :return: the new value.
+        :raise RuntimeError: if the new value could not be stored.
+        '''
+        lock = self.__update_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            async with self._lockRecord(key):
+                value = update(await self.get(key, default))
+                if not await self.set(key, value):
+                    raise RuntimeError(f'Failed to store DataStore value for {key!r}')
+        return value
+
+    async def listKeys(self, prefix: str = '') -> List[str]:
+        '''List the key names held in the `DataStore`
+
+        :param str prefix: Only list key names which start with this string. Where the prefix includes whole namespace
+                           components (e.g. ``provisioning-sessions/``) implementations can use it to avoid looking at keys
+                           outside of that namespace.
+
+        :return: a list of key names.
+        '''
+        raise NotImplementedError('DataStore implementation should override this method')
+
+    async def flush(self) -> None:
+        '''Wait for background write-backs of migrated values to complete
+
+        Applications should await this before exiting so that migrated values are not lost. Any that are lost will be
+        migrated again the next time they are read.
+        '''
+        while len(self.__write_backs) > 0:
+            await asyncio.wait(list(self.__write_backs.values()))
+
+    # Implementation hooks
+
+    async def _getRecord(self, key: str, path: Optional[DataStorePath]) -> Optional[Tuple[int, bool, Any]]:
+        '''Get a stored value and its schema version
+
+        Implementations must override this method.
+
+        :param str key: The key name to retrieve the stored value for.
+        :param path: An optional sequence of sub-keys to follow into the stored value.
+
+        :return: ``None`` if there is no value stored for *key*, otherwise a tuple of the stored schema version, whether the
+                 *path* was found and the value found.
+        '''
         raise NotImplementedError('DataStore implementation should override this method')
 
+    async def _setRecord(self, key: str, schema: int, value: Any) -> bool:
+        '''Store a value with its schema version
+
+        Implementations must override this method.
+
+        :param str key: The key name to set a value for.
+        :param int schema: The schema version of *value*.
+        :param value: The value to set.
+
+        :return: ``True`` if the value was stored or ``False`` if there was a failure.
+        '''
+        raise NotImplementedError('DataStore implementation should override this method')
+
+    @contextlib.asynccontextmanager
+    async def _lockRecord(self, key: str) -> AsyncIterator[None]:
+        '''Hold an exclusive lock on a stored value for other processes
+
+        This is used by `update` while it reads and replaces a value. Updates within the process are already serialised, so
+        the default implementation does nothing. Implementations which can be shared between processes should override this.
+
+        :param str key: The key name to lock.
+        '''
+        yield
+
+    async def _deleteRecord(self, key: str) -> bool:
+        '''Remove a stored value
+
+        Implementations must override this method.
+
+        :param str key: The key name to remove.
+
+        :return: ``True`` if the key was removed or ``False`` if the key did not exist.
+        '''
+        raise NotImplementedError('DataStore implementation should override this method')
+
+    # Private methods
+
+    async def __migrate(self, key: str, schema: int, current: int, value: Any) -> Any:
+        '''Apply the registered migrations to a value
+
+        :meta private:
+        :param str key: The key name the value is stored under.
+        :param int schema: The schema version of *value*.
+        :param int current: The schema version to migrate *value* to.
+        :param value: The value to migrate.
+        :return: the migrated value.
+        '''
+        steps = {from_version: migration for pattern, from_version, migration in self.__migrations
+                 if fnmatch.fnmatchcase(key, pattern)}
+        for version in range(schema, current):
+            if version in steps:
+                value = steps[version](value)
+                if inspect.isawaitable(value):
+                    value = await value
+        self.__log.debug('Migrated DataStore value for %r from schema version %i to %i', key, schema, current)
+        return value
+
+    def __writeBack(self, key: str, schema: int, value: Any, generation: int) -> None:
+        '''Store a migrated value in the background
+
+        The write-back is skipped if the key has been set or deleted since the value was read.
+
+        :meta private:
+        :param str key: The key name to store the value under.
+        :param int schema: The schema version of *value*.
+        :param value: The migrated value.
+        :param int generation: The change count of *key* when the value was read.
+        '''
+        async def write_back() -> bool:
+            # Any set or delete starting after this check waits for this write-back to finish
+            if self.__generations.get(key, 0) != generation:
+                self.__log.debug('DataStore value for %r changed since it was migrated, not writing back', key)
+                return False
+            return await self._setRecord(key, schema, value)
+
+        task = asyncio.ensure_future(write_back())
+        self.__write_backs[key] = task
+
+        def write_back_done(fut: asyncio.Future):
+            if self.__write_backs.get(key) is fut:
+                del self.__write_backs[key]
+            if not fut.cancelled() and fut.exception() is not None:
+                self.__log.error('Failed to write back migrated DataStore value for %r: %s', key, fut.exception())
+
+        task.add_done_callback(write_back_done)
+
+    def __startChange(self, key: str) -> None:
+        '''Record the start of a set or delete of a key
+
+        :meta private:
+        :param str key: The key name being changed.
+        '''
+        self.__generations[key] = self.__generations.get(key, 0) + 1
+        self.__in_flight[key] = self.__in_flight.get(key, 0) + 1
+
+    def __endChange(self, key: str) -> None:
+        '''Record the end of a set or delete of a key
+
+        :meta private:
+        :param str key: The key name that was changed.
+        '''
+        self.__in_flight[key] -= 1
+        if self.__in_flight[key] == 0:
+            del self.__in_flight[key]
+
+    async def __waitForWriteBack(self, key: str) -> None:
+        '''Wait for any pending write-back of a key to complete
+
+        :meta private:
+        :param str key: The key name to wait for.
+        '''
+        pending = self.__write_backs.get(key)
+        if pending is not None:
+            await asyncio.wait([pending])
+
 class JSONFileDataStore(DataStore):
     '''JSONFileDataStore class
 
     This class implements a DataStore as a set of files containing JSON.
+
+    Each key is stored in its own file. The key is split into namespace components and a name at each ``/``. Each namespace
+    component becomes a directory, with a ``.d`` suffix, and the name is stored in a two level shard directory tree, picked
+    using a hash of the name, inside the namespace directory. All components are percent-encoded so that any characters can be
+    used in a key name. For example the key ``provisioning-sessions/abc`` is stored in
+    ``provisioning-sessions.d/ab/cd/abc.json`` where ``abcd...`` is the SHA-1 hash of ``abc``. This keeps the number of
+    entries in any one directory small, even when there are tens of thousands of keys.
+
+    Files from the earlier flat layout, ``{key}.json`` in the data store directory, are still read and are moved to the
+    sharded layout when they are next written.
+
+    Each file holds a JSON object with the schema version as its first member, ``__schema__``, and the value as the
+    ``__value__`` member. Files holding a bare value, as written before schema versioning, are read as schema version 0.
+    Files are written to a temporary file first and then renamed into place. The `update` method holds an exclusive `fcntl.flock`
+    lock on a ``.{name}.json.lock`` file next to the value file so that processes sharing the data store directory do not
+    interleave their updates.
+
+    Values can optionally be stored compressed, either for keys matching one of the *compress_keys* patterns or where the
+    encoded value is at least *compress_threshold* bytes long. A compressed file starts with a single line JSON header
+    recording the codec used, e.g. ``{"__codec__": "zlib"}``, followed by the compressed record. The *codec* can be ``zlib``,
+    ``zstd`` or ``auto``, which uses ``zstd`` if the `zstandard` module is available or ``zlib`` if not. Compressed files are
+    read transparently whatever the *codec* setting.
+
+    Files at least *mmap_threshold* bytes in size, and any read which asks for a sub-key *path*, are read using a memory map
+    of the file. The JSON is then scanned in place and only the parts of the document needed are decoded, so the whole file
+    is never held in memory as a `str` alongside the decoded value.
     '''
-    def __init__(self, data_store_dir: str):
+
+    DEFAULT_MMAP_THRESHOLD: int = 1024*1024 #: Default file size at which the memory mapped read mode is used
+
+    def __init__(self, data_store_dir: str, mmap_threshold: Optional[int] = None, compress_threshold: Optional[int] = None,
+                 compress_keys: Optional[str] = None, codec: str = 'auto'):
         '''Constructor
 
         :param str data_store_dir: The directory path to use for the JSON file data store.
+        :param int mmap_threshold: The file size, in bytes, at or above which values will be read using a memory map. If not
+                                   given then `DEFAULT_MMAP_THRESHOLD` is used.
+        :param int compress_threshold: The encoded value size, in bytes, at or above which values will be stored compressed.
+                                       If not given then values are only compressed if they match *compress_keys*.
+        :param str compress_keys: Space separated list of shell-style wildcard patterns (see `fnmatch`) for key names whose
+                                  values should always be stored compressed.
+        :param str codec: The compression codec to use, one of ``auto``, ``zlib`` or ``zstd``.
+        :raise ValueError: if the *codec* is not recognised.
 
         Please note that this object should be instantiated using ``await JSONFileDataStore(data_store_dir)`` as it has
         asynchronous initialisation to perform.
         '''
+        super().__init__()
+        self.__log = logging.getLogger(__name__ + '.' + self.__class__.__name__)
         self.__dir = data_store_dir
+        if mmap_threshold is None:
+            mmap_threshold = self.DEFAULT_MMAP_THRESHOLD
+        self.__mmap_threshold: int = int(mmap_threshold)
+        self.__compress_threshold: Optional[int] = None
+        if compress_threshold is not None and len(str(compress_threshold)) > 0:
+            self.__compress_threshold = int(compress_threshold)
+        self.__compress_keys: List[str] = []
+        if compress_keys is not None:
+            self.__compress_keys = compress_keys.split()
+        if codec == 'auto':
+            codec = 'zstd' if zstandard is not None else 'zlib'
+        elif codec not in _CODECS:
+            raise ValueError(f'Unknown DataStore compression codec {codec!r}')
+        elif codec == 'zstd' and zstandard is None:
+            self.__log.warning('zstd compression requested but the zstandard module is not available, using zlib instead')
+            codec = 'zlib'
+        self.__codec: str = codec
+        self.__known_dirs: Set[str] = set()
 
     async def asyncInit(self):
         '''Asynchronous JSONFileDataStore initialisation
@@ -110,39 +500,647 @@ class JSONFileDataStore(DataStore):
         :raise RuntimeError: if the data store path already exists but is not a directory.
         '''
         if not await aiofiles.os.path.exists(self.__dir):
-            old_umask = os.umask(0)
-            try:
-                await aiofiles.os.makedirs(self.__dir, mode=0o700)
-            finally:
-                os.umask(old_umask)
+            await aiofiles.os.makedirs(self.__dir, mode=0o700, exist_ok=True)
         if not await aiofiles.os.path.isdir(self.__dir):
             raise RuntimeError(f'{self.__dir} is not a directory')
         return self
 
-    async def get(self, key: str, default: Any = None) -> Any:
-        '''Get a persisted value by key name
+    async def _getRecord(self, key: str, path: Optional[DataStorePath]) -> Optional[Tuple[int, bool, Any]]:
+        '''Get a stored value and its schema version
 
-        :param str key: The key name to retrieve the `DataStore` value for.
-        :param default: The default value to return if the *key* does not exist in the `DataStore`.
+        :param str key: The key name to retrieve the stored value for.
+        :param path: An optional sequence of sub-keys to follow into the stored value.
 
-        :return: The value of the retrieved key or the *default* value.
+        :return: ``None`` if there is no value stored for *key*, otherwise a tuple of the stored schema version, whether the
+                 *path* was found and the value found.
         '''
-        json_file = os.path.join(self.__dir, f'{key}.json')
-        if not await aiofiles.os.path.exists(json_file) or not await aiofiles.os.path.isfile(json_file):
-            return default
-        async with aiofiles.open(json_file, mode='r') as json_in:
-            val = json.loads(await json_in.read())
-        return val
+        json_file, size = await self.__findFile(key)
+        if json_file is None:
+            return None
+        if path is not None or size >= self.__mmap_threshold:
+            return await asyncio.get_running_loop().run_in_executor(None, _read_record_file, json_file, path)
+        async with aiofiles.open(json_file, mode='rb') as json_in:
+            data = await json_in.read()
+        if data.startswith(_CODEC_HEADER_START):
+            data = await asyncio.get_running_loop().run_in_executor(None, _decompress_file_data, json_file, data)
+        schema, val = _unwrap_record(json.loads(data))
+        return schema, True, val
 
-    async def set(self, key: str, value: Any) -> bool:
-        '''Store a persisted value using the key name
+    async def _setRecord(self, key: str, schema: int, value: Any) -> bool:
+        '''Store a value with its schema version
+
+        The file is replaced atomically so that readers, and later runs after an interrupted write, never see a partially
+        written value. The value is compressed if the *key* or size of the value call for it.
 
         :param str key: The key name to set a value for.
+        :param int schema: The schema version of *value*.
         :param value: The value to set.
 
-        :return: ``True`` if the value was set in the `DataStore` or ``False`` if there was a failure.
+        :return: ``True`` if the value was stored.
         '''
-        json_file = os.path.join(self.__dir, f'{key}.json')
-        async with aiofiles.open(json_file, mode='w') as json_out:
-            await json_out.write(json.dumps(value))
+        json_file = self.__keyFilename(key)
+        data = json.dumps(_wrap_record(schema, value)).encode('utf-8')
+        codec = None
+        if (self.__compress_threshold is not None and len(data) >= self.__compress_threshold) or \
+                any([fnmatch.fnmatchcase(key, pattern) for pattern in self.__compress_keys]):
+            codec = self.__codec
+        await self.__makeDirs(os.path.dirname(json_file))
+        await asyncio.get_running_loop().run_in_executor(None, _write_record_file, json_file, data, codec)
+        await self.__removeFile(self.__legacyFilename(key))
         return True
+
+    @contextlib.asynccontextmanager
+    async def _lockRecord(self, key: str) -> AsyncIterator[None]:
+        '''Hold an exclusive lock on a stored value for other processes
+
+        :param str key: The key name to lock.
+        '''
+        json_file = self.__keyFilename(key)
+        await self.__makeDirs(os.path.dirname(json_file))
+        lock_file = os.path.join(os.path.dirname(json_file), '.' + os.path.basename(json_file) + '.lock')
+        fd = await asyncio.get_running_loop().run_in_executor(None, _lock_file, lock_file)
+        try:
+            yield
+        finally:
+            os.close(fd)
+
+    async def _deleteRecord(self, key: str) -> bool:
+        '''Remove a stored value
+
+        :param str key: The key name to remove from the `DataStore`.
+
+        :return: ``True`` if the key was removed or ``False`` if the key did not exist.
+        '''
+        removed = await self.__removeFile(self.__keyFilename(key))
+        if await self.__removeFile(self.__legacyFilename(key)):
+            removed = True
+        return removed
+
+    async def listKeys(self, prefix: str = '') -> List[str]:
+        '''List the key names held in the `DataStore`
+
+        Only the namespace directory given by the complete namespace components of *prefix* is scanned.
+
+        :param str prefix: Only list key names which start with this string.
+
+        :return: a list of key names.
+        '''
+        return await asyncio.get_running_loop().run_in_executor(None, self.__scanKeys, prefix)
+
+    # Private methods
+
+    def __keyFilename(self, key: str) -> str:
+        '''Get the file path for a key in the sharded layout
+
+        :meta private:
+        :param str key: The key name to find the file path for.
+        :return: the file path to use for the *key*.
+        :raise ValueError: if the *key* contains an empty namespace component or name.
+        '''
+        components = key.split('/')
+        if '' in components:
+            raise ValueError(f'Bad DataStore key name {key!r}')
+        name = components.pop()
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        return os.path.join(self.__dir, *[_quote_key_component(c) + '.d' for c in components], digest[0:2], digest[2:4],
+                            _quote_key_component(name) + '.json')
+
+    def __legacyFilename(self, key: str) -> Optional[str]:
+        '''Get the file path for a key in the old flat layout
+
+        :meta private:
+        :param str key: The key name to find the file path for.
+        :return: the old flat layout file path or ``None`` if the *key* could not have been stored in the flat layout.
+        '''
+        if '/' in key or key.startswith('.'):
+            return None
+        return os.path.join(self.__dir, f'{key}.json')
+
+    async def __findFile(self, key: str) -> Tuple[Optional[str], int]:
+        '''Find the file holding the value for a key
+
+        :meta private:
+        :param str key: The key name to find.
+        :return: a tuple of the file path and the file size, or ``(None, 0)`` if there is no value stored for *key*.
+        '''
+        for json_file in (self.__keyFilename(key), self.__legacyFilename(key)):
+            if json_file is None:
+                continue
+            try:
+                file_stat = await aiofiles.os.stat(json_file)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            if stat.S_ISREG(file_stat.st_mode):
+                return json_file, file_stat.st_size
+        return None, 0
+
+    async def __makeDirs(self, dirname: str) -> None:
+        '''Ensure a directory exists in the data store
+
+        :meta private:
+        :param str dirname: The directory path to create.
+        '''
+        if dirname in self.__known_dirs:
+            return
+        await aiofiles.os.makedirs(dirname, mode=0o700, exist_ok=True)
+        self.__known_dirs.add(dirname)
+
+    async def __removeFile(self, filename: Optional[str]) -> bool:
+        '''Remove a file if it exists
+
+        :meta private:
+        :param filename: The file to remove.
+        :return: ``True`` if the file was removed, ``False`` if it did not exist.
+        '''
+        if filename is None:
+            return False
+        try:
+            await aiofiles.os.remove(filename)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        return True
+
+    def __scanKeys(self, prefix: str) -> List[str]:
+        '''Find the key names that start with a prefix
+
+        This performs blocking directory scans and so is run in an executor by `listKeys`.
+
+        :meta private:
+        :param str prefix: The key name prefix to look for.
+        :return: a list of key names.
+        '''
+        namespace = prefix.split('/')[:-1]
+        keys = []
+        if len(namespace) == 0:
+            # Include any keys still in the old flat layout
+            try:
+                with os.scandir(self.__dir) as entries:
+                    for entry in entries:
+                        if entry.name.endswith('.json') and entry.is_file():
+                            keys += [entry.name[:-5]]
+            except FileNotFoundError:
+                pass
+        start_dir = os.path.join(self.__dir, *[_quote_key_component(c) + '.d' for c in namespace])
+        ns_prefix = ''.join([c + '/' for c in namespace])
+        keys += self.__scanNamespaceDir(start_dir, ns_prefix, prefix)
+        return [k for k in keys if k.startswith(prefix)]
+
+    def __scanNamespaceDir(self, dirname: str, ns_prefix: str, prefix: str) -> List[str]:
+        '''Find the key names in a namespace directory and its sub-namespaces
+
+        :meta private:
+        :param str dirname: The namespace directory to scan.
+        :param str ns_prefix: The key name prefix for keys found in *dirname*.
+        :param str prefix: The key name prefix being searched for, used to skip sub-namespaces which cannot match.
+        :return: a list of key names.
+        '''
+        keys = []
+        try:
+            with os.scandir(dirname) as entries:
+                for entry in entries:
+                    if not entry.is_dir():
+                        continue
+                    if entry.name.endswith('.d'):
+                        sub_prefix = ns_prefix + urllib.parse.unquote(entry.name[:-2]) + '/'
+                        if sub_prefix.startswith(prefix) or prefix.startswith(sub_prefix):
+                            keys += self.__scanNamespaceDir(entry.path, sub_prefix, prefix)
+                    elif _SHARD_DIR_RE.fullmatch(entry.name):
+                        for shard_dir in os.scandir(entry.path):
+                            if shard_dir.is_dir() and _SHARD_DIR_RE.fullmatch(shard_dir.name):
+                                keys += [ns_prefix + urllib.parse.unquote(f.name[:-5]) for f in os.scandir(shard_dir.path)
+                                         if f.name.endswith('.json')]
+        except FileNotFoundError:
+            pass
+        return keys
+
+class InMemoryDataStore(DataStore):
+    '''InMemoryDataStore class
+
+    This class implements a DataStore which keeps the values in memory. Nothing is persisted beyond the lifetime of the
+    object.
+
+    Values are held in their JSON encoded form so that the values returned by `get` are independent copies and any value which
+    could not be stored by `JSONFileDataStore` is also rejected here.
+    '''
+    def __init__(self, *args, **kwargs):
+        '''Constructor
+
+        Any arguments, such as the data store directory path passed by `create_data_store`, are ignored.
+        '''
+        super().__init__()
+        self.__values: Dict[str,Tuple[int,str]] = {}
+
+    async def _getRecord(self, key: str, path: Optional[DataStorePath]) -> Optional[Tuple[int, bool, Any]]:
+        '''Get a stored value and its schema version
+
+        :param str key: The key name to retrieve the stored value for.
+        :param path: An optional sequence of sub-keys to follow into the stored value.
+
+        :return: ``None`` if there is no value stored for *key*, otherwise a tuple of the stored schema version, whether the
+                 *path* was found and the value found.
+        '''
+        if key not in self.__values:
+            return None
+        schema, encoded = self.__values[key]
+        return (schema,) + _follow_path(json.loads(encoded), path)
+
+    async def _setRecord(self, key: str, schema: int, value: Any) -> bool:
+        '''Store a value with its schema version
+
+        :param str key: The key name to set a value for.
+        :param int schema: The schema version of *value*.
+        :param value: The value to set.
+
+        :return: ``True`` if the value was stored.
+        '''
+        self.__values[key] = (schema, json.dumps(value))
+        return True
+
+    async def _deleteRecord(self, key: str) -> bool:
+        '''Remove a stored value
+
+        :param str key: The key name to remove from the `DataStore`.
+
+        :return: ``True`` if the key was removed or ``False`` if the key did not exist.
+        '''
+        return self.__values.pop(key, None) is not None
+
+    async def listKeys(self, prefix: str = '') -> List[str]:
+        '''List the key names held in the `DataStore`
+
+        :param str prefix: Only list key names which start with this string.
+
+        :return: a list of key names.
+        '''
+        return [k for k in self.__values.keys() if k.startswith(prefix)]
+
+async def create_data_store(class_spec: Optional[str], data_store_dir: Optional[str]) -> Optional[DataStore]:
+    '''Create a DataStore from a class specification
+
+    The *class_spec* is in the same form as the *certificate_signing_class* configuration option, i.e. a full Python class name
+    optionally followed by keyword arguments in brackets (see `rt_m1_client.configuration.load_class_spec`). The class will be
+    instantiated with *data_store_dir* as its first argument.
+
+    :param class_spec: The DataStore class specification. If this is ``None`` or empty then `JSONFileDataStore` is used.
+    :param data_store_dir: The data store path to pass to the DataStore class.
+
+    :return: a new `DataStore` or ``None`` if *data_store_dir* is ``None`` or empty, meaning that no data store should be used.
+    :raise RuntimeError: if the class specified is not derived from `DataStore`.
+    '''
+    if data_store_dir is None or len(data_store_dir) == 0:
+        return None
+    if class_spec is None or len(class_spec) == 0:
+        data_store_cls, data_store_args = JSONFileDataStore, {}
+    else:
+        data_store_cls, data_store_args = load_class_spec(class_spec)
+    if not isinstance(data_store_cls, type) or not issubclass(data_store_cls, DataStore):
+        raise RuntimeError(f'The data store class {class_spec!r} is not derived from DataStore')
+    return await data_store_cls(data_store_dir, **data_store_args)
+
+def _follow_path(value: Any, path: Optional[DataStorePath]) -> Tuple[bool, Any]:
+    '''Follow a sub-key path into a decoded value
+
+    :param value: The value to look in.
+    :param path: The sequence of sub-keys to follow or ``None`` to return the whole *value*.
+
+    :return: a tuple of whether the *path* was found and the value found.
+    '''
+    if path is None:
+        return True, value
+    for step in path:
+        if isinstance(value, dict) and isinstance(step, str) and step in value:
+            value = value[step]
+        elif isinstance(value, list) and isinstance(step, int) and not isinstance(step, bool) and 0 <= step < len(value):
+            value = value[step]
+        else:
+            return False, None
+    return True, value
+
+_SHARD_DIR_RE = re.compile(r'[0-9a-f]{2}')
+
+def _quote_key_component(component: str) -> str:
+    '''Percent-encode a key name component for use as a file or directory name
+
+    :param str component: The key name component.
+    :return: the component encoded so that it is safe to use as a single file path component.
+    '''
+    quoted = urllib.parse.quote(component, safe='')
+    if quoted.startswith('.'):
+        quoted = '%2E' + quoted[1:]
+    return quoted
+
+# Memory mapped JSON reading
+#
+# These functions scan JSON held in a bytes-like buffer (such as an mmap.mmap) to find the extents of values without decoding
+# them. Only the values actually requested are passed to the json module for decoding.
+
+_JSON_NON_WS_RE = re.compile(rb'[^ \t\r\n]')
+_JSON_STRING_RE = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_JSON_SCALAR_RE = re.compile(rb'[^ \t\r\n,\]}]+')
+_JSON_STRUCTURE_RE = re.compile(rb'["\[\]{}]')
+
+_JSON_DECODE_CHUNK: int = 64*1024 #: Containers larger than this are decoded member by member
+
+def _json_skip_ws(buf, pos: int) -> int:
+    '''Find the next non-whitespace character at or after *pos*
+    '''
+    match = _JSON_NON_WS_RE.search(buf, pos)
+    if match is None:
+        return len(buf)
+    return match.start()
+
+def _json_value_end(buf, pos: int) -> int:
+    '''Find the end of the JSON value starting at *pos*
+
+    :return: the index of the first character after the value.
+    :raise ValueError: if the JSON is malformed.
+    '''
+    first = buf[pos:pos+1]
+    if first == b'"':
+        match = _JSON_STRING_RE.match(buf, pos)
+        if match is None:
+            raise ValueError(f'Unterminated JSON string at offset {pos}')
+        return match.end()
+    if first in (b'{', b'['):
+        depth = 0
+        scan = pos
+        while True:
+            match = _JSON_STRUCTURE_RE.search(buf, scan)
+            if match is None:
+                raise ValueError(f'Unterminated JSON container at offset {pos}')
+            char = match.group()
+            if char == b'"':
+                scan = _json_value_end(buf, match.start())
+                continue
+            if char in (b'{', b'['):
+                depth += 1
+            else:
+                depth -= 1
+            scan = match.end()
+            if depth == 0:
+                return scan
+    match = _JSON_SCALAR_RE.match(buf, pos)
+    if match is None:
+        raise ValueError(f'Expected a JSON value at offset {pos}')
+    return match.end()
+
+def _json_members(buf, pos: int):
+    '''Iterate over the members of a JSON object or array starting at *pos*
+
+    The end of each member value is only found when the generator is resumed, so a caller which stops iterating at the
+    member it wants does not scan that member's value. A caller which has already found the end of the member value can pass
+    it back using ``send()`` to avoid it being scanned again.
+
+    :return: a generator of tuples of member name (`str` for objects, `int` index for arrays) and value start.
+    :raise ValueError: if the JSON is malformed or *pos* is not the start of an object or array.
+    '''
+    opener = buf[pos:pos+1]
+    if opener == b'{':
+        closer = b'}'
+    elif opener == b'[':
+        closer = b']'
+    else:
+        raise ValueError(f'Expected a JSON object or array at offset {pos}')
+    pos = _json_skip_ws(buf, pos + 1)
+    if buf[pos:pos+1] == closer:
+        return
+    index = 0
+    while True:
+        if closer == b'}':
+            key_end = _json_value_end(buf, pos)
+            name = json.loads(buf[pos:key_end])
+            pos = _json_skip_ws(buf, key_end)
+            if buf[pos:pos+1] != b':':
+                raise ValueError(f'Expected ":" at offset {pos}')
+            pos = _json_skip_ws(buf, pos + 1)
+        else:
+            name = index
+            index += 1
+        value_end = yield name, pos
+        if value_end is None:
+            value_end = _json_value_end(buf, pos)
+        pos = _json_skip_ws(buf, value_end)
+        sep = buf[pos:pos+1]
+        if sep == closer:
+            return
+        if sep != b',':
+            raise ValueError(f'Expected "," or "{closer.decode()}" at offset {pos}')
+        pos = _json_skip_ws(buf, pos + 1)
+
+def _json_decode(buf, start: int, end: int) -> Any:
+    '''Decode the JSON value between *start* and *end*
+
+    Large objects and arrays are decoded a member at a time so that no more than one member's encoded form is copied out of
+    *buf* at once.
+    '''
+    if end - start <= _JSON_DECODE_CHUNK or buf[start:start+1] not in (b'{', b'['):
+        return json.loads(buf[start:end])
+    result = {} if buf[start:start+1] == b'{' else []
+    members = _json_members(buf, start)
+    try:
+        name, vstart = next(members)
+        while True:
+            vend = _json_value_end(buf, vstart)
+            if isinstance(result, dict):
+                result[name] = _json_decode(buf, vstart, vend)
+            else:
+                result += [_json_decode(buf, vstart, vend)]
+            name, vstart = members.send(vend)
+    except StopIteration:
+        pass
+    return result
+
+def _json_find(buf, pos: int, path: DataStorePath) -> Optional[Tuple[int, int]]:
+    '''Follow the sub-key *path* from the JSON value at *pos*
+
+    :return: the start and end offsets of the value found or ``None`` if the *path* does not exist.
+    '''
+    for step in path:
+        if buf[pos:pos+1] not in (b'{', b'['):
+            return None
+        for name, vstart in _json_members(buf, pos):
+            if name == step:
+                pos = vstart
+                break
+        else:
+            return None
+    return pos, _json_value_end(buf, pos)
+
+def _json_record(buf, pos: int) -> Tuple[int, int]:
+    '''Find the schema version and value of a stored record starting at *pos*
+
+    :return: a tuple of the schema version and the start offset of the stored value.
+    '''
+    if buf[pos:pos+1] == b'{':
+        members = _json_members(buf, pos)
+        name, vstart = next(members, (None, None))
+        if name == _RECORD_SCHEMA:
+            vend = _json_value_end(buf, vstart)
+            schema = json.loads(buf[vstart:vend])
+            if isinstance(schema, int) and not isinstance(schema, bool):
+                try:
+                    name, vstart = members.send(vend)
+                    while name != _RECORD_VALUE:
+                        name, vstart = next(members)
+                    return schema, vstart
+                except StopIteration:
+                    pass
+    # Bare value from before schema versioning
+    return 0, pos
+
+def _json_read_record(buf, path: Optional[DataStorePath] = None) -> Tuple[int, bool, Any]:
+    '''Read a stored value, or a part of it, from a buffer holding a JSON encoded record
+
+    :param buf: The bytes-like buffer to read.
+    :param path: Optional sequence of sub-keys to follow into the stored value.
+
+    :return: a tuple of the stored schema version, whether the value was found and the decoded value.
+    :raise ValueError: if the buffer does not contain valid JSON.
+    '''
+    schema, start = _json_record(buf, _json_skip_ws(buf, 0))
+    if path is None:
+        return schema, True, _json_decode(buf, start, _json_value_end(buf, start))
+    extent = _json_find(buf, start, path)
+    if extent is None:
+        return schema, False, None
+    return schema, True, _json_decode(buf, *extent)
+
+def _read_record_file(filename: str, path: Optional[DataStorePath] = None) -> Tuple[int, bool, Any]:
+    '''Read a stored value, or a part of it, from a file
+
+    Uncompressed files are read using a memory map. Compressed files are decompressed into memory and then scanned in the
+    same way, so only the parts of the value needed are decoded.
+
+    :param str filename: The file to read.
+    :param path: Optional sequence of sub-keys to follow into the stored value.
+
+    :return: a tuple of the stored schema version, whether the value was found and the decoded value.
+    :raise ValueError: if the file does not contain valid JSON or a valid compressed record.
+    '''
+    with open(filename, 'rb') as json_in:
+        if os.fstat(json_in.fileno()).st_size == 0:
+            raise ValueError(f'{filename} is empty')
+        if json_in.read(len(_CODEC_HEADER_START)) == _CODEC_HEADER_START:
+            json_in.seek(0)
+            return _json_read_record(_decompress_file_data(filename, json_in.read()), path)
+        with mmap.mmap(json_in.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return _json_read_record(buf, path)
+
+# Stored records
+
+_RECORD_SCHEMA: str = '__schema__' #: Record member holding the schema version, always the first member
+_RECORD_VALUE: str = '__value__' #: Record member holding the stored value
+
+def _wrap_record(schema: int, value: Any) -> Dict[str, Any]:
+    '''Create the record to store for a value
+
+    :param int schema: The schema version of *value*.
+    :param value: The value to store.
+    :return: the record to encode as JSON.
+    '''
+    return {_RECORD_SCHEMA: schema, _RECORD_VALUE: value}
+
+def _unwrap_record(record: Any) -> Tuple[int, Any]:
+    '''Get the schema version and value from a decoded record
+
+    :param record: The decoded record, or a bare value from before schema versioning.
+    :return: a tuple of the schema version and the stored value.
+    '''
+    if isinstance(record, dict) and len(record) > 0 and next(iter(record)) == _RECORD_SCHEMA and _RECORD_VALUE in record:
+        schema = record[_RECORD_SCHEMA]
+        if isinstance(schema, int) and not isinstance(schema, bool):
+            return schema, record[_RECORD_VALUE]
+    return 0, record
+
+def _write_record_file(filename: str, data: bytes, codec: Optional[str] = None) -> None:
+    '''Write an encoded record to a file, optionally compressing it
+
+    :param str filename: The file to write.
+    :param bytes data: The JSON encoded record.
+    :param codec: The compression codec to use or ``None`` to store the record uncompressed.
+    '''
+    if codec is not None:
+        data = json.dumps({_CODEC_MEMBER: codec}).encode('utf-8') + b'\n' + _CODECS[codec][0](data)
+    _write_file_atomic(filename, data)
+
+def _decompress_file_data(filename: str, data: bytes) -> bytes:
+    '''Decompress the contents of a compressed record file
+
+    :param str filename: The name of the file the *data* was read from, for error messages.
+    :param bytes data: The file contents, starting with the codec header line.
+    :return: the decompressed JSON encoded record.
+    :raise ValueError: if the header is malformed or the codec is not known or not available.
+    '''
+    header_end = data.find(b'\n')
+    if header_end < 0:
+        raise ValueError(f'{filename} has a malformed compression header')
+    codec = json.loads(data[:header_end]).get(_CODEC_MEMBER)
+    if codec not in _CODECS:
+        raise ValueError(f'{filename} uses unknown compression codec {codec!r}')
+    return _CODECS[codec][1](data[header_end+1:])
+
+def _zstd_compress(data: bytes) -> bytes:
+    '''Compress using zstd
+    '''
+    return zstandard.ZstdCompressor().compress(data)
+
+def _zstd_decompress(data: bytes) -> bytes:
+    '''Decompress zstd compressed data
+    '''
+    if zstandard is None:
+        raise ValueError('Cannot read zstd compressed DataStore value as the zstandard module is not available')
+    return zstandard.ZstdDecompressor().decompress(data)
+
+_CODEC_MEMBER: str = '__codec__' #: Compression header member holding the codec name
+_CODEC_HEADER_START: bytes = b'{"' + _CODEC_MEMBER.encode('utf-8') + b'"'
+_CODECS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+        'zlib': (zlib.compress, zlib.decompress),
+        'zstd': (_zstd_compress, _zstd_decompress),
+        } #: Compression codec (compress, decompress) functions
+
+def _write_file_atomic(filename: str, data: bytes) -> None:
+    '''Replace the contents of a file atomically
+
+    The *data* is written to a temporary file in the same directory which is then renamed over *filename*.
+
+    :param str filename: The file to write.
+    :param bytes data: The new file contents.
+    '''
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_out:
+            tmp_out.write(data)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+def _lock_file(filename: str) -> int:
+    '''Open and exclusively lock a lock file
+
+    This blocks until the lock is acquired. The lock is released by closing the returned file descriptor.
+
+    :param str filename: The lock file, which is created if it does not exist.
+    :return: the open file descriptor holding the lock.
+    '''
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+__all__ = [
+        # Types
+        'DataStorePath',
+        # Classes
+        'DataStore',
+        'JSONFileDataStore',
+        'InMemoryDataStore',
+        # Functions
+        'create_data_store',
+        ]
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+#==============================================================================
+# 5G-MAG Reference Tools: M1 Client JSON Patch generation
+#==============================================================================
+#
+# File: rt_m1_client/json_patch.py
+# License: 5G-MAG Public License (v1.0)
+# Author: David Waring
+# Copyright: (C) 2023 British Broadcasting Corporation
+#
+# For full license terms please see the LICENSE file distributed with this
+# program. If this file is missing then the license can be retrieved from
+# https://drive.google.com/file/d/1cinCiA778IErENZ3JN52VFW-1ffHpx7Z/view
+#
+#==============================================================================
+#
+# M1 Client JSON Patch generation
+# ===============================
+#
+# This module creates RFC 6902 JSON Patch documents describing the changes
+# between two JSON documents so that M1 resources can be updated with a PATCH
+# request instead of replacing the whole resource.
+#
+'''
+=====================================================
+5G-MAG Reference Tools: M1 Client JSON Patch creation
+=====================================================
+
+The `make_json_patch` function compares two decoded JSON documents and returns
+the list of RFC 6902 JSON Patch operations which will turn the first document
+into the second.
+
+Objects are compared key by key and arrays element by element, so a change deep
+inside a large document produces a small patch. Elements added to or removed
+from the end of an array are added or removed individually, other changes to
+array elements are made in place.
+'''
+
+from typing import Any, List, TypedDict
+
+class JSONPatchOperation(TypedDict, total=False):
+    '''A single RFC 6902 JSON Patch operation
+    '''
+    op: str
+    path: str
+    value: Any
+
+def make_json_patch(source: Any, target: Any) -> List[JSONPatchOperation]:
+    '''Create a JSON Patch which will change one JSON document into another
+
+    :param source: The current document, as decoded JSON.
+    :param target: The desired document, as decoded JSON.
+    :return: the list of JSON Patch operations, which will be empty if the documents are the same.
+    '''
+    ops: List[JSONPatchOperation] = []
+    _diff(source, target, '', ops)
+    return ops
+
+def _diff(source: Any, target: Any, path: str, ops: List[JSONPatchOperation]) -> None:
+    '''Add the operations to change *source* into *target* at *path* to *ops*
+    '''
+    if isinstance(source, dict) and isinstance(target, dict):
+        for key in source.keys():
+            if key not in target:
+                ops += [JSONPatchOperation(op='remove', path=f'{path}/{_escape(key)}')]
+        for key, value in target.items():
+            if key in source:
+                _diff(source[key], value, f'{path}/{_escape(key)}', ops)
+            else:
+                ops += [JSONPatchOperation(op='add', path=f'{path}/{_escape(key)}', value=value)]
+    elif isinstance(source, list) and isinstance(target, list):
+        common = min(len(source), len(target))
+        for i in range(common):
+            _diff(source[i], target[i], f'{path}/{i}', ops)
+        # Remove from the end so that the indexes of the earlier elements do not change
+        for i in range(len(source) - 1, common - 1, -1):
+            ops += [JSONPatchOperation(op='remove', path=f'{path}/{i}')]
+        for i in range(common, len(target)):
+            ops += [JSONPatchOperation(op='add', path=f'{path}/-', value=target[i])]
+    elif type(source) is not type(target) or source != target:
+        ops += [JSONPatchOperation(op='replace', path=path, value=target)]
+
+def _escape(key: str) -> str:
+    '''Escape an object key for use in a JSON Pointer
+    '''
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+__all__ = [
+        # Classes
+        'JSONPatchOperation',
+        # Functions
+        'make_json_patch',
+        ]
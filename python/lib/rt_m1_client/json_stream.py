@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+#==============================================================================
+# 5G-MAG Reference Tools: M1 Client incremental JSON parsing
+#==============================================================================
+#
+# File: rt_m1_client/json_stream.py
+# License: 5G-MAG Public License (v1.0)
+# Author: David Waring
+# Copyright: (C) 2023 British Broadcasting Corporation
+#
+# For full license terms please see the LICENSE file distributed with this
+# program. If this file is missing then the license can be retrieved from
+# https://drive.google.com/file/d/1cinCiA778IErENZ3JN52VFW-1ffHpx7Z/view
+#
+#==============================================================================
+#
+# M1 Client incremental JSON parsing
+# ==================================
+#
+# This module parses a large JSON object document a piece at a time so that
+# the members of the document can be processed one by one without holding the
+# whole document in memory.
+#
+'''
+==========================================================
+5G-MAG Reference Tools: M1 Client incremental JSON parsing
+==========================================================
+
+The `JSONMemberParser` class is fed the text of a JSON document, whose top level
+value is an object, in chunks and returns the members of the object as each
+one is completed.
+
+The members named in the *expand* list are not returned whole. If their value
+is an object or an array then the (empty) object or array is returned first,
+followed by each member of the object or each element of the array in turn.
+This allows a large map or list in the document to be processed one entry at a
+time.
+
+Each parsed value is returned with its path in the document, for example:
+
+```python
+parser = JSONMemberParser(expand=['streams'])
+for path, value in parser.feed('{"appId": "x", "streams": {"a": {}, "b": {'):
+    print(path, value)
+# ('appId',) x
+# ('streams',) {}
+# ('streams', 'a') {}
+```
+
+Values are decoded with the standard `json` module so the results are the same
+as for `json.loads`.
+'''
+
+import json
+from typing import Any, Iterable, List, Optional, Tuple, Union
+
+JSONPath = Tuple[Union[str, int], ...]
+
+class JSONMemberParser:
+    '''Incremental parser for the members of a JSON object document
+    '''
+
+    __WHITESPACE = ' \t\n\r'
+    __DELIMITERS = ',]}' + __WHITESPACE
+
+    def __init__(self, expand: Iterable[str] = ()):
+        '''Constructor
+
+        :param expand: The names of the top level members to return one entry at a time.
+        '''
+        self.__expand = set(expand)
+        self.__decoder = json.JSONDecoder()
+        self.__buffer = ''
+        self.__pos = 0
+        # Position in the document of the start of the buffer and its line, for error messages
+        self.__consumed = 0
+        self.__line = 1
+        self.__line_start = 0
+        # The containers being parsed: [path, is_object, state, key or index]
+        self.__stack: List[list] = []
+        self.__done = False
+
+    def feed(self, text: str) -> List[Tuple[JSONPath, Any]]:
+        '''Parse the next chunk of the document
+
+        :param text: The next chunk of the document text.
+        :return: the list of paths and values completed by this chunk.
+        :raise ValueError: if the document is not a valid JSON object.
+        '''
+        self.__discardParsed()
+        self.__buffer += text
+        return self.__parse(False)
+
+    def close(self) -> List[Tuple[JSONPath, Any]]:
+        '''Finish parsing the document
+
+        :return: the list of paths and values completed by the end of the document.
+        :raise ValueError: if the document is incomplete or not a valid JSON object.
+        '''
+        result = self.__parse(True)
+        if not self.__done:
+            self.__error('Unexpected end of document', len(self.__buffer))
+        return result
+
+    def __parse(self, final: bool) -> List[Tuple[JSONPath, Any]]:
+        '''Parse as much of the buffered text as possible
+
+        :meta private:
+        '''
+        result = []
+        buf = self.__buffer
+        while True:
+            pos = self.__pos
+            while pos < len(buf) and buf[pos] in self.__WHITESPACE:
+                pos += 1
+            self.__pos = pos
+            if pos >= len(buf):
+                break
+            char = buf[pos]
+            if self.__done:
+                self.__error('Extra data', pos)
+            if not self.__stack:
+                if char != '{':
+                    self.__error('Expecting a JSON object', pos)
+                self.__stack += [[(), True, 'first', None]]
+                self.__pos = pos + 1
+                continue
+            container = self.__stack[-1]
+            path, is_object, state, key = container
+            if state in ['first', 'next', 'comma'] and char in '}]':
+                if char != ('}' if is_object else ']') or state == 'comma':
+                    self.__error(f'Unexpected {char!r}', pos)
+                self.__stack.pop()
+                self.__pos = pos + 1
+                if self.__stack:
+                    self.__stack[-1][2] = 'next'
+                else:
+                    self.__done = True
+                continue
+            if state == 'next':
+                if char != ',':
+                    self.__error("Expecting ',' delimiter", pos)
+                container[2] = 'comma'
+                self.__pos = pos + 1
+                continue
+            if is_object and state in ['first', 'comma']:
+                if char != '"':
+                    self.__error('Expecting property name enclosed in double quotes', pos)
+                decoded = self.__decode(pos, final)
+                if decoded is None:
+                    break
+                container[3] = decoded[0]
+                container[2] = 'colon'
+                continue
+            if state == 'colon':
+                if char != ':':
+                    self.__error("Expecting ':' delimiter", pos)
+                container[2] = 'value'
+                self.__pos = pos + 1
+                continue
+            # Expecting a value, the state is 'value' in an object or 'first' or 'comma' in an array
+            if not is_object:
+                key = 0 if state == 'first' else key + 1
+            if len(self.__stack) == 1 and key in self.__expand and char in '{[':
+                result += [((key,), {} if char == '{' else [])]
+                container[2] = 'expanded'
+                self.__stack += [[(key,), char == '{', 'first', None]]
+                self.__pos = pos + 1
+                continue
+            decoded = self.__decode(pos, final)
+            if decoded is None:
+                break
+            result += [(path + (key,), decoded[0])]
+            container[2] = 'next'
+            container[3] = key
+        return result
+
+    def __decode(self, pos: int, final: bool) -> Optional[Tuple[Any]]:
+        '''Decode the JSON value at *pos* in the buffer
+
+        :meta private:
+        :return: a 1-tuple holding the decoded value, or ``None`` if more of the document is needed to complete the value.
+        '''
+        try:
+            value, end = self.__decoder.raw_decode(self.__buffer, pos)
+        except json.JSONDecodeError as err:
+            if final:
+                self.__error(err.msg, err.pos)
+            # The value may be incomplete, try again when there is more text
+            return None
+        # A number or literal is only complete once it is followed by a delimiter, it may continue in the next chunk
+        if not final and not isinstance(value, (str, dict, list)) and (end >= len(self.__buffer) or
+                                                                       self.__buffer[end] not in self.__DELIMITERS):
+            return None
+        self.__pos = end
+        return (value,)
+
+    def __discardParsed(self):
+        '''Remove the text which has been parsed from the buffer
+
+        :meta private:
+        '''
+        pos = self.__pos
+        newline = self.__buffer.rfind('\n', 0, pos)
+        if newline >= 0:
+            self.__line += self.__buffer.count('\n', 0, pos)
+            self.__line_start = self.__consumed + newline + 1
+        self.__consumed += pos
+        self.__buffer = self.__buffer[pos:]
+        self.__pos = 0
+
+    def __error(self, msg: str, pos: int):
+        '''Raise a ValueError for a syntax error at *pos* in the buffer
+
+        :meta private:
+        '''
+        line = self.__line + self.__buffer.count('\n', 0, pos)
+        newline = self.__buffer.rfind('\n', 0, pos)
+        if newline >= 0:
+            column = pos - newline
+        else:
+            column = self.__consumed + pos - self.__line_start + 1
+        raise ValueError(f'{msg}: line {line} column {column} (char {self.__consumed + pos})')
+
+__all__ = [
+        # Classes
+        'JSONMemberParser',
+        # Types
+        'JSONPath',
+        ]
@@ -0,0 +1,381 @@
+#!/usr/bin/python3
+#==============================================================================
+# 5G-MAG Reference Tools: M1 Certificate Renewal
+#==============================================================================
+#
+# File: rt_m1_client/renewal.py
+# License: 5G-MAG Public License (v1.0)
+# Author: David Waring
+# Copyright: (C) 2023 British Broadcasting Corporation
+#
+# For full license terms please see the LICENSE file distributed with this
+# program. If this file is missing then the license can be retrieved from
+# https://drive.google.com/file/d/1cinCiA778IErENZ3JN52VFW-1ffHpx7Z/view
+#
+#==============================================================================
+#
+# M1 Certificate Renewal class
+# ============================
+#
+# This module contains a class which keeps track of the expiry times of the
+# certificates in use by the provisioning sessions of an M1Session and renews
+# those certificates when they get close to expiry.
+#
+'''5G-MAG Reference Tools: M1 Certificate Renewal
+==============================================
+
+The `CertificateRenewer` class keeps an index of the expiry times of the
+certificates referenced by the ContentHostingConfigurations of the provisioning
+sessions managed by an `M1Session`.
+
+Each certificate is summarised once, using `M1Session.certificateSummary`, when
+it is first seen and its expiry time is kept in a heap ordered by expiry. Checking for certificates due for renewal
+only needs to look at the front of the heap, so repeated checks do not need to
+fetch and parse every certificate again.
+
+Certificates which are due for renewal are replaced by new certificates with the
+same domain names, the ContentHostingConfiguration is updated to use the new
+certificates and then the old certificates are deleted. If renewing a
+certificate fails then it is not tried again until a retry delay has passed,
+which doubles with each failure.
+'''
+
+import asyncio
+import copy
+import datetime
+import heapq
+import logging
+from typing import Optional, Dict, Iterable, List, Set, Tuple
+
+from .exceptions import M1Error
+from .session import M1Session
+from .types import ContentHostingConfiguration, ResourceId
+
+class CertificateRenewer:
+    '''Certificate expiry index and renewal scheduler
+    ==============================================
+
+    This class tracks the expiry times of the certificates in use by the provisioning sessions of an `M1Session`.
+
+    Use `scan` to bring the index up to date with the provisioning sessions, `dueCertificates` to find the certificates
+    which are due for renewal and `renewDue` to renew them. The `run` method combines these into a loop suitable for
+    running as a daemon.
+    '''
+
+    def __init__(self, session: M1Session, renewal_window: datetime.timedelta = datetime.timedelta(days=14),
+                 retry_delay: datetime.timedelta = datetime.timedelta(minutes=1),
+                 max_retry_delay: datetime.timedelta = datetime.timedelta(hours=6)):
+        '''Constructor
+
+        :param session: The `M1Session` to manage certificates for.
+        :param renewal_window: Certificates will be renewed when they are due to expire within this amount of time.
+        :param retry_delay: How long to wait before trying to renew a certificate again after the first failure. The delay
+                            doubles after each further failure.
+        :param max_retry_delay: The longest delay between attempts to renew a certificate.
+        '''
+        self.__log = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__session = session
+        self.__renewal_window = renewal_window
+        self.__heap: List[Tuple[datetime.datetime, ResourceId, ResourceId]] = []
+        self.__expiries: Dict[Tuple[ResourceId, ResourceId], datetime.datetime] = {}
+        self.__retry_delay = retry_delay
+        self.__max_retry_delay = max_retry_delay
+        # Certificates which failed to renew: the time to try again and the delay used
+        self.__retries: Dict[Tuple[ResourceId, ResourceId], Tuple[datetime.datetime, datetime.timedelta]] = {}
+
+    @property
+    def renewalWindow(self) -> datetime.timedelta:
+        '''The time before expiry at which certificates become due for renewal'''
+        return self.__renewal_window
+
+    async def scan(self, provisioning_session_ids: Optional[Iterable[ResourceId]] = None) -> None:
+        '''Bring the expiry index up to date
+
+        Certificates referenced by the ContentHostingConfigurations which are not yet in the index are retrieved and parsed.
+        Certificates already in the index are not retrieved again. Certificates which are no longer in use are dropped from
+        the index.
+
+        :param provisioning_session_ids: The provisioning sessions to scan. If ``None`` then all provisioning sessions known to
+                                         the `M1Session` are scanned.
+        '''
+        if provisioning_session_ids is None:
+            provisioning_session_ids = list(await self.__session.provisioningSessionIds())
+            scanned_all = True
+        else:
+            provisioning_session_ids = list(provisioning_session_ids)
+            scanned_all = False
+        in_use = await asyncio.gather(*[self.__certificatesInUse(ps_id) for ps_id in provisioning_session_ids])
+        in_use_keys = set()
+        for ps_id, cert_ids in zip(provisioning_session_ids, in_use):
+            for cert_id in cert_ids:
+                in_use_keys.add((ps_id, cert_id))
+        new_keys = [key for key in in_use_keys if key not in self.__expiries]
+        expiries = await asyncio.gather(*[self.__certificateExpiry(ps_id, cert_id) for ps_id, cert_id in new_keys])
+        for (ps_id, cert_id), not_after in zip(new_keys, expiries):
+            if not_after is not None:
+                self.__add(ps_id, cert_id, not_after)
+        scanned = set(provisioning_session_ids)
+        for key in list(self.__expiries.keys()):
+            if key not in in_use_keys and (scanned_all or key[0] in scanned):
+                del self.__expiries[key]
+                self.__retries.pop(key, None)
+        self.__compact()
+
+    def dueCertificates(self, now: Optional[datetime.datetime] = None) -> List[Tuple[ResourceId, ResourceId, datetime.datetime]]:
+        '''Find the certificates due for renewal
+
+        This does not change the index. Certificates which failed to renew are not included until their retry time has passed.
+
+        :param now: The time to check against, defaults to the current time.
+        :return: a list of (provisioning session id, certificate id, expiry time) tuples, soonest expiry first.
+        '''
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        limit = now + self.__renewal_window
+        due = []
+        popped = []
+        while len(self.__heap) > 0 and self.__heap[0][0] <= limit:
+            entry = heapq.heappop(self.__heap)
+            popped.append(entry)
+            not_after, ps_id, cert_id = entry
+            if self.__expiries.get((ps_id, cert_id)) == not_after and not self.__retryPending((ps_id, cert_id), now):
+                due.append((ps_id, cert_id, not_after))
+        for entry in popped:
+            if self.__expiries.get(entry[1:]) == entry[0]:
+                heapq.heappush(self.__heap, entry)
+        return due
+
+    def nextRenewalTime(self) -> Optional[datetime.datetime]:
+        '''Find when the next certificate will become due for renewal
+
+        For a certificate which failed to renew this is its retry time.
+
+        :return: the time the next certificate becomes due for renewal, or ``None`` if there are no certificates in the index.
+        '''
+        next_time = None
+        for key, (retry_at, _) in self.__retries.items():
+            if key in self.__expiries:
+                retry_at = max(retry_at, self.__expiries[key] - self.__renewal_window)
+                if next_time is None or retry_at < next_time:
+                    next_time = retry_at
+        # Find the soonest expiry which is not waiting to be retried
+        popped = []
+        while len(self.__heap) > 0:
+            entry = heapq.heappop(self.__heap)
+            not_after, ps_id, cert_id = entry
+            if self.__expiries.get((ps_id, cert_id)) != not_after:
+                continue
+            popped.append(entry)
+            if (ps_id, cert_id) not in self.__retries:
+                if next_time is None or not_after - self.__renewal_window < next_time:
+                    next_time = not_after - self.__renewal_window
+                break
+        for entry in popped:
+            heapq.heappush(self.__heap, entry)
+        return next_time
+
+    async def renew(self, provisioning_session_id: ResourceId,
+                    certificate_ids: Optional[Iterable[ResourceId]] = None) -> Dict[ResourceId, ResourceId]:
+        '''Renew certificates in a provisioning session
+
+        New certificates are created, with the same domain name aliases as the certificates they replace, and the
+        ContentHostingConfiguration is updated to use them. Once the ContentHostingConfiguration has been updated the old
+        certificates are deleted.
+
+        :param provisioning_session_id: The provisioning session to renew the certificates in.
+        :param certificate_ids: The certificates to renew. If ``None`` then all certificates used by the provisioning session's
+                                ContentHostingConfiguration are renewed.
+        :return: a `dict` mapping the old certificate ids to the new certificate ids for the certificates renewed.
+        '''
+        chc = await self.__session.contentHostingConfigurationGet(provisioning_session_id)
+        if chc is None:
+            self.__log.error('Provisioning session %s has no ContentHostingConfiguration', provisioning_session_id)
+            return {}
+        chc = copy.deepcopy(chc)
+        domain_names: Dict[ResourceId, Set[str]] = {}
+        for dc in chc['distributionConfigurations']:
+            cert_id = dc.get('certificateId')
+            if cert_id is None:
+                continue
+            names = domain_names.setdefault(cert_id, set())
+            if 'domainNameAlias' in dc:
+                names.add(dc['domainNameAlias'])
+        if certificate_ids is not None:
+            certificate_ids = set(certificate_ids)
+            domain_names = {cert_id: names for cert_id, names in domain_names.items() if cert_id in certificate_ids}
+        if len(domain_names) == 0:
+            return {}
+        old_cert_ids = list(domain_names.keys())
+        new_cert_ids = await self.__session.createNewCertificates(
+                [(provisioning_session_id, sorted(domain_names[cert_id]) or None) for cert_id in old_cert_ids], reuse=False)
+        renewed = {old: new for old, new in zip(old_cert_ids, new_cert_ids) if new is not None}
+        for old in old_cert_ids:
+            if old not in renewed:
+                self.__log.error('Failed to create replacement for certificate %s in provisioning session %s', old,
+                                 provisioning_session_id)
+        if len(renewed) == 0:
+            return {}
+        for dc in chc['distributionConfigurations']:
+            if dc.get('certificateId') in renewed:
+                dc['certificateId'] = renewed[dc['certificateId']]
+            # These fields are generated by the Application Function and cannot be set
+            for strip_field in ['canonicalDomainName', 'baseURL']:
+                if strip_field in dc:
+                    del dc[strip_field]
+        if not await self.__session.contentHostingConfigurationUpdate(provisioning_session_id, chc):
+            self.__log.error('Failed to update ContentHostingConfiguration for provisioning session %s',
+                             provisioning_session_id)
+            await self.__deleteCertificates(provisioning_session_id, set(renewed.values()))
+            return {}
+        await self.__deleteCertificates(provisioning_session_id, renewed.keys())
+        for old in renewed.keys():
+            self.__expiries.pop((provisioning_session_id, old), None)
+            self.__retries.pop((provisioning_session_id, old), None)
+        await self.scan([provisioning_session_id])
+        return renewed
+
+    async def renewDue(self, now: Optional[datetime.datetime] = None) -> Dict[ResourceId, Dict[ResourceId, ResourceId]]:
+        '''Renew all certificates due for renewal
+
+        The provisioning sessions with certificates due for renewal are processed concurrently. Certificates which could not be
+        renewed are backed off and not tried again until their retry delay has passed.
+
+        :param now: The time to check against, defaults to the current time.
+        :return: a `dict` mapping provisioning session id to the old to new certificate id mappings returned by `renew`.
+        '''
+        due: Dict[ResourceId, List[ResourceId]] = {}
+        for ps_id, cert_id, not_after in self.dueCertificates(now):
+            self.__log.info('Certificate %s in provisioning session %s expires %s, renewing', cert_id, ps_id,
+                            not_after.isoformat())
+            due.setdefault(ps_id, []).append(cert_id)
+        ps_ids = list(due.keys())
+        results = await asyncio.gather(*[self.renew(ps_id, due[ps_id]) for ps_id in ps_ids], return_exceptions=True)
+        renewed = {}
+        for ps_id, result in zip(ps_ids, results):
+            if isinstance(result, M1Error):
+                self.__log.error('Failed to renew certificates for provisioning session %s: %s', ps_id, result)
+                result = {}
+            elif isinstance(result, BaseException):
+                raise result
+            elif len(result) > 0:
+                renewed[ps_id] = result
+            for cert_id in due[ps_id]:
+                if cert_id not in result:
+                    self.__retryLater((ps_id, cert_id))
+        return renewed
+
+    async def run(self, rescan_interval: float = 3600.0) -> None:
+        '''Run the renewal loop
+
+        This scans the provisioning sessions and renews any certificates which are due, then sleeps until either the next
+        certificate becomes due or *rescan_interval* seconds have passed, whichever is sooner. This method does not return
+        unless cancelled.
+
+        :param rescan_interval: The maximum time, in seconds, between scans of the provisioning sessions.
+        '''
+        while True:
+            try:
+                await self.scan()
+                await self.renewDue()
+            except M1Error as err:
+                self.__log.error('Certificate renewal check failed: %s', err)
+            delay = rescan_interval
+            next_renewal = self.nextRenewalTime()
+            if next_renewal is not None:
+                until_next = (next_renewal - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                delay = max(min(delay, until_next), 1.0)
+            self.__log.debug('Next certificate renewal check in %.0f seconds', delay)
+            await asyncio.sleep(delay)
+
+    def __add(self, provisioning_session_id: ResourceId, certificate_id: ResourceId, not_after: datetime.datetime) -> None:
+        '''Add a certificate expiry to the index
+
+        :meta private:
+        '''
+        self.__expiries[(provisioning_session_id, certificate_id)] = not_after
+        heapq.heappush(self.__heap, (not_after, provisioning_session_id, certificate_id))
+
+    def __retryPending(self, key: Tuple[ResourceId, ResourceId], now: datetime.datetime) -> bool:
+        '''Check if a certificate which failed to renew is still waiting for its retry time
+
+        :meta private:
+        '''
+        retry = self.__retries.get(key)
+        return retry is not None and retry[0] > now
+
+    def __retryLater(self, key: Tuple[ResourceId, ResourceId]) -> None:
+        '''Back off renewal of a certificate which failed to renew
+
+        :meta private:
+        '''
+        retry = self.__retries.get(key)
+        delay = self.__retry_delay if retry is None else min(retry[1] * 2, self.__max_retry_delay)
+        retry_at = datetime.datetime.now(datetime.timezone.utc) + delay
+        self.__retries[key] = (retry_at, delay)
+        self.__log.warning('Certificate %s in provisioning session %s will be renewed again after %s', key[1], key[0],
+                           retry_at.isoformat())
+
+    def __compact(self) -> None:
+        '''Rebuild the heap if it holds too many stale entries
+
+        :meta private:
+        '''
+        if len(self.__heap) > 2 * len(self.__expiries) + 16:
+            self.__heap = [(not_after, ps_id, cert_id) for (ps_id, cert_id), not_after in self.__expiries.items()]
+            heapq.heapify(self.__heap)
+
+    async def __certificatesInUse(self, provisioning_session_id: ResourceId) -> Set[ResourceId]:
+        '''Get the certificate ids used by a provisioning session's ContentHostingConfiguration
+
+        :meta private:
+        '''
+        try:
+            chc: Optional[ContentHostingConfiguration] = await self.__session.contentHostingConfigurationGet(provisioning_session_id)
+        except M1Error as err:
+            self.__log.warning('Unable to retrieve ContentHostingConfiguration for provisioning session %s: %s',
+                               provisioning_session_id, err)
+            return set()
+        if chc is None:
+            return set()
+        return set([dc['certificateId'] for dc in chc['distributionConfigurations'] if 'certificateId' in dc])
+
+    async def __certificateExpiry(self, provisioning_session_id: ResourceId, certificate_id: ResourceId) -> Optional[datetime.datetime]:
+        '''Retrieve a certificate and find its expiry time
+
+        :meta private:
+        :return: the notAfter time of the certificate or ``None`` if the certificate is unavailable or cannot be parsed.
+        '''
+        try:
+            summary = await self.__session.certificateSummary(provisioning_session_id, certificate_id)
+        except M1Error as err:
+            self.__log.warning('Unable to retrieve certificate %s from provisioning session %s: %s', certificate_id,
+                               provisioning_session_id, err)
+            return None
+        except ValueError as err:
+            self.__log.warning('Unable to parse certificate %s from provisioning session %s: %s', certificate_id,
+                               provisioning_session_id, err)
+            return None
+        if summary is None:
+            # Certificate reserved but not uploaded yet
+            return None
+        return summary['notAfter']
+
+    async def __deleteCertificates(self, provisioning_session_id: ResourceId, certificate_ids: Iterable[ResourceId]) -> None:
+        '''Delete certificates, logging any failures
+
+        :meta private:
+        '''
+        certificate_ids = list(certificate_ids)
+        results = await asyncio.gather(*[self.__session.certificateDelete(provisioning_session_id, cert_id)
+                                         for cert_id in certificate_ids], return_exceptions=True)
+        for cert_id, result in zip(certificate_ids, results):
+            if isinstance(result, M1Error) or not result:
+                self.__log.warning('Failed to delete certificate %s from provisioning session %s', cert_id,
+                                   provisioning_session_id)
+            elif isinstance(result, BaseException):
+                raise result
+
+__all__ = [
+        # Classes
+        'CertificateRenewer',
+        ]
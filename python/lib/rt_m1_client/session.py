@@ -33,14 +33,15 @@ Application Function.
 This class uses the M1Client class to communicate with the 5GMS Application
 Function via the interface at reference point M1.
 '''
+import asyncio
+import copy
 import datetime
-import importlib
 import inspect
+import json
 import logging
 import re
-from typing import Optional, Union, Tuple, Dict, Any, TypedDict, List, Iterable
+from typing import Optional, Union, Tuple, Dict, Any, TypedDict, List, Iterable, Awaitable
 
-import OpenSSL
 
 from .exceptions import (M1ClientError, M1ServerError, M1Error)
 from .types import (ApplicationId, ContentHostingConfiguration, ContentProtocols, ProvisioningSessionType, ProvisioningSession,
@@ -49,7 +50,9 @@ from .client import (M1Client, ProvisioningSessionResponse, ContentHostingConfig
                      ServerCertificateSigningRequestResponse, ContentProtocolsResponse, ConsumptionReportingConfigurationResponse, MetricsReportingConfigurationResponse,
                      PolicyTemplateResponse)
 from .data_store import DataStore
-from .certificates import CertificateSigner, DefaultCertificateSigner
+from .certificates import CertificateSigner, DefaultCertificateSigner, CertificateSummary, certificate_summary, pem_digest
+from .configuration import load_class_spec
+from .json_patch import make_json_patch
 
 class M1Session:
     '''M1 Session management class
@@ -59,19 +62,40 @@ class M1Session:
     communicate using the `M1Client` class with the M1 Server (5GMS Application Function) and cache the results to improve
     efficiency. It can also use a `DataStore` to provide persistence of information across different sessions, and can use a
     `CertificateSigner` to perform signing of certificates when ``domainNameAlias`` is used.
+
+    If a *certificate_reuse_min_validity* is given then, when asked to create a new certificate, an existing certificate in the
+    provisioning session which has the same domain names and is valid for at least that long will be reused instead.
+
+    The `CertificateSigner` is normally created when it is first needed. Long running applications can set
+    *prepare_certificate_signer* to create it when the `M1Session` is created, so that it can prepare in the background, e.g.
+    by pre-generating keys, before the first certificate is signed.
     '''
 
-    def __init__(self, host_address: Tuple[str,int], persistent_data_store: Optional[DataStore] = None, certificate_signer: Optional[Union[CertificateSigner,type,str]] = None):
+    def __init__(self, host_address: Tuple[str,int], persistent_data_store: Optional[DataStore] = None, certificate_signer: Optional[Union[CertificateSigner,type,str]] = None, certificate_reuse_min_validity: Optional[Union[datetime.timedelta,float,str]] = None, prepare_certificate_signer: bool = False):
         '''Constructor
 
         :param host_address: A tuple containing the M1 server (5GMS Application Function) hostname/ip-address and TCP port number
                              to contact it at.
         :param persistent_data_store: A `DataStore` object to use to provide persistent storage.
         :param certificate_signer: A `CertificateSigner` to use when signing certificates with extra domain names. This can be either a `str` containing the full Python class name, a `CertificateSigner` class to instantiate if needed, or an instance of a `CertificateSigner` to use. If not given then ``rt_m1_client.certificates.DefaultCertificateSigner`` is used.
+        :param certificate_reuse_min_validity: The minimum remaining validity for an existing certificate to be reused instead of
+                                               creating a new certificate. This can be a `datetime.timedelta` or a number of
+                                               days, as a number or a `str`. If not given, empty or zero then existing
+                                               certificates are never reused.
+        :param prepare_certificate_signer: If ``True`` then create the `CertificateSigner` when this `M1Session` is created
+                                           instead of when it is first needed.
         '''
         self.__m1_host = host_address
+        if certificate_reuse_min_validity is not None and not isinstance(certificate_reuse_min_validity, datetime.timedelta):
+            if len(str(certificate_reuse_min_validity).strip()) > 0 and float(certificate_reuse_min_validity) > 0:
+                certificate_reuse_min_validity = datetime.timedelta(days=float(certificate_reuse_min_validity))
+            else:
+                certificate_reuse_min_validity = None
+        self.__cert_reuse_min_validity: Optional[datetime.timedelta] = certificate_reuse_min_validity
         self.__data_store_dir = persistent_data_store
-        self.__cert_signer = certificate_signer
+        self.__cert_signer_spec = certificate_signer
+        self.__cert_signer: Optional[CertificateSigner] = None
+        self.__prepare_cert_signer: bool = prepare_certificate_signer
         self.__m1_client = None
         self.__provisioning_sessions = {}
         self.__ca_key = None
@@ -86,14 +110,30 @@ class M1Session:
     async def __asyncInit(self):
         '''Asynchronous object instantiation
 
-        Loads previous state from the DataStore.
+        Loads previous state from the DataStore and, if *prepare_certificate_signer* was set, creates the `CertificateSigner`.
 
         :meta private:
         :return: self
         '''
         await self.__reloadFromDataStore()
+        if self.__prepare_cert_signer:
+            try:
+                await self.__getCertificateSigner()
+            except (RuntimeError, ImportError, AttributeError, TypeError, ValueError) as err:
+                # Leave any error to be reported when a certificate is signed
+                self.__log.warning('Unable to create the certificate signer: %s', err)
         return self
 
+    async def aclose(self) -> None:
+        '''Release the resources held by the session
+
+        This closes the `CertificateSigner`, if one has been created, including one passed in as *certificate_signer*.
+        Applications should await this before exiting.
+        '''
+        cert_signer, self.__cert_signer = self.__cert_signer, None
+        if cert_signer is not None:
+            await cert_signer.aclose()
+
     # Provisioning Session Management
 
     async def provisioningSessionIds(self) -> Iterable:
@@ -103,6 +143,21 @@ class M1Session:
         '''
         return self.__provisioning_sessions.keys()
 
+    async def provisioningSessionRefresh(self, provisioning_session_id: ResourceId) -> bool:
+        '''Discard the cached state of a provisioning session and fetch it again from the AF
+
+        The cached resources of the provisioning session, such as its `ContentHostingConfiguration`, are also discarded and will
+        be fetched again when next asked for. If the AF no longer has the provisioning session then it is forgotten.
+
+        :param ResourceId provisioning_session_id: The provisioning session to refresh.
+        :return: ``True`` if the provisioning session still exists in the AF or ``False`` if it does not.
+        '''
+        if provisioning_session_id not in self.__provisioning_sessions:
+            return False
+        self.__provisioning_sessions[provisioning_session_id] = None
+        await self.__cacheProvisioningSession(provisioning_session_id)
+        return provisioning_session_id in self.__provisioning_sessions
+
     async def provisioningSessionProtocols(self, provisioning_session_id: ResourceId) -> Optional[ContentProtocols]:
         '''Get the ContentProtocols for the existing provisioning session
 
@@ -114,6 +169,18 @@ class M1Session:
         await self.__cacheProtocols(provisioning_session_id)
         return self.__provisioning_sessions[provisioning_session_id]['protocols']['contentprotocols']
 
+    async def provisioningSessionETag(self, provisioning_session_id: ResourceId) -> Optional[str]:
+        '''Get the entity tag for the existing provisioning session
+
+        :param ResourceId provisioning_session_id: The provisioning session to get the entity tag for.
+        :return: the ``ETag`` of the provisioning session or ``None`` if the provisioning session could not be found or the AF did
+                 not provide an entity tag.
+        '''
+        ps = await self.__getProvisioningSessionCache(provisioning_session_id)
+        if ps is None:
+            return None
+        return ps.get('etag')
+
     async def provisioningSessionCertificateIds(self, provisioning_session_id: ResourceId) -> Optional[List[ResourceId]]:
         '''Get the list of certificate Ids for a provisioning session
 
@@ -123,6 +190,8 @@ class M1Session:
         if provisioning_session_id not in self.__provisioning_sessions:
             return None
         await self.__cacheProvisioningSession(provisioning_session_id)
+        if self.__provisioning_sessions.get(provisioning_session_id) is None:
+            return None
         ps = self.__provisioning_sessions[provisioning_session_id]['provisioningsession']
         if 'certificates' not in ps:
             return []
@@ -138,8 +207,8 @@ class M1Session:
         if provisioning_session_id not in self.__provisioning_sessions:
             return None
         await self.__cacheContentHostingConfiguration(provisioning_session_id)
-        ps = self.__provisioning_sessions[provisioning_session_id]
-        chc_resp = ps['content-hosting-configuration']
+        ps = self.__provisioning_sessions.get(provisioning_session_id)
+        chc_resp = ps and ps['content-hosting-configuration']
         if chc_resp is None:
             # Nothing got cached from the AF, probably an error, but no CHC found
             return None
@@ -218,6 +287,8 @@ class M1Session:
         if provisioning_session_id not in self.__provisioning_sessions:
             return None
         await self.__cacheProvisioningSession(provisioning_session_id)
+        if self.__provisioning_sessions.get(provisioning_session_id) is None:
+            return None
         ps = self.__provisioning_sessions[provisioning_session_id]['provisioningsession']
         if 'serverCertificateIds' not in ps:
             return []
@@ -282,6 +353,30 @@ class M1Session:
         # Return the cached certificate
         return ps['certificates'][certificate_id]['servercertificate']
 
+    async def certificateSummary(self, provisioning_session_id: ResourceId, certificate_id: ResourceId) -> Optional[CertificateSummary]:
+        '''Retrieve a summary of a public certificate
+
+        The summary is parsed from the PEM data the first time it is requested and then kept with the PEM data in the
+        certificate cache, so that later requests for the same certificate do not need to decode the certificate again. The
+        summary is made again if the PEM data changes and is dropped along with the PEM data.
+
+        :param provisioning_session_id: The provisioning session id to use to look up the certificate.
+        :param certificate_id: The certificate id for the certificate in the provisioning session.
+
+        :return: The `CertificateSummary` for the public certificate or ``None`` if the certificate could not be found or has
+                 not been uploaded yet.
+        :raise ValueError: if the certificate PEM data could not be parsed.
+        '''
+        pem = await self.certificateGet(provisioning_session_id, certificate_id)
+        if pem is None:
+            return None
+        cert = self.__provisioning_sessions[provisioning_session_id]['certificates'][certificate_id]
+        summary = cert.get('summary')
+        if summary is None or summary['digest'] != pem_digest(pem):
+            summary = certificate_summary(pem)
+            cert['summary'] = summary
+        return CertificateSummary(summary, subjectAltNames=list(summary['subjectAltNames']))
+
     async def certificateNewSigningRequest(self, provisioning_session_id: ResourceId, extra_domain_names: Optional[List[str]] = None) -> Optional[Tuple[ResourceId,str]]:
         '''Create a new CSR for a provisioning session
 
@@ -305,10 +400,11 @@ class M1Session:
         cert_id = cert_resp['ServerCertificateId']
         ps = await self.__getProvisioningSessionCache(provisioning_session_id)
         if ps is not None:
+            # The public certificate is not available until it is set, so just note the certificate id for now
             if 'certificates' not in ps or ps['certificates'] is None:
-                ps['certificates'] = [cert_id]
+                ps['certificates'] = {cert_id: None}
             elif cert_id not in ps['certificates']:
-                ps['certificates'] += [cert_id]
+                ps['certificates'][cert_id] = None
         return (cert_id,cert_resp['CertificateSigningRequestPEM'])
 
     async def certificateSet(self, provisioning_session_id: ResourceId, certificate_id: ResourceId, pem: str) -> Optional[bool]:
@@ -330,6 +426,32 @@ class M1Session:
         await self.__connect()
         return await self.__m1_client.uploadServerCertificate(provisioning_session_id, certificate_id, pem)
 
+    async def certificateDelete(self, provisioning_session_id: ResourceId, certificate_id: ResourceId) -> Optional[bool]:
+        '''Delete a certificate from a provisioning session
+
+        :param provisioning_session_id: The provisioning session id of the provisioning session to delete the certificate from.
+        :param certificate_id: The certificate id of the certificate to delete.
+
+        :return: ``True`` if the certificate was deleted, ``False`` if the deletion failed and ``None`` if the provisioning
+                 session was not found.
+        '''
+        if provisioning_session_id not in self.__provisioning_sessions:
+            return None
+        await self.__connect()
+        result = await self.__m1_client.destroyServerCertificate(provisioning_session_id, certificate_id)
+        if result:
+            ps = self.__provisioning_sessions[provisioning_session_id]
+            if ps is not None:
+                if ps.get('certificates') is not None and certificate_id in ps['certificates']:
+                    if isinstance(ps['certificates'], dict):
+                        del ps['certificates'][certificate_id]
+                    else:
+                        ps['certificates'].remove(certificate_id)
+                cert_ids = (ps.get('provisioningsession') or {}).get('serverCertificateIds')
+                if cert_ids is not None and certificate_id in cert_ids:
+                    cert_ids.remove(certificate_id)
+        return result
+
     # ContentHostingConfiguration methods
 
     async def contentHostingConfigurationCreate(self, provisioning_session: ResourceId, chc: ContentHostingConfiguration) -> bool:
@@ -369,6 +491,22 @@ class M1Session:
             return None
         return ContentHostingConfiguration(ps['content-hosting-configuration']['contenthostingconfiguration'])
 
+    async def contentHostingConfigurationETag(self, provisioning_session: ResourceId) -> Optional[str]:
+        '''Get the entity tag of the `ContentHostingConfiguration` set on a provisioning session
+
+        :param provisioning_session: The provisioning session id to get the `ContentHostingConfiguration` entity tag for.
+
+        :return: the ``ETag`` of the `ContentHostingConfiguration` or ``None`` if the provisioning session does not exist, if it
+                 has no `ContentHostingConfiguration` set or if the AF did not provide an entity tag.
+        '''
+        if provisioning_session not in self.__provisioning_sessions:
+            return None
+        await self.__cacheContentHostingConfiguration(provisioning_session)
+        ps = await self.__getProvisioningSessionCache(provisioning_session)
+        if ps is None or ps['content-hosting-configuration'] is None:
+            return None
+        return ps['content-hosting-configuration'].get('etag')
+
     async def contentHostingConfigurationUpdate(self, provisioning_session: ResourceId, chc: ContentHostingConfiguration) -> bool:
         '''Update the `ContentHostingConfiguration` for a provisioning session
 
@@ -381,7 +519,59 @@ class M1Session:
         if provisioning_session not in self.__provisioning_sessions:
             return False
         await self.__connect()
-        return await self.__m1_client.updateContentHostingConfiguration(provisioning_session, chc)
+        result = await self.__m1_client.updateContentHostingConfiguration(provisioning_session, chc)
+        if result:
+            # The update response has no body, so fetch the new configuration when next asked for it
+            ps = self.__provisioning_sessions[provisioning_session]
+            if ps is not None:
+                ps['content-hosting-configuration'] = None
+        return result
+
+    async def contentHostingConfigurationPatch(self, provisioning_session: ResourceId, chc: ContentHostingConfiguration) -> bool:
+        '''Change the `ContentHostingConfiguration` for a provisioning session using a JSON Patch
+
+        A JSON Patch is made between the current `ContentHostingConfiguration` and *chc* so that only the changes are sent to the
+        AF. The fields generated by the AF in each distribution configuration (``canonicalDomainName`` and ``baseURL``) are left
+        alone unless they are present in *chc*. If the AF rejects the patch then the whole `ContentHostingConfiguration` is
+        replaced using `contentHostingConfigurationUpdate` instead.
+
+        :param provisioning_session: The provisioning session id of the provisioning session to change the
+                                     `ContentHostingConfiguration` in.
+        :param chc: The desired `ContentHostingConfiguration`.
+        :return: ``True`` if the provisioning session now has the desired `ContentHostingConfiguration` or ``False`` if the
+                 operation failed (e.g. because there was no `ContentHostingConfiguration` set).
+        '''
+        current = await self.contentHostingConfigurationGet(provisioning_session)
+        if current is None:
+            return False
+        current = copy.deepcopy(current)
+        new_dcs = chc.get('distributionConfigurations', [])
+        for i, dc in enumerate(current.get('distributionConfigurations', [])):
+            for gen_field in ['canonicalDomainName', 'baseURL']:
+                if i >= len(new_dcs) or gen_field not in new_dcs[i]:
+                    dc.pop(gen_field, None)
+        patch = make_json_patch(current, chc)
+        if len(patch) == 0:
+            return True
+        await self.__connect()
+        try:
+            result = await self.__m1_client.patchContentHostingConfiguration(provisioning_session, json.dumps(patch))
+        except M1Error as err:
+            if not self.__patchRejected(err):
+                raise
+            self.__log.info('AF rejected the ContentHostingConfiguration patch for %s (%s), replacing it instead',
+                            provisioning_session, err)
+            result = False
+        if not result:
+            return await self.contentHostingConfigurationUpdate(provisioning_session, chc)
+        ps = self.__provisioning_sessions[provisioning_session]
+        if ps is not None:
+            if isinstance(result, bool):
+                # No body in the response, so fetch the new configuration when next asked for it
+                ps['content-hosting-configuration'] = None
+            else:
+                ps['content-hosting-configuration'] = {k.lower(): v for k,v in result.items()}
+        return True
 
     # ConsumptionReportingConfiguration methods
 
@@ -436,6 +626,43 @@ class M1Session:
         await self.__connect()
         return await self.__m1_client.updateConsumptionReportingConfiguration(provisioning_session, crc)
 
+    async def consumptionReportingConfigurationPatch(self, provisioning_session: ResourceId, crc: ConsumptionReportingConfiguration) -> bool:
+        '''Change the `ConsumptionReportingConfiguration` for a provisioning session using a JSON Patch
+
+        A JSON Patch is made between the current `ConsumptionReportingConfiguration` and *crc* so that only the changes are
+        sent to the AF. If the AF rejects the patch then the whole `ConsumptionReportingConfiguration` is replaced using
+        `consumptionReportingConfigurationUpdate` instead.
+
+        :param provisioning_session: The provisioning session id of the provisioning session to change the
+                                     `ConsumptionReportingConfiguration` in.
+        :param crc: The desired `ConsumptionReportingConfiguration`.
+        :return: ``True`` if the provisioning session now has the desired `ConsumptionReportingConfiguration` or ``False`` if
+                 the operation failed (e.g. because there was no `ConsumptionReportingConfiguration` set).
+        '''
+        current = await self.consumptionReportingConfigurationGet(provisioning_session)
+        if current is None:
+            return False
+        patch = make_json_patch(current, crc)
+        if len(patch) == 0:
+            return True
+        await self.__connect()
+        try:
+            result = await self.__m1_client.patchConsumptionReportingConfiguration(provisioning_session, json.dumps(patch))
+        except M1Error as err:
+            if not self.__patchRejected(err):
+                raise
+            self.__log.info('AF rejected the ConsumptionReportingConfiguration patch for %s (%s), replacing it instead',
+                            provisioning_session, err)
+            result = None
+        ps = self.__provisioning_sessions[provisioning_session]
+        if result is None:
+            if ps is not None:
+                ps['consumption-reporting-configuration'] = None
+            return await self.consumptionReportingConfigurationUpdate(provisioning_session, crc)
+        if ps is not None:
+            ps['consumption-reporting-configuration'] = {k.lower(): v for k,v in result.items()}
+        return True
+
     async def consumptionReportingConfigurationDelete(self, provisioning_session: ResourceId) -> bool:
         '''Remove the `ConsumptionReportingConfiguration` for a provisioning session
 
@@ -460,6 +687,8 @@ class M1Session:
         if provisioning_session_id not in self.__provisioning_sessions:
             return None
         await self.__cacheProvisioningSession(provisioning_session_id)
+        if self.__provisioning_sessions.get(provisioning_session_id) is None:
+            return None
         ps = self.__provisioning_sessions[provisioning_session_id]['provisioningsession']
         if 'policyTemplateIds' not in ps:
             return []
@@ -505,7 +734,7 @@ class M1Session:
         if provisioning_session_id not in self.__provisioning_sessions:
             return None
         await self.__cachePolicyTemplates(provisioning_session_id)
-        ps = self.__provisioning_sessions[provisioning_session_id]        
+        ps = self.__provisioning_sessions.get(provisioning_session_id)
         if ps is None or 'policyTemplates' not in ps or ps['policyTemplates'] is None or policy_template_id not in ps['policyTemplates']:
             return None
         return PolicyTemplate(ps['policyTemplates'][policy_template_id]['policytemplate'])
@@ -537,6 +766,8 @@ class M1Session:
         if provisioning_session_id not in self.__provisioning_sessions:
             return None
         await self.__cacheProvisioningSession(provisioning_session_id)
+        if self.__provisioning_sessions.get(provisioning_session_id) is None:
+            return None
         ps = self.__provisioning_sessions[provisioning_session_id]['provisioningsession']
         if 'metricsReportingConfigurationIds' not in ps:
             return []
@@ -621,7 +852,7 @@ class M1Session:
         '''
         return await self.provisioningSessionCreate(PROVISIONING_SESSION_TYPE_DOWNLINK, app_id, asp_id)
 
-    async def createNewCertificate(self, provisioning_session: ResourceId, extra_domain_names: Optional[List[str]] = None) -> Optional[ResourceId]:
+    async def createNewCertificate(self, provisioning_session: ResourceId, extra_domain_names: Optional[List[str]] = None, reuse: bool = True) -> Optional[ResourceId]:
         '''Create a new certificate
 
         This will create a new certificate for the provisioning session. If *domain_name_alias* is not given this will leave
@@ -629,20 +860,20 @@ class M1Session:
         ``None`` and contains at least one entry then this will reserve a certificate for the provisioning session, sign the CSR
         using the local `CertificateSigner` object and set the signed public certificate for the provisioning session.
 
+        If certificate reuse is enabled, and *reuse* is ``True``, then an existing certificate will be returned instead if one
+        is found which has exactly the *extra_domain_names* (see `certificateFindReusable`).
+
         :param provisioning_session: The provisioning session id of the provisioning session to create the certificate in.
         :param extra_domain_names: An optional list of domain names to add as extra SubjectAltName entries.
+        :param reuse: Set to ``False`` to always create a new certificate.
         :return: The certificate id of the newly created certificate or ``None`` if the certificate could not be created.
         '''
+        extra_domain_names = self.__normaliseDomainNames(extra_domain_names)
+        if reuse:
+            cert_id = await self.certificateFindReusable(provisioning_session, extra_domain_names)
+            if cert_id is not None:
+                return cert_id
         # simple case just create the certificate
-        if extra_domain_names is not None and isinstance(extra_domain_names, bytes):
-            extra_domain_names = extra_domain_names.decode('utf-8')
-        if extra_domain_names is not None and isinstance(extra_domain_names, str):
-            if len(extra_domain_names) > 0:
-                extra_domain_names = [extra_domain_names]
-            else:
-                extra_domain_names = None
-        if extra_domain_names is not None and len(extra_domain_names) == 0:
-            extra_domain_names = None
         if extra_domain_names is None:
             return await self.certificateCreate(provisioning_session)
         # When domainNameAlias is used we need to use a CSR
@@ -662,6 +893,95 @@ class M1Session:
             return None
         return cert_id
 
+    async def createNewCertificates(self, requests: Iterable[Tuple[ResourceId, Optional[Union[List[str],str]]]], reuse: bool = True, concurrency: Optional[int] = None) -> List[Optional[ResourceId]]:
+        '''Create several new certificates
+
+        This is the batch form of `createNewCertificate`. Each request is a tuple of the provisioning session id to create the
+        certificate in and the optional extra domain names for the certificate.
+
+        Certificates without extra domain names are created by the M1 server concurrently. For the remaining requests the CSRs
+        are reserved concurrently, signed together using a single call to `CertificateSigner.signCertificates` and the signed
+        certificates are then uploaded concurrently.
+
+        If the `CertificateSigner` has a `CertificateSigner.consolidationLimit` then requests with extra domain names in the
+        same provisioning session are combined into as few certificates as possible, in which case several requests will
+        receive the same certificate id.
+
+        If certificate reuse is enabled, and *reuse* is ``True``, then requests which can be satisfied by an existing
+        certificate (see `certificateFindReusable`) are given that certificate's id instead of creating a new certificate.
+
+        A failure for one request does not stop the other requests. The failure is logged and ``None`` is returned for that
+        request.
+
+        If *concurrency* is given then no more than that many requests to the M1 server are made at once.
+
+        :param requests: The certificates to create as tuples of provisioning session id and extra domain names.
+        :param reuse: Set to ``False`` to always create new certificates.
+        :param concurrency: The maximum number of requests to make to the M1 server at once, or ``None`` for no limit.
+        :return: a list of the certificate ids of the newly created certificates, in the same order as *requests*, with
+                 ``None`` in place of any certificate which could not be created.
+        '''
+        requests = [(ps_id, self.__normaliseDomainNames(domain_names)) for ps_id, domain_names in requests]
+        results: List[Optional[ResourceId]] = [None] * len(requests)
+        limit = asyncio.Semaphore(max(1, int(concurrency))) if concurrency is not None else None
+        if reuse and self.__cert_reuse_min_validity is not None:
+            ps_ids = list(set([ps_id for ps_id, _ in requests]))
+            candidates = dict(zip(ps_ids, await asyncio.gather(*[self.__bounded(limit, self.__reusableCertificates(ps_id))
+                                                                 for ps_id in ps_ids])))
+            for i, (ps_id, domain_names) in enumerate(requests):
+                results[i] = self.__matchReusableCertificate(*candidates[ps_id], domain_names)
+        simple = [i for i, (_, domain_names) in enumerate(requests) if domain_names is None and results[i] is None]
+        # Requests needing a CSR as (provisioning session id, domain names, indexes into requests)
+        signed = [(ps_id, domain_names, [i]) for i, (ps_id, domain_names) in enumerate(requests)
+                  if domain_names is not None and results[i] is None]
+        cert_signer = None
+        if len(signed) > 0:
+            cert_signer = await self.__getCertificateSigner()
+            consolidation_limit = cert_signer.consolidationLimit()
+            if consolidation_limit > 0:
+                signed = self.__consolidateRequests(signed, consolidation_limit)
+        created, csrs = await asyncio.gather(
+                asyncio.gather(*[self.__bounded(limit, self.certificateCreate(requests[i][0])) for i in simple],
+                               return_exceptions=True),
+                asyncio.gather(*[self.__bounded(limit, self.certificateNewSigningRequest(ps_id, extra_domain_names=domain_names))
+                                 for ps_id, domain_names, _ in signed], return_exceptions=True))
+        for i, cert_id in zip(simple, created):
+            results[i] = self.__batchResult(cert_id, f'Failed to create certificate for provisioning session {requests[i][0]}')
+        reserved = [(req, csr) for req, csr in zip(signed, csrs)
+                    if self.__batchResult(csr, f'Failed to reserve certificate for provisioning session {req[0]}')]
+        if len(reserved) == 0:
+            return results
+        certs: List[Optional[str]] = await cert_signer.signCertificates([csr[1] for _, csr in reserved])
+        uploads = [(req, csr[0], cert) for (req, csr), cert in zip(reserved, certs)
+                   if self.__batchResult(cert, f'Failed to generate certificate with domainNameAlias for provisioning session {req[0]}')]
+        uploaded = await asyncio.gather(*[self.__bounded(limit, self.certificateSet(req[0], cert_id, cert))
+                                          for req, cert_id, cert in uploads], return_exceptions=True)
+        for (req, cert_id, _), result in zip(uploads, uploaded):
+            if self.__batchResult(result, f'Failed to upload certificate with domainNameAlias for provisioning session {req[0]}'):
+                for i in req[2]:
+                    results[i] = cert_id
+        return results
+
+    async def certificateFindReusable(self, provisioning_session_id: ResourceId, extra_domain_names: Optional[List[str]] = None) -> Optional[ResourceId]:
+        '''Find an existing certificate which can be reused
+
+        A certificate can be reused if it has been uploaded, its DNS subjectAltNames are exactly the *extra_domain_names* plus
+        any of the AF's default names for the provisioning session, and it remains valid for at least the
+        *certificate_reuse_min_validity* given when this `M1Session` was created. The AF's default names are taken to be the
+        ``canonicalDomainName`` values in the provisioning session's `ContentHostingConfiguration`. If there is none then only
+        a certificate with exactly the *extra_domain_names* can be reused. Of the certificates which can be reused, the one
+        with the latest expiry is chosen.
+
+        :param provisioning_session_id: The provisioning session to look for the certificate in.
+        :param extra_domain_names: The extra domain names the certificate must include.
+        :return: the certificate id of a certificate which can be reused, or ``None`` if there is no such certificate or if
+                 certificate reuse is not enabled.
+        '''
+        if self.__cert_reuse_min_validity is None:
+            return None
+        return self.__matchReusableCertificate(*await self.__reusableCertificates(provisioning_session_id),
+                                               self.__normaliseDomainNames(extra_domain_names))
+
     async def createNewDownlinkPullStream(self, ingesturl: str, app_id: ApplicationId, entrypoints: Optional[List[str]] = None, name: Optional[str] = None, asp_id: Optional[ApplicationId] = None, ssl: bool = False, insecure: bool = True, domain_name_alias: Optional[str] = None) -> ResourceId:
         '''Create a new downlink pull stream
 
@@ -773,6 +1093,130 @@ class M1Session:
 
     # Private methods
 
+    @staticmethod
+    def __consolidateRequests(requests: List[Tuple[ResourceId, List[str], List[int]]],
+                              limit: int) -> List[Tuple[ResourceId, List[str], List[int]]]:
+        '''Combine certificate requests in the same provisioning session
+
+        The requests for each provisioning session are packed, largest domain name set first, into the first combined request
+        that they will fit in without the combined request having more than *limit* domain names.
+
+        :meta private:
+        :param requests: The requests as tuples of provisioning session id, domain names and request indexes.
+        :param limit: The maximum number of domain names in a combined request.
+        :return: the combined requests, as tuples of provisioning session id, domain names and the request indexes combined.
+        '''
+        by_session: Dict[ResourceId, List[Tuple[set, List[int]]]] = {}
+        for ps_id, domain_names, indexes in sorted(requests, key=lambda req: len(set(req[1])), reverse=True):
+            names = set(domain_names)
+            bins = by_session.setdefault(ps_id, [])
+            for bin_names, bin_indexes in bins:
+                if len(bin_names | names) <= limit:
+                    bin_names |= names
+                    bin_indexes += indexes
+                    break
+            else:
+                bins += [(names, list(indexes))]
+        return [(ps_id, sorted(names), sorted(indexes)) for ps_id, bins in by_session.items() for names, indexes in bins]
+
+    @staticmethod
+    def __normaliseDomainNames(extra_domain_names: Optional[Union[List[str],str,bytes]]) -> Optional[List[str]]:
+        '''Normalise an extra domain names parameter
+
+        :meta private:
+        :param extra_domain_names: A single domain name as a `str` or `bytes`, a list of domain names or ``None``.
+        :return: a non-empty list of domain names or ``None`` if there are no extra domain names.
+        '''
+        if extra_domain_names is not None and isinstance(extra_domain_names, bytes):
+            extra_domain_names = extra_domain_names.decode('utf-8')
+        if extra_domain_names is not None and isinstance(extra_domain_names, str):
+            if len(extra_domain_names) > 0:
+                extra_domain_names = [extra_domain_names]
+            else:
+                extra_domain_names = None
+        if extra_domain_names is not None and len(extra_domain_names) == 0:
+            extra_domain_names = None
+        return extra_domain_names
+
+    async def __reusableCertificates(self, provisioning_session_id: ResourceId
+                                     ) -> Tuple[List[Tuple[ResourceId, set, datetime.datetime]], set]:
+        '''Get the certificates in a provisioning session which have enough remaining validity to be reused
+
+        :meta private:
+        :param provisioning_session_id: The provisioning session to get the certificates for.
+        :return: a list of tuples of certificate id, the set of DNS subjectAltNames and expiry time, and the set of the AF's
+                 default domain names for the provisioning session.
+        '''
+        cert_ids = await self.certificateIds(provisioning_session_id)
+        if not cert_ids:
+            return [], set()
+        chc = await self.contentHostingConfigurationGet(provisioning_session_id)
+        default_names = set([dc['canonicalDomainName'] for dc in (chc or {}).get('distributionConfigurations', [])
+                             if 'canonicalDomainName' in dc])
+        min_not_after = datetime.datetime.now(datetime.timezone.utc) + self.__cert_reuse_min_validity
+        summaries = await asyncio.gather(*[self.certificateSummary(provisioning_session_id, cert_id) for cert_id in cert_ids],
+                                         return_exceptions=True)
+        candidates = []
+        for cert_id, summary in zip(cert_ids, summaries):
+            if isinstance(summary, (M1Error, ValueError)) or summary is None:
+                continue
+            if isinstance(summary, BaseException):
+                raise summary
+            if summary['notAfter'] is None or summary['notAfter'] < min_not_after:
+                continue
+            names = set([san[4:] for san in summary['subjectAltNames'] if san.startswith('DNS:')])
+            candidates += [(cert_id, names, summary['notAfter'])]
+        return candidates, default_names
+
+    @staticmethod
+    def __patchRejected(err: M1Error) -> bool:
+        '''Check if an error from a PATCH request means the AF will not accept the patch
+
+        This is a client error (e.g. 405 Method Not Allowed, 415 Unsupported Media Type or 422 Unprocessable Entity) or a
+        501 Not Implemented server response.
+
+        :meta private:
+        '''
+        return isinstance(err, M1ClientError) or err.args[1] == 501
+
+    @staticmethod
+    def __matchReusableCertificate(candidates: List[Tuple[ResourceId, set, datetime.datetime]], default_names: set,
+                                   domain_names: Optional[List[str]]) -> Optional[ResourceId]:
+        '''Choose a certificate to reuse for a set of domain names
+
+        :meta private:
+        :param candidates: The certificates available for reuse as returned by `__reusableCertificates`.
+        :param default_names: The AF's default domain names, which may also appear in the certificates.
+        :param domain_names: The extra domain names the certificate must have.
+        :return: the certificate id of the certificate with the latest expiry whose names are the *domain_names*, ignoring the
+                 *default_names*, or ``None`` if there is no such certificate in the *candidates*.
+        '''
+        wanted = set(domain_names or [])
+        matches = [(-not_after.timestamp(), cert_id) for cert_id, names, not_after in candidates
+                   if wanted <= names and names <= wanted | default_names]
+        if len(matches) == 0:
+            return None
+        return min(matches)[1]
+
+    def __batchResult(self, result: Any, failure_message: str) -> Any:
+        '''Check a result gathered from a batch operation
+
+        :meta private:
+        :param result: The result, or exception raised, from one operation in the batch.
+        :param str failure_message: The message to log if the operation failed.
+        :return: the *result* or ``None`` if the operation failed.
+        :raise BaseException: if the operation raised an exception which is not an `M1Error`.
+        '''
+        if isinstance(result, M1Error):
+            self.__log.error('%s: %s', failure_message, result)
+            return None
+        if isinstance(result, BaseException):
+            raise result
+        if result is None or result is False:
+            self.__log.error(failure_message)
+            return None
+        return result
+
     async def __pathToContentType(self, path: str) -> str:
         self.__log.debug(f'__pathToContentType({path!r})')
         type_map = {
@@ -830,7 +1274,7 @@ class M1Session:
         if provisioning_session_id not in self.__provisioning_sessions:
             return None
         await self.__cacheProvisioningSession(provisioning_session_id)
-        return self.__provisioning_sessions[provisioning_session_id]
+        return self.__provisioning_sessions.get(provisioning_session_id)
 
     async def __cacheResources(self) -> None:
         '''Cache the provisioning session resources lists
@@ -850,12 +1294,15 @@ class M1Session:
         :meta private:
         :param prov_sess: The id of provisioning session to cache.
         '''
-        ps = self.__provisioning_sessions[prov_sess]
+        ps = self.__provisioning_sessions.get(prov_sess)
         now = datetime.datetime.now(datetime.timezone.utc)
         if ps is None or ps['cache-until'] is None or ps['cache-until'] < now:
             await self.__connect()
             result = await self.__m1_client.getProvisioningSessionById(prov_sess)
-            if result is not None:
+            if result is None:
+                # The AF no longer has this provisioning session
+                await self.__forgetProvisioningSession(prov_sess)
+            else:
                 if ps is None:
                     ps = {}
                     self.__provisioning_sessions[prov_sess] = ps
@@ -878,6 +1325,17 @@ class M1Session:
                 if 'metricsReportingConfigurationIds' in ps['provisioningsession']:
                     ps['metricsReportingConfigurations'] = {k: None for k in ps['provisioningsession']['metricsReportingConfigurationIds']}
 
+    async def __forgetProvisioningSession(self, prov_sess: ResourceId) -> None:
+        '''Remove a provisioning session, which no longer exists in the AF, from the cache and the DataStore
+
+        :meta private:
+        :param prov_sess: The id of the provisioning session to forget.
+        '''
+        if self.__provisioning_sessions.pop(prov_sess, False) is not False:
+            self.__log.info('Provisioning session %s no longer exists in the AF', prov_sess)
+            if self.__data_store_dir:
+                await self.__data_store_dir.set('provisioning_sessions', list(self.__provisioning_sessions.keys()))
+
     async def __cacheProtocols(self, provisioning_session_id: ResourceId):
         '''Cache the ContentProtocols for a provisioning session
 
@@ -887,7 +1345,9 @@ class M1Session:
         :param provisioning_session_id: The id of provisioning session to cache the `ContentProtocols` for.
         '''
         await self.__cacheProvisioningSession(provisioning_session_id)
-        ps = self.__provisioning_sessions[provisioning_session_id]
+        ps = self.__provisioning_sessions.get(provisioning_session_id)
+        if ps is None:
+            return
         now = datetime.datetime.now(datetime.timezone.utc)
         if ps['protocols'] is None or ps['protocols']['cache-until'] is None or ps['protocols']['cache-until'] < now:
             await self.__connect()
@@ -906,7 +1366,9 @@ class M1Session:
         :param provisioning_session_id: The id of provisioning session to cache the public certificates for.
         '''
         await self.__cacheProvisioningSession(provisioning_session_id)
-        ps = self.__provisioning_sessions[provisioning_session_id]
+        ps = self.__provisioning_sessions.get(provisioning_session_id)
+        if ps is None:
+            return
         now = datetime.datetime.now(datetime.timezone.utc)
         if ps['certificates'] is None:
             return
@@ -937,7 +1399,9 @@ class M1Session:
         :param provisioning_session_id: The id of provisioning session to cache the `ContentHostingConfiguration` for.
         '''
         await self.__cacheProvisioningSession(provisioning_session_id)
-        ps = self.__provisioning_sessions[provisioning_session_id]
+        ps = self.__provisioning_sessions.get(provisioning_session_id)
+        if ps is None:
+            return
         now = datetime.datetime.now(datetime.timezone.utc)
         chc = ps['content-hosting-configuration']
         if chc is None or chc['cache-until'] is None or chc['cache-until'] < now:
@@ -960,7 +1424,9 @@ class M1Session:
         :param provisioning_session_id: The id of provisioning session to cache the `ConsumptionReportingConfiguration` for.
         '''
         await self.__cacheProvisioningSession(provisioning_session_id)
-        ps = self.__provisioning_sessions[provisioning_session_id]
+        ps = self.__provisioning_sessions.get(provisioning_session_id)
+        if ps is None:
+            return
         now = datetime.datetime.now(datetime.timezone.utc)
         crc = ps['consumption-reporting-configuration']
         if crc is None or crc['cache-until'] is None or crc['cache-until'] < now:
@@ -984,7 +1450,9 @@ class M1Session:
         :param provisioning_session_id: The id of provisioning session to cache the metrics reporting configurations for.
         '''
         await self.__cacheProvisioningSession(provisioning_session_id)
-        ps = self.__provisioning_sessions[provisioning_session_id]
+        ps = self.__provisioning_sessions.get(provisioning_session_id)
+        if ps is None:
+            return
         now = datetime.datetime.now(datetime.timezone.utc)
         
         ret_err = None
@@ -1013,7 +1481,9 @@ class M1Session:
         :param provisioning_session_id: The id of provisioning session to cache the policy templates for.
         '''
         await self.__cacheProvisioningSession(provisioning_session_id)
-        ps = self.__provisioning_sessions[provisioning_session_id]
+        ps = self.__provisioning_sessions.get(provisioning_session_id)
+        if ps is None:
+            return
         now = datetime.datetime.now(datetime.timezone.utc)
         if ps is None or 'policyTemplates' not in ps or ps['policyTemplates'] is None:
             return
@@ -1034,6 +1504,20 @@ class M1Session:
         if ret_err is not None:
             raise ret_err
 
+    @staticmethod
+    async def __bounded(limit: Optional[asyncio.Semaphore], coro: Awaitable[Any]) -> Any:
+        '''Await a coroutine while holding a semaphore
+
+        :meta private:
+        :param limit: The semaphore to hold, or ``None`` to await *coro* without a limit.
+        :param coro: The coroutine to await.
+        :return: the result of *coro*.
+        '''
+        if limit is None:
+            return await coro
+        async with limit:
+            return await coro
+
     async def __getCertificateSigner(self) -> CertificateSigner:
         '''Get the `CertificateSigner`
 
@@ -1043,26 +1527,25 @@ class M1Session:
         :return: a `CertificateSigner`
         :raise RuntimeError: if the certificate signer requested is not derived from `CertificateSigner`.
         '''
+        if self.__cert_signer is not None:
+            return self.__cert_signer
+        # Build from the configured spec each time so that a failed attempt is retried with the same class and arguments
+        cert_signer = self.__cert_signer_spec
         signer_args = {}
-        if self.__cert_signer is None:
-            self.__cert_signer = 'rt_m1_client.certificates.DefaultCertificateSigner'
-        if isinstance(self.__cert_signer, str):
-            if '(' in self.__cert_signer:
-                self.__cert_signer, args_str = self.__cert_signer.split('(',1)
-                args_str = args_str[:-1]
-                signer_args = dict([tuple([p.strip() for p in kv.split('=')]) for kv in args_str.split(',')])
-            cert_sign_cls_mod, cert_sign_cls_name = self.__cert_signer.rsplit('.', 1)
-            cert_sign_cls_mod = importlib.import_module(cert_sign_cls_mod)
-            self.__cert_signer = getattr(cert_sign_cls_mod, cert_sign_cls_name)
+        if cert_signer is None:
+            cert_signer = 'rt_m1_client.certificates.DefaultCertificateSigner'
+        if isinstance(cert_signer, str):
+            cert_signer, signer_args = load_class_spec(cert_signer)
         try:
-            if inspect.isclass(self.__cert_signer) and issubclass(self.__cert_signer, CertificateSigner):
-                self.__cert_signer = await self.__cert_signer(data_store=self.__data_store_dir, **signer_args)
+            if inspect.isclass(cert_signer) and issubclass(cert_signer, CertificateSigner):
+                cert_signer = await cert_signer(data_store=self.__data_store_dir, **signer_args)
         except TypeError:
             pass
-        if inspect.iscoroutinefunction(self.__cert_signer):
-            self.__cert_signer = await self.__cert_signer(data_store=self.__data_store_dir, **signer_args)
-        if not isinstance(self.__cert_signer, CertificateSigner):
+        if inspect.iscoroutinefunction(cert_signer):
+            cert_signer = await cert_signer(data_store=self.__data_store_dir, **signer_args)
+        if not isinstance(cert_signer, CertificateSigner):
             raise RuntimeError('The certificate signer class given is not derived from CertificateSigner')
+        self.__cert_signer = cert_signer
         return self.__cert_signer
 
     async def __connect(self) -> None:
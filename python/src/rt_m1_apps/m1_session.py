@@ -54,7 +54,7 @@ Syntax:
     m1-session-cli del-certificate -h
     m1-session-cli del-certificate -p <provisioning-session-id> -c <certificate-id>
     m1-session-cli check-certificates-renewal -h
-    m1-session-cli check-certificates-renewal
+    m1-session-cli check-certificates-renewal [-w <days>] [-d [-i <seconds>]]
     m1-session-cli renew-certificates -h
     m1-session-cli renew-certificates -p <provisioning-session-id>
     m1-session-cli renew-certificates <ingest-URL> [<entry-point-suffix-URL>]
@@ -169,7 +169,6 @@ from typing import Tuple, List, Optional
 #logging.basicConfig(level=logging.DEBUG)
 
 import json
-import OpenSSL
 
 installed_packages_dir = '@python_packages_dir@'
 if os.path.isdir(installed_packages_dir) and installed_packages_dir not in sys.path:
@@ -177,9 +176,11 @@ if os.path.isdir(installed_packages_dir) and installed_packages_dir not in sys.p
 
 from rt_m1_client.session import M1Session
 from rt_m1_client.exceptions import M1Error
-from rt_m1_client.data_store import JSONFileDataStore
+from rt_m1_client.data_store import create_data_store
 from rt_m1_client.types import ContentHostingConfiguration, ConsumptionReportingConfiguration, PolicyTemplate, BitRate, SponsoringStatus, MetricsReportingConfiguration
 from rt_m1_client.configuration import Configuration
+from rt_m1_client.renewal import CertificateRenewer
+from rt_m1_client.certificates import CertificateSummary
 
 async def cmd_configure_show(args: argparse.Namespace, config: Configuration) -> int:
     '''Perform ``configure show`` operation
@@ -216,61 +217,23 @@ async def cmd_configure_set(args: argparse.Namespace, config: Configuration) ->
     config.set(args.key, args.value)
     return 0
 
-def __formatX509Name(x509name: OpenSSL.crypto.X509Name) -> str:
-    '''Format an X509Name as a comma separated DN string
+async def __prettyPrintCertificate(summary: CertificateSummary, indent: int = 0) -> None:
+    '''Print certificate information from a certificate summary
 
-    :meta private:
-    :param OpenSSL.crypto.X509Name x509name: The X509 name to convert to a string.
-    :return: a ``str`` version of the X509 Name as comma separated DN fields.
-    :rtype: str
-    '''
-    ret = ",".join([f"{name.decode('utf-8')}={value.decode('utf-8')}" for name,value in x509name.get_components()])
-    return ret
-
-async def __prettyPrintCertificate(cert: str, indent: int = 0) -> None:
-    '''Print certificate information from X509 PEM data
-
-    :param str cert: X509 certificate encoded as PEM data
+    :param CertificateSummary summary: The summary of the X509 certificate, see `M1Session.certificateSummary`.
     :param int indent: The indent to use in the certificate output
     '''
-    try:
-        x509 = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, cert)
-    except OpenSSL.crypto.Error as err:
-        print(f'{" "*indent} Certificate not understood as PEM data: {err}')
-        return
-    serial = x509.get_serial_number()
-    subject = x509.get_subject()
-    issuer = x509.get_issuer()
-    start_str = x509.get_notBefore()
-    if isinstance(start_str, bytes):
-        start_str = start_str.decode('utf-8')
-    start = datetime.datetime.strptime(start_str, '%Y%m%d%H%M%SZ').replace(tzinfo=datetime.timezone.utc)
-    end_str = x509.get_notAfter()
-    if isinstance(end_str, bytes):
-        end_str = end_str.decode('utf-8')
-    end = datetime.datetime.strptime(end_str, '%Y%m%d%H%M%SZ').replace(tzinfo=datetime.timezone.utc)
-    subject_key = None
-    issuer_key = None
-    sans = []
-    for ext_num in range(x509.get_extension_count()):
-        ext = x509.get_extension(ext_num)
-        ext_name = ext.get_short_name().decode('utf-8')
-        if ext_name == "subjectKeyIdentifier":
-            subject_key = str(ext)
-        elif ext_name == "authorityKeyIdentifier":
-            issuer_key = str(ext)
-        elif ext_name == "subjectAltName":
-            sans += [s.strip() for s in str(ext).split(',')]
     cert_info_prefix=' '*indent
-    cert_desc=f'{cert_info_prefix}Serial = {serial}\n{cert_info_prefix}Not before = {start}\n{cert_info_prefix}Not after = {end}\n{cert_info_prefix}Subject = {__formatX509Name(subject)}\n'
-    if subject_key is not None:
-        cert_desc += f'{cert_info_prefix}          key={subject_key}\n'
-    cert_desc += f'{cert_info_prefix}Issuer = {__formatX509Name(issuer)}'
-    if issuer_key is not None:
-        cert_desc += f'\n{cert_info_prefix}         key={issuer_key}'
-    if len(sans) > 0:
+    cert_desc=f'{cert_info_prefix}Serial = {summary["serialNumber"]}\n{cert_info_prefix}Not before = {summary["notBefore"]}\n{cert_info_prefix}Not after = {summary["notAfter"]}\n{cert_info_prefix}Subject = {summary["subject"]}\n'
+    if summary['subjectKeyIdentifier'] is not None:
+        cert_desc += f'{cert_info_prefix}          key={summary["subjectKeyIdentifier"]}\n'
+    cert_desc += f'{cert_info_prefix}Issuer = {summary["issuer"]}'
+    if summary['authorityKeyIdentifier'] is not None:
+        cert_desc += f'\n{cert_info_prefix}         key={summary["authorityKeyIdentifier"]}'
+    cert_desc += f'\n{cert_info_prefix}Public key = {summary["keyType"]} ({summary["keyBits"]} bits)'
+    if len(summary['subjectAltNames']) > 0:
         cert_desc += f'\n{cert_info_prefix}Subject Alternative Names:'
-        cert_desc += ''.join([f'\n{cert_info_prefix}  {san}' for san in sans])
+        cert_desc += ''.join([f'\n{cert_info_prefix}  {san}' for san in summary['subjectAltNames']])
     print(f'{cert_desc}')
 
 async def cmd_list_verbose(args: argparse.Namespace, config: Configuration) -> int:
@@ -286,13 +249,15 @@ async def cmd_list_verbose(args: argparse.Namespace, config: Configuration) -> i
         for cert_id in certs:
             print(f'    {cert_id}:')
             try:
-                cert = await session.certificateGet(ps_id, cert_id)
-                if cert is not None:
-                    await __prettyPrintCertificate(cert, indent=6)
+                summary = await session.certificateSummary(ps_id, cert_id)
+                if summary is not None:
+                    await __prettyPrintCertificate(summary, indent=6)
                 else:
                     print('      Certificate not yet uploaded')
             except M1Error as err:
                 print(f'      Certificate not available: {str(err)}')
+            except ValueError as err:
+                print(f'       {err}')
         chc = await session.contentHostingConfigurationGet(ps_id)
         print('  ContentHostingConfiguration:')
         if chc is not None:
@@ -486,7 +451,7 @@ async def cmd_new_certificate(args: argparse.Namespace, config: Configuration) -
         print(f'certificate_id={cert_id}')
         print(csr)
         return 0
-    cert_id = await session.createNewCertificate(args.provisioning_session, extra_domain_names=args.domain_name_alias)
+    cert_id = await session.createNewCertificate(args.provisioning_session, extra_domain_names=args.domain_name_alias, reuse=False)
     if cert_id is None:
         print('Failed to create certificate')
         return 1
@@ -507,7 +472,11 @@ async def cmd_show_certificate(args: argparse.Namespace, config: Configuration)
         print(result)
     else:
         print(f'Certificate details for {args.certificate_id}:')
-        await __prettyPrintCertificate(result, indent=2)
+        try:
+            await __prettyPrintCertificate(await session.certificateSummary(args.provisioning_session, args.certificate_id),
+                                           indent=2)
+        except ValueError as err:
+            print(f'   {err}')
     return 0
 
 async def cmd_set_certificate(args: argparse.Namespace, config: Configuration) -> int:
@@ -536,39 +505,53 @@ async def cmd_set_certificate(args: argparse.Namespace, config: Configuration) -
     return 0
 
 async def cmd_check_all_renewal(args: argparse.Namespace, config: Configuration) -> int:
-    '''Perform ``check-all-renewal`` operation
+    '''Perform ``check-certificates-renewal`` operation
+
+    This will renew all certificates, in use by ContentHostingConfigurations, which expire within the renewal window.
 
-    **TODO**
+    With ``--daemon`` this will keep running, checking for certificates due for renewal as they approach expiry.
     '''
     session = await get_session(config)
-    for ps_id in await session.provisioningSessionIds():
-        chc = await session.getContentHostingConfiguration(ps_id)
-        # extract current cert ids
-        # get public cert for each cert id
-        #   check for soon or past expiry
-        #     request a new certificate
-        #     change id in chc and remember old cert ids
-        # if any cert ids changed in chc upload replacement chc
-        # delete old certs
-    sys.stderr.write('check-all-renewal not yet implemented\n')
-    return 1
+    renewer = CertificateRenewer(session, renewal_window=datetime.timedelta(days=args.window))
+    if args.daemon:
+        await renewer.run(rescan_interval=args.interval)
+        return 0
+    await renewer.scan()
+    renewed = await renewer.renewDue()
+    for ps_id, cert_ids in renewed.items():
+        for old_cert_id, new_cert_id in cert_ids.items():
+            print(f'Provisioning Session {ps_id}: certificate {old_cert_id} renewed as {new_cert_id}')
+    due = renewer.dueCertificates()
+    if len(due) > 0:
+        for ps_id, cert_id, not_after in due:
+            print(f'Provisioning Session {ps_id}: failed to renew certificate {cert_id} (expires {not_after.isoformat()})')
+        return 1
+    if len(renewed) == 0:
+        print('No certificates due for renewal')
+    return 0
 
 async def cmd_renew_certs(args: argparse.Namespace, config: Configuration) -> int:
-    '''Perform ``renew-certs`` operation
+    '''Perform ``renew-certificates`` operation
 
-    **TODO**
+    This will renew all certificates in use by the ContentHostingConfiguration of a provisioning session, regardless of
+    their expiry time.
     '''
     session = await get_session(config)
-    ps_id = args.provisioning_session
-    chc = await session.getContentHostingConfiguration(ps_id)
-    # get list of unique cert ids in chc
-    # for each cert id in list
-    #   request a new certificate
-    #   change ids in chc for new cert id
-    # upload replacement chc
-    # delete old certs
-    sys.stderr.write('renew-certs not yet implemented\n')
-    return 1
+    if args.provisioning_session is not None:
+        ps_id = args.provisioning_session
+    else:
+        ps_id = await session.provisioningSessionIdByIngestUrl(args.ingesturl, args.entrypoint)
+        if ps_id is None:
+            print('No such hosting session found')
+            return 1
+    renewer = CertificateRenewer(session)
+    renewed = await renewer.renew(ps_id)
+    if len(renewed) == 0:
+        print(f'No certificates renewed for Provisioning Session {ps_id}')
+        return 1
+    for old_cert_id, new_cert_id in renewed.items():
+        print(f'Certificate {old_cert_id} renewed as {new_cert_id}')
+    return 0
 
 async def cmd_set_consumption(args: argparse.Namespace, config: Configuration) -> int:
     '''Activate or set consumption reporting parameters on a provisioning session
@@ -1061,20 +1044,26 @@ async def parse_args() -> Tuple[argparse.Namespace,Configuration]:
     parser_set_certificate.add_argument('certificate-PEM-file', nargs='?',
                                         help='PEM file to load the public certificate from, if omitted will use stdin instead')
 
-    # m1-session-cli check-certificate-renewal
-    #parser_checkrenewal = subparsers.add_parser('check-certificate-renewal', help='Renew all certificates if close to expiry')
-    #parser_checkrenewal.set_defaults(command=cmd_check_all_renewal)
-
-    # m1-session-cli renew-certificate -p <provisioning-session-id>
-    # m1-session-cli renew-certificate <ingest-URL> [<entry-point-path>]
-    #parser_renewcert = subparsers.add_parser('renew-certificate', help='Force renewal of a specific certificate')
-    #parser_renewcert.set_defaults(command=cmd_renew_certs)
-    #parser_renewcert_filter = parser_renewcert.add_mutually_exclusive_group(required=True)
-    #parser_renewcert_filter.add_argument('-p', '--provisioning-session', help='Renew by provisioning session id')
-    #parser_renewcert_filter.add_argument('ingesturl', metavar='ingest-URL', nargs='?', help='The ingest URL prefix to use')
+    # m1-session-cli check-certificates-renewal [-w <days>] [--daemon [-i <seconds>]]
+    parser_checkrenewal = subparsers.add_parser('check-certificates-renewal', help='Renew all certificates if close to expiry')
+    parser_checkrenewal.set_defaults(command=cmd_check_all_renewal)
+    parser_checkrenewal.add_argument('-w', '--window', type=float, default=14.0, metavar='DAYS',
+                                     help='Renew certificates which expire within this many days (default: 14)')
+    parser_checkrenewal.add_argument('-d', '--daemon', action='store_true',
+                                     help='Keep running and renew certificates as they become due')
+    parser_checkrenewal.add_argument('-i', '--interval', type=float, default=3600.0, metavar='SECONDS',
+                                     help='In daemon mode, the maximum time between checks for new certificates (default: 3600)')
+
+    # m1-session-cli renew-certificates -p <provisioning-session-id>
+    # m1-session-cli renew-certificates <ingest-URL> [<entry-point-path>]
+    parser_renewcert = subparsers.add_parser('renew-certificates', help='Force renewal of the certificates for a provisioning session')
+    parser_renewcert.set_defaults(command=cmd_renew_certs)
+    parser_renewcert_filter = parser_renewcert.add_mutually_exclusive_group(required=True)
+    parser_renewcert_filter.add_argument('-p', '--provisioning-session', help='Renew by provisioning session id')
+    parser_renewcert_filter.add_argument('ingesturl', metavar='ingest-URL', nargs='?', help='The ingest URL prefix to use')
     # The entry-point-path should go with ingest-URL, but argparser lacks the ability to do subgroups
-    #parser_renewcert.add_argument('entrypoint', metavar='entry-point-path', nargs='?', help='The media player entry point suffix.')
-  
+    parser_renewcert.add_argument('entrypoint', metavar='entry-point-path', nargs='?', help='The media player entry point suffix.')
+
     # m1-session-cli new-metrics-reporting -p <provisioning-session-id> -s <scheme> -d <data-network-name>
     #                                 [-i <interval-in-seconds>] [-P <sample-percentage>]
     #                                 [-f <url-filter> ...] -S <sampling-period-in-seconds>
@@ -1267,12 +1256,9 @@ async def get_session(config: Configuration) -> M1Session:
     '''
     global _m1_session
     if _m1_session is None:
-        data_store_dir = config.get('data_store')
-        if data_store_dir is not None:
-            data_store = await JSONFileDataStore(config.get('data_store'))
-        else:
-            data_store = None
-        _m1_session = await M1Session((config.get('m1_address', 'localhost'), config.get('m1_port',7777)), data_store, config.get('certificate_signing_class'))
+        data_store = await create_data_store(config.get('data_store_class'), config.get('data_store'))
+        _m1_session = await M1Session((config.get('m1_address', 'localhost'), config.get('m1_port',7777)), data_store, config.get('certificate_signing_class'),
+                                      config.get('certificate_reuse_min_days'))
     return _m1_session
 
 async def main():
@@ -1315,6 +1301,9 @@ async def main():
         if args.debug:
             traceback.print_exc()
         return 2
+    finally:
+        if _m1_session is not None:
+            await _m1_session.aclose()
     return 0
 
 def app():
@@ -40,6 +40,49 @@ This tool is designed to be run immediately after the AF is started in order to
 
 The streams to configure are found in the /etc/rt-5gms/streams.json file.
 
+Syntax:
+    msaf-configuration [--plan [{diff,json}]] [--full] [--watch [--debounce SECS] [--poll-interval SECS]
+                       [--verify-interval SECS]]
+
+A stream whose name, ingestURL or distributionConfigurations have changed is
+matched with the Provisioning Session it was previously configured in, by the
+record of the last sync or else by its name or ingestURL, and its
+ContentHostingConfiguration is updated in place using a JSON Patch. Only
+Provisioning Sessions which cannot be matched to any stream are removed.
+
+With the ``--plan`` option the tool will read the current state of the AF and
+show the Provisioning Sessions, certificates, ContentHostingConfigurations,
+ConsumptionReportingConfigurations, MetricsReportingConfigurations and
+PolicyTemplates that would be created, updated or deleted, without changing the
+AF or publishing any M8 data. The plan is shown as a diff by default, or as JSON
+with ``--plan json``.
+
+When a data store is configured (see `m1-session configure`) the desired state
+of each stream, along with the entity tags of its Provisioning Session and
+ContentHostingConfiguration in the AF, is recorded after each sync. The next
+run will only reconcile streams whose configuration has changed in the
+streams.json file, or whose Provisioning Session has been changed in the AF,
+since they were recorded. Streams for which any change failed are not recorded
+as synchronised and are reconciled again on the next run. Use ``--full`` to
+reconcile every stream.
+
+The streams.json file is read incrementally, one stream at a time, and only the
+definitions of streams which need reconciling are kept in memory. On the first
+run, with no record of a previous sync, or with ``--full``, every stream needs
+reconciling, so every stream definition is still held in memory while the plan
+is made. The plan cannot be made in smaller batches because a Provisioning
+Session can only be removed once no stream at all is found to match it. Each stream
+definition and *vodMedia* entry is checked as it is read. Invalid entries are
+reported and skipped, and the Provisioning Session of an invalid stream is left
+as it was by the last sync until the stream definition is fixed.
+
+With ``--watch`` the tool will keep running after the first sync, holding its
+connection to the AF, and watch the streams.json and af-sync.conf files for
+changes, using inotify where available or polling every ``--poll-interval``
+seconds otherwise. Once a burst of edits has been quiet for ``--debounce``
+seconds the changed streams are synchronised. In between edits the AF is only
+checked for changes made by other tools every ``--verify-interval`` seconds.
+
 **af-sync.conf file**
 
 This file defines configuration values specifically for this AF configuration
@@ -50,6 +93,10 @@ sync tool, and can be found at `/etc/rt-5gms/af-sync.conf`.
 m5_authority = af.example.com:1234
 docroot = /var/cache/rt-5gms/as/docroots
 default_docroot = /usr/share/nginx/html
+concurrency = 8
+workers = 1
+m8_precompress = gzip br
+certificate_reuse_min_days = 14
 ```
 
 The *m5_authority* is a URL authority describing the location of the M5
@@ -62,6 +109,29 @@ placed at `{docroot}/{domain_name}/m8.json`.
 The *default_docroot* is for the directory path to the root directory for the
 fallback AS listening point. This will normally be `/usr/share/nginx/html`.
 
+The *concurrency* is the maximum number of streams which will be provisioned in
+the AF at the same time. Independent streams are configured in parallel, up to
+this limit, so that onboarding many streams is not bound by the round-trip time
+to the AF.
+
+The *workers* is the number of processes to use when comparing the streams
+with the state of the AF to work out the changes to make, or 0 to use one
+process per CPU core. When there are enough streams to make it worthwhile the
+streams are shared between the processes by a hash of the stream identifier.
+All communication with the AF still takes place in the main process.
+
+The *m8_precompress* is an optional space separated list of precompressed
+copies of the M8 JSON file to publish alongside `m8.json`: `gzip` for
+`m8.json.gz` and `br` for `m8.json.br`, which needs the `brotli` module. The
+M8 files are only rewritten when their contents change and are replaced
+atomically.
+
+The *certificate_reuse_min_days* is how many days an existing certificate in a
+Provisioning Session must remain valid for it to be reused when a stream needs a
+certificate with the same domain names, or empty to always create new
+certificates. A *certificate_reuse_min_days* set in the m1-client configuration
+(see `m1-session configure`) takes precedence.
+
 **streams.json format**
 
 This file defines the streams to configure and is located at
@@ -215,14 +285,32 @@ fields defined so that it acts as a top level ingest point for multiple media.
 '''
 
 import aiofiles
+import argparse
 import asyncio
+import concurrent.futures
 import configparser
+import copy
+import ctypes
+import ctypes.util
+import gzip
+import hashlib
 import importlib
 import json
 import logging
+import multiprocessing
 import os.path
+import signal
+import stat
+import struct
 import sys
-from typing import List, Optional
+import tempfile
+import zlib
+from typing import Any, AsyncIterator, Awaitable, Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 installed_packages_dir = '@python_packages_dir@'
 if os.path.isdir(installed_packages_dir) and installed_packages_dir not in sys.path:
@@ -230,12 +318,19 @@ if os.path.isdir(installed_packages_dir) and installed_packages_dir not in sys.p
 
 from rt_m1_client.session import M1Session
 from rt_m1_client.exceptions import M1Error
-from rt_m1_client.data_store import JSONFileDataStore
-from rt_m1_client.types import ContentHostingConfiguration, DistributionConfiguration, IngestConfiguration, M1MediaEntryPoint, PathRewriteRule, ConsumptionReportingConfiguration, PolicyTemplate, M1QoSSpecification, ChargingSpecification, AppSessionContext, Snssai, MetricsReportingConfiguration
+from rt_m1_client.data_store import DataStore, create_data_store
+from rt_m1_client.types import ResourceId, ContentHostingConfiguration, DistributionConfiguration, IngestConfiguration, M1MediaEntryPoint, PathRewriteRule, ConsumptionReportingConfiguration, PolicyTemplate, M1QoSSpecification, ChargingSpecification, AppSessionContext, Snssai, MetricsReportingConfiguration
 from rt_m1_client.configuration import Configuration
+from rt_m1_client.json_patch import make_json_patch
+from rt_m1_client.json_stream import JSONMemberParser, JSONPath
 
 g_streams_config = os.path.join(os.path.sep, 'etc', 'rt-5gms', 'streams.json')
 g_sync_config = os.path.join(os.path.sep, 'etc', 'rt-5gms', 'af-sync.conf')
+g_journal_key = 'af-sync-journal'
+g_read_size = 65536
+g_plan_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+g_plan_pool_workers = 0
+g_shard_min_streams = 64
 
 logging.basicConfig(level=logging.INFO)
 g_log = logging.getLogger(__name__)
@@ -256,69 +351,91 @@ def log_error(*args, **kwargs):
     global g_log
     g_log.error(*args, **kwargs)
 
+def path_rewrite_rule_key(prr: PathRewriteRule) -> Tuple[str, str]:
+    '''Get the canonical form of a PathRewriteRule
+
+    :param prr: The PathRewriteRule to normalise.
+    :return: a hashable key which is equal for equivalent PathRewriteRules.
+    '''
+    return (prr.get('requestPathPattern'), prr.get('mappedPath'))
+
+def path_rewrite_rules_key(prrs: List[PathRewriteRule]) -> Tuple[Tuple[str, str], ...]:
+    '''Get the canonical form of a list of PathRewriteRules
+
+    The order of the rules is not significant for the comparison.
+
+    :param prrs: The list of PathRewriteRules to normalise.
+    :return: a hashable key which is equal for equivalent lists of PathRewriteRules.
+    '''
+    return tuple(sorted(path_rewrite_rule_key(prr) for prr in prrs))
+
+def entry_point_key(ep: M1MediaEntryPoint) -> Tuple[str, str, Optional[Tuple[str, ...]]]:
+    '''Get the canonical form of an M1MediaEntryPoint
+
+    :param ep: The M1MediaEntryPoint to normalise.
+    :return: a hashable key which is equal for equivalent entry points.
+    '''
+    profiles = ep.get('profiles')
+    if profiles is not None:
+        profiles = tuple(sorted(set(profiles)))
+    return (ep.get('relativePath'), ep.get('contentType'), profiles)
+
+def distrib_config_key(dc: DistributionConfiguration) -> str:
+    '''Get the canonical form of a DistributionConfiguration
+
+    Fields generated by the AF (canonicalDomainName and baseURL) are ignored. The values of the certificateId,
+    cachingConfigurations, geoFencing, urlSignature and supplementaryDistributionNetworks fields are ignored, only their
+    presence is significant.
+
+    :param dc: The DistributionConfiguration to normalise.
+    :return: a hashable key which is equal for equivalent DistributionConfigurations.
+    '''
+    norm = {k: True for k in dc.keys() if k not in ['canonicalDomainName', 'baseURL']}
+    if 'entryPoint' in dc:
+        norm['entryPoint'] = entry_point_key(dc['entryPoint'])
+    for field in ['contentPreparationTemplateId', 'domainNameAlias']:
+        if field in dc:
+            norm[field] = dc[field]
+    if 'pathRewriteRules' in dc:
+        norm['pathRewriteRules'] = path_rewrite_rules_key(dc['pathRewriteRules'])
+    return json.dumps(norm, sort_keys=True)
+
+def distrib_configs_key(dcs: List[DistributionConfiguration]) -> Tuple[str, ...]:
+    '''Get the canonical form of a list of DistributionConfigurations
+
+    The order of the DistributionConfigurations is not significant for the comparison.
+
+    :param dcs: The list of DistributionConfigurations to normalise.
+    :return: a hashable key which is equal for equivalent lists of DistributionConfigurations.
+    '''
+    return tuple(sorted(distrib_config_key(dc) for dc in dcs))
+
+def stream_fingerprint(name: str, ingest_url: str, dcs: List[DistributionConfiguration]) -> Tuple[str, str, Tuple[str, ...]]:
+    '''Get the fingerprint of the desired state of a stream
+
+    Two streams with the same fingerprint will produce equivalent ContentHostingConfigurations.
+
+    :param name: The stream name.
+    :param ingest_url: The ingest base URL for the stream.
+    :param dcs: The DistributionConfigurations for the stream.
+    :return: a hashable fingerprint for the stream.
+    '''
+    return (name, ingest_url, distrib_configs_key(dcs))
+
 async def path_rewrite_rule_equal(a: PathRewriteRule, b: PathRewriteRule) -> bool:
-    if a['requestPathPattern'] != b['requestPathPattern']:
-        return False
-    if a['mappedPath'] != b['mappedPath']:
-        return False
-    return True
+    return path_rewrite_rule_key(a) == path_rewrite_rule_key(b)
 
 async def path_rewrite_rules_equal(a: List[PathRewriteRule], b: List[PathRewriteRule]) -> bool:
-    if len(a) != len(b):
-        return False
-    for prr_a in a:
-        for prr_b in b:
-            if await path_rewrite_rule_equal(prr_a, prr_b):
-                break
-        else:
-            return False
-    return True
+    return path_rewrite_rules_key(a) == path_rewrite_rules_key(b)
 
 async def entry_points_equal(a: M1MediaEntryPoint, b: M1MediaEntryPoint) -> bool:
-    if a['relativePath'] != b['relativePath']:
-        return False
-    if a['contentType'] != b['contentType']:
-        return False
-    if 'profiles' not in a and 'profiles' not in b:
-        return True
-    if 'profiles' in a and 'profiles' in b and set(a['profiles']) == set(b['profiles']):
-        return True
-    return False
+    return entry_point_key(a) == entry_point_key(b)
 
 async def distrib_config_equal(a: DistributionConfiguration, b: DistributionConfiguration) -> bool:
-    a_keys = set(a.keys())
-    b_keys = set(b.keys())
-    # Ignore fields generated by the AF
-    for gen_field in ['canonicalDomainName', 'baseURL']:
-        a_keys.discard(gen_field)
-        b_keys.discard(gen_field)
-    # Distribution configuration must have the same fields present
-    if a_keys != b_keys:
-        return False
-
-    if 'entryPoint' in a and not await entry_points_equal(a['entryPoint'], b['entryPoint']):
-        return False
-    if 'contentPreparationTemplateId' in a and a['contentPreparationTemplateId'] != b['contentPreparationTemplateId']:
-        return False
-    if 'domainNameAlias' in a and a['domainNameAlias'] != b['domainNameAlias']:
-        return False
-    if 'pathRewriteRules' in a and not await path_rewrite_rules_equal(a['pathRewriteRules'], b['pathRewriteRules']):
-        return False
-
-    # Ignore: cachingConfigurations, geoFencing, urlSignature, supplementaryDistributionNetworks
-
-    return True
+    return distrib_config_key(a) == distrib_config_key(b)
 
 async def distrib_configs_equal(a: List[DistributionConfiguration], b: List[DistributionConfiguration]) -> bool:
-    if len(a) != len(b):
-        return False
-    for dc_a in a:
-        for dc_b in b:
-            if await distrib_config_equal(dc_a, dc_b):
-                break
-        else:
-            return False
-    return True
+    return distrib_configs_key(a) == distrib_configs_key(b)
 
 async def _flagsEqual(a: Optional[bool], b: Optional[bool]) -> bool:
     if a is None and b is None:
@@ -450,197 +567,786 @@ async def policies_match(p1: Optional[PolicyTemplate], p2: Optional[PolicyTempla
         return False
     return True
 
-async def sync_configuration(m1: M1Session, streams: dict) -> dict:
-    have = {}
-    to_check = streams['streams']
-    del_ps_id = []
-    stream_map = {}
-    for ps_id in await m1.provisioningSessionIds():
-        chc = await m1.contentHostingConfigurationGet(ps_id)
+async def _bounded_gather(limit: asyncio.Semaphore, coros: Iterable[Awaitable[Any]]) -> List[Any]:
+    '''Await a collection of coroutines concurrently, with at most *limit* running at once
+
+    :param limit: The semaphore bounding the number of coroutines running at once.
+    :param coros: The coroutines to run.
+    :return: the list of results in the same order as *coros*.
+    '''
+    async def run(coro: Awaitable[Any]) -> Any:
+        async with limit:
+            return await coro
+    return await asyncio.gather(*[run(coro) for coro in coros])
+
+def _policy_templates(cfg_id: str, policies) -> List[PolicyTemplate]:
+    '''Get the configured policies for a stream as a list of PolicyTemplates
+
+    :param cfg_id: The stream identifier, for logging.
+    :param policies: The policies from the stream configuration.
+    :return: the list of PolicyTemplates, empty if there are no valid policies configured.
+    '''
+    if policies is None:
+        return []
+    if isinstance(policies,dict):
+        pol_list = policies.items()
+    elif isinstance(policies,list):
+        pol_list = [(p.get('externalReference', None), p) for p in policies]
+    else:
+        log_error(f'Configured policies for provisioning session "{cfg_id}" should be an object or array')
+        return []
+    result = []
+    for ext_id, pol in pol_list:
+        pt = dict()
+        if ext_id is not None:
+            pt.update({'externalReference': ext_id})
+        pt.update(pol)
+        result += [pt]
+    return result
+
+async def _snapshot_provisioning_session(m1: M1Session, ps_id: ResourceId) -> dict:
+    chc, crc, mrc_ids, pol_ids = await asyncio.gather(
+            m1.contentHostingConfigurationGet(ps_id),
+            m1.consumptionReportingConfigurationGet(ps_id),
+            m1.metricsReportingConfigurationIds(ps_id),
+            m1.policyTemplateIds(ps_id),
+            )
+    mrc_ids = mrc_ids or []
+    pol_ids = pol_ids or []
+    mrcs, pols = await asyncio.gather(
+            asyncio.gather(*[m1.metricsReportingConfigurationGet(ps_id, mrc_id) for mrc_id in mrc_ids]),
+            asyncio.gather(*[m1.policyTemplateGet(ps_id, pol_id) for pol_id in pol_ids]),
+            )
+    return {'contentHostingConfiguration': chc,
+            'consumptionReportingConfiguration': crc,
+            'metricsReportingConfigurations': dict(zip(mrc_ids, mrcs)),
+            'policyTemplates': dict(zip(pol_ids, pols)),
+            }
+
+async def snapshot_af_state(m1: M1Session, concurrency: int = 8, exclude: Optional[Iterable[ResourceId]] = None
+                            ) -> Dict[ResourceId, dict]:
+    '''Fetch the state of all Provisioning Sessions in the AF
+
+    The Provisioning Sessions are fetched concurrently, with at most *concurrency* Provisioning Sessions being fetched at once.
+
+    :param m1: The M1Session to use to communicate with the AF.
+    :param concurrency: The maximum number of Provisioning Sessions to fetch at once.
+    :param exclude: Provisioning Session identifiers to leave out of the snapshot.
+    :return: a map of Provisioning Session identifier to the ContentHostingConfiguration, ConsumptionReportingConfiguration,
+             MetricsReportingConfigurations and PolicyTemplates for that Provisioning Session.
+    '''
+    limit = asyncio.Semaphore(max(1, concurrency))
+    exclude = set(exclude or [])
+    ps_ids = [ps_id for ps_id in (await m1.provisioningSessionIds() or []) if ps_id not in exclude]
+    states = await _bounded_gather(limit, [_snapshot_provisioning_session(m1, ps_id) for ps_id in ps_ids])
+    return dict(zip(ps_ids, states))
+
+def _desired_chc(cfg: dict) -> ContentHostingConfiguration:
+    '''Get the ContentHostingConfiguration for a stream configuration
+
+    The certificateId fields will be the placeholders from the stream configuration.
+    '''
+    return { 'name': cfg['name'],
+             'ingestConfiguration': {
+                 'baseURL': cfg['ingestURL'],
+                 'pull': True,
+                 'protocol': 'urn:3gpp:5gms:content-protocol:http-pull-ingest',
+             },
+             'distributionConfigurations': copy.deepcopy(cfg['distributionConfigurations']),
+             }
+
+def _strip_generated_fields(chc: ContentHostingConfiguration) -> ContentHostingConfiguration:
+    '''Get a copy of a ContentHostingConfiguration without the fields generated by the AF
+    '''
+    chc = copy.deepcopy(chc)
+    for dc in chc.get('distributionConfigurations', []):
+        for gen_field in ['canonicalDomainName', 'baseURL']:
+            dc.pop(gen_field, None)
+    return chc
+
+def _plan_chc_update(cfg: dict, current: ContentHostingConfiguration) -> dict:
+    '''Work out the change to an existing ContentHostingConfiguration for a changed stream
+
+    Certificates already used in the *current* ContentHostingConfiguration for the same domainNameAlias are kept, only
+    certificates for new domain names need to be created. Certificates used by the *current* ContentHostingConfiguration
+    which the desired one no longer uses are to be deleted once it has been updated.
+
+    :return: the desired ContentHostingConfiguration, the certificates to create for it, the certificates to delete and the
+             JSON Patch from the *current* ContentHostingConfiguration.
+    '''
+    target = _desired_chc(cfg)
+    existing = {}
+    in_use = []
+    for dc in current.get('distributionConfigurations', []):
+        if 'certificateId' in dc:
+            existing.setdefault(dc.get('domainNameAlias', None), dc['certificateId'])
+            if dc['certificateId'] not in in_use:
+                in_use += [dc['certificateId']]
+    resolved = {}
+    certs = {}
+    for dc in target['distributionConfigurations']:
+        if 'certificateId' in dc:
+            placeholder = dc['certificateId']
+            if placeholder not in resolved:
+                resolved[placeholder] = existing.get(dc.get('domainNameAlias', None))
+                if resolved[placeholder] is None:
+                    certs[placeholder] = dc.get('domainNameAlias', None)
+            if resolved[placeholder] is not None:
+                dc['certificateId'] = resolved[placeholder]
+    kept = set(resolved.values())
+    return {'update': target, 'certificates': certs, 'deleteCertificates': [cert_id for cert_id in in_use if cert_id not in kept],
+            'patch': make_json_patch(_strip_generated_fields(current), target)}
+
+async def _plan_stream_update(cfg_id: str, cfg: dict, state: dict, chc_changed: bool = False) -> Optional[dict]:
+    '''Work out the changes needed to bring an already configured Provisioning Session in line with its stream configuration
+
+    :return: the changes to make or ``None`` if the stream cannot be synchronised.
+    '''
+    metrics_configs = cfg.get('metricsReporting', [])
+    if not isinstance(metrics_configs, list):
+        log_error(f'Configured metrics for stream "{cfg_id}" should be a list')
+        return None
+    update = {'contentHostingConfiguration': {},
+              'consumptionReportingConfiguration': {},
+              'metricsReportingConfigurations': {'create': [], 'delete': []},
+              'policyTemplates': {'create': [], 'delete': []},
+              }
+
+    # ContentHostingConfiguration
+    if chc_changed:
+        update['contentHostingConfiguration'] = _plan_chc_update(cfg, state['contentHostingConfiguration'])
+
+    # ConsumptionReportingConfiguration
+    old_crc: Optional[ConsumptionReportingConfiguration] = state['consumptionReportingConfiguration']
+    new_crc: Optional[ConsumptionReportingConfiguration] = cfg.get('consumptionReporting', None)
+    if not await consumption_reporting_equal(old_crc, new_crc):
+        if old_crc is None:
+            # No pre-existing CRC, add the new one
+            update['consumptionReportingConfiguration'] = {'create': new_crc}
+        elif new_crc is None:
+            # There is a CRC, but shouldn't be one, remove it
+            update['consumptionReportingConfiguration'] = {'delete': old_crc}
+        else:
+            # The CRC has changed, update it
+            update['consumptionReportingConfiguration'] = {'update': new_crc}
+
+    # MetricsReportingConfigurations
+    new_metrics_configurations = list(metrics_configs)
+    for existing_id, existing_config in state['metricsReportingConfigurations'].items():
+        for new_config in new_metrics_configurations:
+            if await metrics_configuration_match(existing_config, new_config):
+                new_metrics_configurations.remove(new_config)
+                break
+        else:
+            update['metricsReportingConfigurations']['delete'] += [existing_id]
+    update['metricsReportingConfigurations']['create'] = new_metrics_configurations
+
+    # PolicyTemplates
+    new_pol_left = _policy_templates(cfg_id, cfg.get('policies', None))
+    for pol_id, old_pol in state['policyTemplates'].items():
+        for pol in new_pol_left:
+            if await policies_match(old_pol, pol):
+                new_pol_left.remove(pol)
+                break
+        else:
+            update['policyTemplates']['delete'] += [pol_id]
+    update['policyTemplates']['create'] = new_pol_left
+
+    return update
+
+def _plan_stream_create(cfg_id: str, cfg: dict) -> dict:
+    '''Work out the resources to create for a new stream
+    '''
+    metrics_configurations = cfg.get('metricsReporting', None)
+    if metrics_configurations is not None and not isinstance(metrics_configurations, list):
+        log_error(f'Configured metrics for stream "{cfg_id}" should be an array')
+        metrics_configurations = None
+    chc = _desired_chc(cfg)
+    # Certificates are identified by the placeholder certificateId used in the stream configuration
+    certs = {}
+    for dc in chc['distributionConfigurations']:
+        if 'certificateId' in dc and dc['certificateId'] not in certs:
+            certs[dc['certificateId']] = dc.get('domainNameAlias', None)
+    return {'contentHostingConfiguration': chc,
+            'certificates': certs,
+            'consumptionReportingConfiguration': cfg.get('consumptionReporting', None),
+            'metricsReportingConfigurations': metrics_configurations or [],
+            'policyTemplates': _policy_templates(cfg_id, cfg.get('policies', None)),
+            }
+
+def _pair_changed_streams(streams_left: Dict[str, dict], sessions_left: Dict[ResourceId, dict],
+                          known: Dict[str, ResourceId]) -> List[Tuple[str, ResourceId]]:
+    '''Pair changed streams with the existing Provisioning Sessions they were configured in
+
+    A stream is paired with the Provisioning Session recorded for it in *known*, otherwise with the only remaining
+    Provisioning Session with the same name, or failing that the same ingest URL, as long as that is unambiguous.
+
+    :param streams_left: The streams which did not match any Provisioning Session.
+    :param sessions_left: The snapshots of the Provisioning Sessions which did not match any stream.
+    :param known: The Provisioning Session identifiers for the streams from the last sync.
+    :return: the list of (stream identifier, Provisioning Session identifier) pairs.
+    '''
+    pairs = []
+    streams_left = dict(streams_left)
+    sessions_left = dict(sessions_left)
+    for cfg_id in list(streams_left.keys()):
+        ps_id = known.get(cfg_id)
+        if ps_id in sessions_left:
+            pairs += [(cfg_id, ps_id)]
+            del streams_left[cfg_id]
+            del sessions_left[ps_id]
+    for stream_key, chc_key in [(lambda cfg: cfg['name'], lambda chc: chc['name']),
+                                (lambda cfg: cfg['ingestURL'], lambda chc: chc['ingestConfiguration']['baseURL'])]:
+        by_stream: Dict[str, List[str]] = {}
+        for cfg_id, cfg in streams_left.items():
+            by_stream.setdefault(stream_key(cfg), []).append(cfg_id)
+        by_session: Dict[str, List[ResourceId]] = {}
+        for ps_id, state in sessions_left.items():
+            by_session.setdefault(chc_key(state['contentHostingConfiguration']), []).append(ps_id)
+        for key, cfg_ids in by_stream.items():
+            ps_ids = by_session.get(key, [])
+            if len(cfg_ids) == 1 and len(ps_ids) == 1:
+                pairs += [(cfg_ids[0], ps_ids[0])]
+                del streams_left[cfg_ids[0]]
+                del sessions_left[ps_ids[0]]
+    return pairs
+
+def _has_changes(update: dict) -> bool:
+    return bool(update['contentHostingConfiguration'] or update['consumptionReportingConfiguration'] or
+                any(update[k]['create'] or update[k]['delete'] for k in ['metricsReportingConfigurations', 'policyTemplates']))
+
+def _plan_shard(updates: List[Tuple[str, dict, dict, bool]], creates: List[Tuple[str, dict]]
+                ) -> Tuple[List[Optional[dict]], List[dict]]:
+    '''Work out the changes for a shard of the streams
+
+    This is run in the worker processes by `_plan_streams`.
+
+    :param updates: The stream identifier, stream configuration, Provisioning Session state and CHC changed flag of each
+                    already configured stream.
+    :param creates: The stream identifier and stream configuration of each new stream.
+    :return: the results of `_plan_stream_update` for the *updates* and `_plan_stream_create` for the *creates*.
+    '''
+    async def plan_updates() -> List[Optional[dict]]:
+        return [await _plan_stream_update(cfg_id, cfg, state, chc_changed) for cfg_id, cfg, state, chc_changed in updates]
+    return asyncio.run(plan_updates()), [_plan_stream_create(cfg_id, cfg) for cfg_id, cfg in creates]
+
+def _plan_pool(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    '''Get the process pool for planning, creating it if needed
+
+    The pool is kept between syncs, so that worker processes are only started once in ``--watch`` mode.
+    '''
+    global g_plan_pool
+    global g_plan_pool_workers
+    if g_plan_pool is None or g_plan_pool_workers != workers:
+        close_plan_pool()
+        # Use fresh interpreters, forking a process with a running event loop and I/O threads is not safe
+        g_plan_pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        g_plan_pool_workers = workers
+    return g_plan_pool
+
+def close_plan_pool():
+    '''Stop the worker processes used for planning, if any
+    '''
+    global g_plan_pool
+    if g_plan_pool is not None:
+        g_plan_pool.shutdown()
+        g_plan_pool = None
+
+async def _plan_streams(updates: List[Tuple[str, dict, dict, bool]], creates: List[Tuple[str, dict]], workers: int = 1
+                        ) -> Tuple[List[Optional[dict]], List[dict]]:
+    '''Work out the changes for the streams, sharded across worker processes
+
+    Streams are assigned to shards by a stable hash of the stream identifier, one shard per worker process, while there
+    are at least `g_shard_min_streams` streams per shard. With fewer streams, or a single worker, the planning is done in
+    this process.
+
+    :param updates: The already configured streams, as for `_plan_shard`.
+    :param creates: The new streams, as for `_plan_shard`.
+    :param workers: The number of worker processes to use.
+    :return: the results for the *updates* and *creates*, in the same order as they were given.
+    '''
+    global g_shard_min_streams
+    shards = min(workers, (len(updates) + len(creates)) // max(1, g_shard_min_streams))
+    if shards > 1:
+        shard_updates = [[] for _ in range(shards)]
+        shard_creates = [[] for _ in range(shards)]
+        for item in updates:
+            shard_updates[zlib.crc32(item[0].encode('utf-8')) % shards] += [item]
+        for item in creates:
+            shard_creates[zlib.crc32(item[0].encode('utf-8')) % shards] += [item]
+        loop = asyncio.get_running_loop()
+        try:
+            results = await asyncio.gather(*[loop.run_in_executor(_plan_pool(workers), _plan_shard, shard_updates[i],
+                                                                  shard_creates[i]) for i in range(shards)])
+        except (concurrent.futures.BrokenExecutor, OSError) as err:
+            log_warn("Planning worker processes failed (%s), planning in this process", err)
+            close_plan_pool()
+        else:
+            update_results = {}
+            create_results = {}
+            for i, (shard_update_results, shard_create_results) in enumerate(results):
+                update_results.update(zip([item[0] for item in shard_updates[i]], shard_update_results))
+                create_results.update(zip([item[0] for item in shard_creates[i]], shard_create_results))
+            return [update_results[item[0]] for item in updates], [create_results[item[0]] for item in creates]
+    return [await _plan_stream_update(*item) for item in updates], [_plan_stream_create(*item) for item in creates]
+
+async def compute_plan(streams: dict, snapshot: Dict[ResourceId, dict], known: Optional[Dict[str, ResourceId]] = None,
+                       workers: int = 1) -> dict:
+    '''Work out the changes needed to make the AF match the streams configuration
+
+    The plan is a ``dict`` with the entries:
+
+    - ``delete``: the list of Provisioning Session identifiers to destroy.
+    - ``create``: a map of stream identifier to the resources to create for the stream in a new Provisioning Session.
+    - ``keep``: a map of stream identifier to the existing Provisioning Session identifier for already configured streams.
+    - ``update``: a map of stream identifier to the changes to make in the Provisioning Session, for those streams in
+      ``keep`` that have changes to make.
+
+    Streams whose ContentHostingConfiguration has changed are paired with their existing Provisioning Session (see
+    `_pair_changed_streams`) and the ContentHostingConfiguration is patched, rather than the Provisioning Session being
+    destroyed and provisioned again.
+
+    :param streams: The streams configuration.
+    :param snapshot: The AF state as returned by `snapshot_af_state`.
+    :param known: The Provisioning Session identifiers for the streams from the last sync, if known.
+    :param workers: The number of worker processes to share the comparison of the streams with the AF state between.
+    :return: the plan.
+    '''
+    plan = {'delete': [], 'create': {}, 'keep': {}, 'update': {}}
+    to_check = dict(streams['streams'])
+    # Index the configured streams by fingerprint so that each existing Provisioning Session can be matched with a lookup
+    wanted: Dict[Tuple[str, str, Tuple[str, ...]], List[str]] = {}
+    for chk_id, chk_stream in to_check.items():
+        fp = stream_fingerprint(chk_stream['name'], chk_stream['ingestURL'], chk_stream['distributionConfigurations'])
+        wanted.setdefault(fp, []).append(chk_id)
+    matched = []
+    unmatched = {}
+    for ps_id, state in snapshot.items():
+        chc = state['contentHostingConfiguration']
         if chc is None:
             log_warn(f'Provisioning Session {ps_id} has no ContentHostingConfiguration, removing from the AF')
-            del_ps_id += [ps_id]
+            plan['delete'] += [ps_id]
             continue
-        for chk_id, chk_stream in to_check.items():
-            if (
-                    chk_stream['name'] == chc['name'] and
-                    chk_stream['ingestURL'] == chc['ingestConfiguration']['baseURL'] and
-                    await distrib_configs_equal(chk_stream['distributionConfigurations'], chc['distributionConfigurations'])
-                    ):
-                del to_check[chk_id]
-                have[chk_id] = chk_stream
-                stream_map[chk_id] = ps_id
-                break
+        fp = stream_fingerprint(chc['name'], chc['ingestConfiguration']['baseURL'], chc['distributionConfigurations'])
+        chk_ids = wanted.get(fp)
+        if chk_ids:
+            chk_id = chk_ids.pop(0)
+            matched += [(chk_id, to_check.pop(chk_id), ps_id, state, False)]
         else:
-            del_ps_id += [ps_id]
-    # have = already configured, to_check = need to configure, del_ps_id = configuration not found in the configured streams
-    for ps_id in del_ps_id:
-        await m1.provisioningSessionDestroy(ps_id)
-    for cfg_id, cfg in to_check.items():
-        chc = { 'name': cfg['name'],
-                'ingestConfiguration': {
-                    'baseURL': cfg['ingestURL'],
-                    'pull': True,
-                    'protocol': 'urn:3gpp:5gms:content-protocol:http-pull-ingest',
-                },
-                'distributionConfigurations': cfg['distributionConfigurations'],
-                }
-        crc = cfg.get('consumptionReporting', None)
-        policies = cfg.get('policies', None)
-        metrics_configurations = cfg.get('metricsReporting', None)
+            unmatched[ps_id] = state
+    for chk_id, ps_id in _pair_changed_streams(to_check, unmatched, known or {}):
+        matched += [(chk_id, to_check.pop(chk_id), ps_id, unmatched.pop(ps_id), True)]
+    plan['delete'] += list(unmatched.keys())
+    updates, creates = await _plan_streams([(chk_id, cfg, state, chc_changed) for chk_id, cfg, _, state, chc_changed in matched],
+                                           list(to_check.items()), workers)
+    for (chk_id, _, ps_id, _, _), update in zip(matched, updates):
+        plan['keep'][chk_id] = ps_id
+        if update is not None and _has_changes(update):
+            update['provisioningSessionId'] = ps_id
+            plan['update'][chk_id] = update
+    for cfg_id, new in zip(to_check.keys(), creates):
+        plan['create'][cfg_id] = new
+    return plan
+
+def format_plan(plan: dict) -> str:
+    '''Format a plan as a human readable diff
+
+    :param plan: The plan as returned by `compute_plan`.
+    :return: the diff text.
+    '''
+    lines = []
+    for ps_id in plan['delete']:
+        lines += [f'- provisioning-session {ps_id}']
+    for cfg_id, new in plan['create'].items():
+        lines += [f'+ provisioning-session for stream "{cfg_id}"']
+        for placeholder, domain_name in new['certificates'].items():
+            lines += [f'+     certificate {placeholder} for {domain_name or "the default domain names"}']
+        lines += [f'+     content-hosting-configuration {json.dumps(new["contentHostingConfiguration"])}']
+        if new['consumptionReportingConfiguration'] is not None:
+            lines += [f'+     consumption-reporting-configuration {json.dumps(new["consumptionReportingConfiguration"])}']
+        for mrc in new['metricsReportingConfigurations']:
+            lines += [f'+     metrics-reporting-configuration {json.dumps(mrc)}']
+        for pt in new['policyTemplates']:
+            lines += [f'+     policy-template {json.dumps(pt)}']
+    for cfg_id, update in plan['update'].items():
+        lines += [f'~ provisioning-session {update["provisioningSessionId"]} for stream "{cfg_id}"']
+        if update['contentHostingConfiguration']:
+            for placeholder, domain_name in update['contentHostingConfiguration']['certificates'].items():
+                lines += [f'+     certificate {placeholder} for {domain_name or "the default domain names"}']
+            lines += [f'~     content-hosting-configuration {json.dumps(update["contentHostingConfiguration"]["patch"])}']
+            for cert_id in update['contentHostingConfiguration'].get('deleteCertificates', []):
+                lines += [f'-     certificate {cert_id}']
+        for action, crc in update['consumptionReportingConfiguration'].items():
+            marker = {'create': '+', 'update': '~', 'delete': '-'}[action]
+            lines += [f'{marker}     consumption-reporting-configuration {json.dumps(crc)}']
+        for kind, label in [('metricsReportingConfigurations', 'metrics-reporting-configuration'),
+                            ('policyTemplates', 'policy-template')]:
+            for res_id in update[kind]['delete']:
+                lines += [f'-     {label} {res_id}']
+            for res in update[kind]['create']:
+                lines += [f'+     {label} {json.dumps(res)}']
+    lines += [f'Plan: {len(plan["create"])} to create, {len(plan["update"])} to update, {len(plan["delete"])} to delete, '
+              f'{len(plan["keep"]) - len(plan["update"])} unchanged']
+    return '\n'.join(lines)
+
+async def _create_stream_session(m1: M1Session, streams: dict, cfg_id: str) -> Optional[ResourceId]:
+    try:
         ps_id = await m1.createDownlinkPullProvisioningSession(streams.get('appId'), streams.get('aspId', None))
-        if ps_id is None:
-            log_error("Failed to create Provisioning Session for %r", cfg)
-        else:
-            stream_map[cfg_id] = ps_id
-            certs = {}
-            for dc in chc['distributionConfigurations']:
-                if 'certificateId' in dc:
-                    if dc['certificateId'] not in certs:
-                        cert_id = await m1.createNewCertificate(ps_id, extra_domain_names=dc.get('domainNameAlias', None))
-                        if cert_id is None:
-                            log_error("Failed to create certificate for Provisioning Session %s, skipping %r", ps_id, cfg)
-                            chc = None
-                            break
-                        certs[dc['certificateId']] = cert_id
-                    else:
-                        cert_id = certs[dc['certificateId']]
-                    dc['certificateId'] = cert_id
-            if chc is not None:
-                if not await m1.contentHostingConfigurationCreate(ps_id, chc):
-                    log_error("Failed to create ContentHostingConfiguration for Provisioning Session %s, skipping %r", ps_id, cfg)
-            if crc is not None:
-                if not await m1.consumptionReportingConfigurationCreate(ps_id, crc):
-                    log_error("Failed to activate ConsumptionReportingConfiguration for Provisioning Session %s")
-
-            if metrics_configurations is not None:
-                if not isinstance (metrics_configurations, list):
-                    log_error(f'Configured metrics for provisioning session "{cfg_id}" should be an array')
-                    return            
-                for metrics_configuration in metrics_configurations:
-                    result = await m1.metricsReportingConfigurationCreate(ps_id, metrics_configuration)
-                    if result is None:
-                        log_error(f'Failed to create metrics reporting configuration in provisioning session {ps_id}')
-            
-            if policies is not None:
-                if isinstance(policies,dict):
-                    pol_list = policies.items()
-                elif isinstance(policies,list):
-                    pol_list = [(p.get('externalReference', None), p) for p in policies]
-                else:
-                    log_error(f'Configured policies for provisioning session "{cfg_id}" should be an object or array')
-                    pol_list = None
-                if pol_list is not None:
-                    for ext_id, pol in pol_list:
-                        pt = dict()
-                        if ext_id is not None:
-                            pt.update({'externalReference': ext_id})
-                        pt.update(pol)
-                        result = await m1.policyTemplateCreate(ps_id, pt)
-                        if result is None:
-                            log_error(f'Failed to create policy template {ext_id!r} in provisioning session {ps_id}')
-    # Check for other changes in the configured sessions
-    for cfg_id, cfg in have.items():
-        # Check for ConsumptionReportingConfiguration changes in already configured sessions
-        ps_id = stream_map[cfg_id]
-        old_crc: Optional[ConsumptionReportingConfiguration] = await m1.consumptionReportingConfigurationGet(ps_id)
-        new_crc: Optional[ConsumptionReportingConfiguration] = cfg.get('consumptionReporting', None)
-        if not await consumption_reporting_equal(old_crc, new_crc):
-            if old_crc is None:
-                # No pre-existing CRC, add the new one
-                if not await m1.consumptionReportingConfigurationCreate(ps_id, new_crc):
-                    log_error("Failed to activate ConsumptionReportingConfiguration for Provisioning Session %s", ps_id)
-            elif new_crc is None:
-                # There is a CRC, but shouldn't be one, remove it
-                if not await m1.consumptionReportingConfigurationDelete(ps_id):
-                    log_error("Failed to remove ConsumptionReportingConfiguration for Provisioning Session %s", ps_id)
-            else:
-                # The CRC has changed, update it
-                if not await m1.consumptionReportingConfigurationUpdate(ps_id, new_crc):
-                    log_error("Failed to update ConsumptionReportingConfiguration for Provisioning Session %s", ps_id)
-
-        # Check for MetricsReportingConfiguration changes in already configured sessions
-        existing_metrics_ids = await m1.metricsReportingConfigurationIds(ps_id)
-        metrics_configs = cfg.get('metricsReporting', [])
-        if not isinstance(metrics_configs, list):
-            log_error(f'Configured metrics for provisioning session "{ps_id}" should be a list')
-            return
-        existing_metrics = {mrc_id: await m1.metricsReportingConfigurationGet(ps_id, mrc_id) for mrc_id in existing_metrics_ids}
-        new_metrics_configurations = metrics_configs.copy()
-        # Assume deletion of all existing metrics
-        del_metrics = list(existing_metrics_ids)
-
-        for existing_id, existing_config in existing_metrics.items():
-            found = False
-            for new_config in new_metrics_configurations:
-                if await metrics_configuration_match(existing_config, new_config):
-                    new_metrics_configurations.remove(new_config)
-                    del_metrics.remove(existing_id)
-                    found = True
-                    break
-
-        for mrc_id in del_metrics:
-            await m1.metricsReportingConfigurationDelete(ps_id, mrc_id)
-
-        for metrics_configuration in new_metrics_configurations:
-            if await m1.metricsReportingConfigurationCreate(ps_id, metrics_configuration) is None:
-                log_error(f'Failed to create new metrics reporting configuration in provisioning session {ps_id}')
-
-        # Check PolicyTemplates for changes in the already configured sessions
-        del_policy: List[ResourceId] = []
-        have_policy: List[ResourceId] = []
-        new_policy: List[PolicyTemplate] = []
-        old_pol_ids: Optional[List[ResourceId]] = await m1.policyTemplateIds(ps_id)
-        policies = cfg.get('policies', None)
-        pol_list = None
-        if policies is not None:
-            if isinstance(policies,dict):
-                pol_list = policies.items()
-            elif isinstance(policies,list):
-                pol_list = [(p.get('externalReference', None), p) for p in policies]
-            else:
-                log_error(f'Configured policies for provisioning session "{cfg_id}" should be an object or array')
-        if old_pol_ids is None or len(old_pol_ids) == 0:
-            if policies is not None:
-                if pol_list is not None:
-                    for pol_ext_id, pol in pol_list:
-                        pt = dict()
-                        if pol_ext_id is not None:
-                            pt.update({'externalReference': pol_ext_id})
-                        pt.update(pol)
-                        new_policy += [pt]
+    except M1Error as err:
+        log_error("Failed to create Provisioning Session for stream %r: %s", cfg_id, err)
+        return None
+    if ps_id is None:
+        log_error("Failed to create Provisioning Session for stream %r", cfg_id)
+    return ps_id
+
+async def _create_metrics_reporting(m1: M1Session, ps_id: ResourceId, metrics_configs: List[MetricsReportingConfiguration]) -> bool:
+    results = await asyncio.gather(*[m1.metricsReportingConfigurationCreate(ps_id, metrics_configuration)
+                                     for metrics_configuration in metrics_configs])
+    for result in results:
+        if result is None:
+            log_error(f'Failed to create metrics reporting configuration in provisioning session {ps_id}')
+    return None not in results
+
+async def _create_policies(m1: M1Session, ps_id: ResourceId, pol_list: List[PolicyTemplate]) -> bool:
+    results = await asyncio.gather(*[m1.policyTemplateCreate(ps_id, pt) for pt in pol_list])
+    for pt, result in zip(pol_list, results):
+        if result is None:
+            log_error(f'Failed to create policy template {pt.get("externalReference")!r} in provisioning session {ps_id}')
+    return None not in results
+
+async def _apply_consumption_reporting(m1: M1Session, ps_id: ResourceId, actions: dict) -> bool:
+    ok = True
+    for action, crc in actions.items():
+        if action == 'create':
+            if not await m1.consumptionReportingConfigurationCreate(ps_id, crc):
+                log_error("Failed to activate ConsumptionReportingConfiguration for Provisioning Session %s", ps_id)
+                ok = False
+        elif action == 'delete':
+            if not await m1.consumptionReportingConfigurationDelete(ps_id):
+                log_error("Failed to remove ConsumptionReportingConfiguration for Provisioning Session %s", ps_id)
+                ok = False
         else:
-            new_pol_left = pol_list
-            for pol_id in old_pol_ids:
-                if new_pol_left is None or len(new_pol_left) == 0:
-                    del_policy += [pol_id]
-                else:
-                    old_pol: Optional[PolicyTemplate] = await m1.policyTemplateGet(ps_id, pol_id)
-                    next_new_pol_list = []
-                    found = False
-                    for pol_ext_id, pol in new_pol_left:
-                        if not found and await policies_match(old_pol, pol):
-                            have_policy += [pol_id]
-                            found = True
-                        else:
-                            next_new_pol_list += [(pol_ext_id, pol)]
-                    if not found:
-                        del_policy += [pol_id]
-                    new_pol_left = next_new_pol_list
-            for pol_ext_id, pol in new_pol_left:
-                pt = dict()
-                if pol_ext_id is not None:
-                    pt.update({'externalReference': pol_ext_id})
-                pt.update(pol)
-                new_policy += [pt]
-        # Now we have del_policy as a list of policy ids to delete, have_policy as a list of ids to keep and new_policy as a list
-        # of new policies to add.
-        for pol_id in del_policy:
-            await m1.policyTemplateDelete(ps_id, pol_id)
-        for pol in new_policy:
-            await m1.policyTemplateCreate(ps_id, pol)
+            if not await m1.consumptionReportingConfigurationPatch(ps_id, crc):
+                log_error("Failed to update ConsumptionReportingConfiguration for Provisioning Session %s", ps_id)
+                ok = False
+    return ok
+
+async def _apply_metrics_reporting(m1: M1Session, ps_id: ResourceId, actions: dict) -> bool:
+    results = await asyncio.gather(*[m1.metricsReportingConfigurationDelete(ps_id, mrc_id) for mrc_id in actions['delete']])
+    for mrc_id, result in zip(actions['delete'], results):
+        if not result:
+            log_error("Failed to remove MetricsReportingConfiguration %s from Provisioning Session %s", mrc_id, ps_id)
+    return await _create_metrics_reporting(m1, ps_id, actions['create']) and all(results)
+
+async def _apply_policies(m1: M1Session, ps_id: ResourceId, actions: dict) -> bool:
+    results = await asyncio.gather(*[m1.policyTemplateDelete(ps_id, pol_id) for pol_id in actions['delete']])
+    for pol_id, result in zip(actions['delete'], results):
+        if not result:
+            log_error("Failed to remove PolicyTemplate %s from Provisioning Session %s", pol_id, ps_id)
+    return await _create_policies(m1, ps_id, actions['create']) and all(results)
+
+async def _apply_chc_update(m1: M1Session, cfg_id: str, ps_id: ResourceId, chc: Optional[ContentHostingConfiguration],
+                            delete_certs: List[ResourceId]) -> bool:
+    '''Update the ContentHostingConfiguration then delete the certificates it no longer uses
+
+    The certificates are only deleted once the ContentHostingConfiguration no longer refers to them. A certificate which
+    cannot be deleted is only warned about, as it does not affect the stream.
+
+    :return: ``True`` if the ContentHostingConfiguration was updated or there was no update to make.
+    '''
+    if chc is None:
+        return True
+    if not await m1.contentHostingConfigurationPatch(ps_id, chc):
+        log_error("Failed to update ContentHostingConfiguration for Provisioning Session %s for stream %r", ps_id, cfg_id)
+        return False
+    results = await asyncio.gather(*[m1.certificateDelete(ps_id, cert_id) for cert_id in delete_certs])
+    for cert_id, result in zip(delete_certs, results):
+        if not result:
+            log_warn("Failed to delete unused certificate %s from Provisioning Session %s", cert_id, ps_id)
+    return True
+
+async def _apply_stream_update(m1: M1Session, cfg_id: str, update: dict) -> bool:
+    '''Apply the planned changes to an already configured Provisioning Session
+
+    The ContentHostingConfiguration, ConsumptionReportingConfiguration, MetricsReportingConfigurations and PolicyTemplates
+    are independent of each other so are changed concurrently.
+
+    :return: ``True`` if all of the changes were made.
+    '''
+    ps_id = update['provisioningSessionId']
+    try:
+        results = await asyncio.gather(
+                _apply_chc_update(m1, cfg_id, ps_id, update['contentHostingConfiguration'].get('update'),
+                                  update['contentHostingConfiguration'].get('deleteCertificates', [])),
+                _apply_consumption_reporting(m1, ps_id, update['consumptionReportingConfiguration']),
+                _apply_metrics_reporting(m1, ps_id, update['metricsReportingConfigurations']),
+                _apply_policies(m1, ps_id, update['policyTemplates']),
+                )
+    except M1Error as err:
+        log_error("Failed to synchronise Provisioning Session %s for stream %r: %s", ps_id, cfg_id, err)
+        return False
+    return all(results)
+
+async def _apply_stream_create(m1: M1Session, cfg_id: str, new: dict, ps_id: ResourceId, chc: Optional[ContentHostingConfiguration]) -> bool:
+    '''Populate a newly created Provisioning Session
+
+    The ContentHostingConfiguration is created first, then the ConsumptionReportingConfiguration,
+    MetricsReportingConfigurations and PolicyTemplates are created concurrently.
+
+    :return: ``True`` if everything was created, or ``False`` if anything failed, including if *chc* is ``None`` because its
+             certificates could not be created.
+    '''
+    crc = new['consumptionReportingConfiguration']
+    ok = chc is not None
+    try:
+        if chc is not None:
+            if not await m1.contentHostingConfigurationCreate(ps_id, chc):
+                log_error("Failed to create ContentHostingConfiguration for Provisioning Session %s, skipping stream %r", ps_id, cfg_id)
+                ok = False
+        results = await asyncio.gather(
+                _apply_consumption_reporting(m1, ps_id, {'create': crc} if crc is not None else {}),
+                _create_metrics_reporting(m1, ps_id, new['metricsReportingConfigurations']),
+                _create_policies(m1, ps_id, new['policyTemplates']),
+                )
+    except M1Error as err:
+        log_error("Failed to provision stream %r in Provisioning Session %s: %s", cfg_id, ps_id, err)
+        return False
+    return ok and all(results)
+
+def _substitute_certificates(chc: ContentHostingConfiguration, certs: Dict[str, int], cert_ids: List[Optional[ResourceId]]
+                             ) -> Optional[ContentHostingConfiguration]:
+    '''Replace the certificate placeholders in a ContentHostingConfiguration with the created certificates
+
+    :param chc: The ContentHostingConfiguration from the plan.
+    :param certs: A map of placeholder to the index in *cert_ids* of the certificate created for it.
+    :param cert_ids: The created certificate identifiers.
+    :return: a copy of *chc* with the placeholders replaced or ``None`` if a certificate could not be created.
+    '''
+    chc = copy.deepcopy(chc)
+    for dc in chc['distributionConfigurations']:
+        if 'certificateId' in dc and dc['certificateId'] in certs:
+            cert_id = cert_ids[certs[dc['certificateId']]]
+            if cert_id is None:
+                return None
+            dc['certificateId'] = cert_id
+    return chc
+
+async def apply_plan(m1: M1Session, streams: dict, plan: dict, concurrency: int = 8) -> Tuple[dict, Set[str]]:
+    '''Make the changes in a plan to the AF
+
+    Independent streams are provisioned concurrently, with at most *concurrency* streams being worked on at once. The
+    certificates needed are created in one batch, making at most *concurrency* certificate requests to the AF at once.
+
+    :param m1: The M1Session to use to communicate with the AF.
+    :param streams: The streams configuration.
+    :param plan: The plan as returned by `compute_plan`.
+    :param concurrency: The maximum number of streams to work on at once.
+    :return: a tuple of the map of stream identifier to Provisioning Session identifier and the set of stream identifiers for
+             the streams which are now fully configured as planned. Streams which were only partly configured, because a
+             change failed, are in the map but not the set.
+    '''
+    limit = asyncio.Semaphore(max(1, concurrency))
+    stream_map = dict(plan['keep'])
+    applied = set([cfg_id for cfg_id in plan['keep'].keys() if cfg_id not in plan['update']])
+    await _bounded_gather(limit, [m1.provisioningSessionDestroy(ps_id) for ps_id in plan['delete']])
+    new_ps_ids = await _bounded_gather(limit, [_create_stream_session(m1, streams, cfg_id) for cfg_id in plan['create'].keys()])
+    new_streams = []
+    cert_requests = []
+    for (cfg_id, new), ps_id in zip(plan['create'].items(), new_ps_ids):
+        if ps_id is None:
+            continue
+        stream_map[cfg_id] = ps_id
+        # Collect the certificates needed so that they can all be created in one batch
+        certs = {}
+        for placeholder, domain_name in new['certificates'].items():
+            certs[placeholder] = len(cert_requests)
+            cert_requests += [(ps_id, domain_name)]
+        new_streams += [(cfg_id, new, ps_id, certs)]
+    updates = []
+    for cfg_id, update in plan['update'].items():
+        certs = {}
+        for placeholder, domain_name in update['contentHostingConfiguration'].get('certificates', {}).items():
+            certs[placeholder] = len(cert_requests)
+            cert_requests += [(update['provisioningSessionId'], domain_name)]
+        updates += [(cfg_id, update, certs)]
+    # The certificate requests to the AF are bounded by the same limit as the streams
+    cert_ids = await m1.createNewCertificates(cert_requests, concurrency=concurrency)
+    provisioning = []
+    provisioning_ids = []
+    for cfg_id, new, ps_id, certs in new_streams:
+        chc = _substitute_certificates(new['contentHostingConfiguration'], certs, cert_ids)
+        if chc is None:
+            log_error("Failed to create certificate for Provisioning Session %s, skipping stream %r", ps_id, cfg_id)
+        provisioning += [_apply_stream_create(m1, cfg_id, new, ps_id, chc)]
+        provisioning_ids += [cfg_id]
+    certs_failed = set()
+    for cfg_id, update, certs in updates:
+        if update['contentHostingConfiguration']:
+            chc = _substitute_certificates(update['contentHostingConfiguration']['update'], certs, cert_ids)
+            if chc is None:
+                log_error("Failed to create certificate for Provisioning Session %s, not updating stream %r",
+                          update['provisioningSessionId'], cfg_id)
+                certs_failed.add(cfg_id)
+            update = dict(update, contentHostingConfiguration=dict(update['contentHostingConfiguration'], update=chc))
+        provisioning += [_apply_stream_update(m1, cfg_id, update)]
+        provisioning_ids += [cfg_id]
+    results = await _bounded_gather(limit, provisioning)
+    applied.update([cfg_id for cfg_id, ok in zip(provisioning_ids, results) if ok and cfg_id not in certs_failed])
+    return stream_map, applied
+
+async def sync_configuration(m1: M1Session, streams: dict, concurrency: int = 8, workers: int = 1) -> dict:
+    '''Synchronise the Provisioning Sessions in the AF with the streams configuration
+
+    :param m1: The M1Session to use to communicate with the AF.
+    :param streams: The streams configuration.
+    :param concurrency: The maximum number of Provisioning Sessions to work on at once.
+    :param workers: The number of worker processes to use for planning the changes.
+    :return: a map of stream identifier to Provisioning Session identifier.
+    '''
+    snapshot = await snapshot_af_state(m1, concurrency)
+    plan = await compute_plan(streams, snapshot, workers=workers)
+    stream_map, _ = await apply_plan(m1, streams, plan, concurrency)
     return stream_map
 
+def stream_config_digest(cfg: dict) -> str:
+    '''Get the digest of a stream definition
+
+    :param cfg: The stream definition from the streams configuration.
+    :return: the hexadecimal SHA-256 digest of the stream definition.
+    '''
+    return hashlib.sha256(json.dumps(cfg, sort_keys=True).encode('utf-8')).hexdigest()
+
+def stream_digest(streams: dict, cfg_id: str) -> str:
+    '''Get the digest of the desired state of a stream
+
+    The digest covers everything in the streams configuration that affects the Provisioning Session for the stream. The
+    digest of the stream definition is taken from the *digests* map of the streams configuration when it is there, as read
+    by `read_streams_config`, so the definition itself need not be held.
+
+    :param streams: The streams configuration.
+    :param cfg_id: The stream identifier.
+    :return: the hexadecimal SHA-256 digest of the stream configuration.
+    '''
+    cfg_digest = streams.get('digests', {}).get(cfg_id) or stream_config_digest(streams['streams'][cfg_id])
+    desired = {'appId': streams.get('appId'), 'aspId': streams.get('aspId', None), 'stream': cfg_digest}
+    return hashlib.sha256(json.dumps(desired, sort_keys=True).encode('utf-8')).hexdigest()
+
+async def _journal_entry(m1: M1Session, streams: dict, cfg_id: str, ps_id: ResourceId) -> Optional[dict]:
+    '''Create the journal entry for a stream as it is currently configured in the AF
+
+    The entry includes the ContentHostingConfiguration so that the M8 data can be generated without fetching it again.
+
+    :return: the journal entry or ``None`` if the stream is not fully configured in the AF.
+    '''
+    ps_etag, chc_etag, chc = await asyncio.gather(m1.provisioningSessionETag(ps_id), m1.contentHostingConfigurationETag(ps_id),
+                                                  m1.contentHostingConfigurationGet(ps_id))
+    if chc is None:
+        return None
+    return {'digest': stream_digest(streams, cfg_id),
+            'streamDigest': streams.get('digests', {}).get(cfg_id) or stream_config_digest(streams['streams'][cfg_id]),
+            'provisioningSessionId': ps_id,
+            'provisioningSessionETag': ps_etag,
+            'contentHostingConfigurationETag': chc_etag,
+            'contentHostingConfiguration': chc,
+            }
+
+async def _journal_entry_current(m1: M1Session, streams: dict, cfg_id: str, entry: dict, verify: bool = True) -> bool:
+    '''Check if the AF still holds the state recorded in a stream's journal entry
+
+    The stream is current if its configuration is unchanged since the entry was recorded and the entity tags of the
+    Provisioning Session and ContentHostingConfiguration in the AF still match those recorded. If the AF does not provide
+    entity tags then the ContentHostingConfiguration is compared with the one recorded instead. If *verify* is ``False``
+    then the AF is not checked. When verifying, the M1Session state should have been refreshed from the AF first, see
+    `refresh_af_state`.
+    '''
+    if entry.get('digest') != stream_digest(streams, cfg_id) or entry.get('contentHostingConfiguration') is None:
+        return False
+    ps_id = entry.get('provisioningSessionId')
+    if ps_id not in await m1.provisioningSessionIds():
+        return False
+    if not verify:
+        return True
+    ps_etag, chc_etag = await asyncio.gather(m1.provisioningSessionETag(ps_id), m1.contentHostingConfigurationETag(ps_id))
+    if ps_etag is not None and chc_etag is not None:
+        return ps_etag == entry.get('provisioningSessionETag') and chc_etag == entry.get('contentHostingConfigurationETag')
+    chc = await m1.contentHostingConfigurationGet(ps_id)
+    if chc is None:
+        return False
+    recorded = entry['contentHostingConfiguration']
+    return (stream_fingerprint(chc['name'], chc['ingestConfiguration']['baseURL'], chc['distributionConfigurations']) ==
+            stream_fingerprint(recorded['name'], recorded['ingestConfiguration']['baseURL'],
+                               recorded['distributionConfigurations']))
+
+async def refresh_af_state(m1: M1Session, concurrency: int = 8) -> None:
+    '''Discard the cached AF state and fetch each known Provisioning Session again
+
+    Provisioning Sessions which have been removed from the AF are forgotten, and the entity tags and
+    ContentHostingConfigurations are fetched fresh when next asked for, so that changes made by other tools are seen.
+
+    :param m1: The M1Session to refresh.
+    :param concurrency: The maximum number of Provisioning Sessions to fetch at once.
+    '''
+    limit = asyncio.Semaphore(max(1, concurrency))
+    await _bounded_gather(limit, [m1.provisioningSessionRefresh(ps_id) for ps_id in list(await m1.provisioningSessionIds())])
+
+async def journal_current_streams(m1: M1Session, streams: dict, journal: Dict[str, dict], concurrency: int = 8,
+                                  verify: bool = True) -> Dict[str, ResourceId]:
+    '''Find the streams which do not need reconciling with the AF
+
+    :param m1: The M1Session to use to communicate with the AF.
+    :param streams: The streams configuration.
+    :param journal: The desired-state journal from the last sync.
+    :param concurrency: The maximum number of streams to check at once.
+    :param verify: If ``True`` check the entity tags in the AF, otherwise only look for changes in the streams configuration.
+    :return: a map of stream identifier to Provisioning Session identifier for the streams that are unchanged since the last
+             sync.
+    '''
+    limit = asyncio.Semaphore(max(1, concurrency))
+    cfg_ids = [cfg_id for cfg_id, digest in streams['digests'].items() if digest is not None and cfg_id in journal]
+    current = await _bounded_gather(limit, [_journal_entry_current(m1, streams, cfg_id, journal[cfg_id], verify)
+                                                  for cfg_id in cfg_ids])
+    result = {}
+    # Reverse index of Provisioning Session identifier to stream identifier for the streams found so far
+    claimed = {}
+    for cfg_id, is_current in zip(cfg_ids, current):
+        ps_id = journal[cfg_id]['provisioningSessionId']
+        # Guard against two streams claiming the same Provisioning Session in a corrupt journal
+        if is_current and ps_id not in claimed:
+            claimed[ps_id] = cfg_id
+            result[cfg_id] = ps_id
+    return result
+
+async def update_journal(m1: M1Session, streams: dict, stream_map: Dict[str, ResourceId], journal: Dict[str, dict],
+                         current: Dict[str, ResourceId], concurrency: int = 8,
+                         applied: Optional[Set[str]] = None) -> Dict[str, dict]:
+    '''Create the desired-state journal after a sync
+
+    Streams in *stream_map* which are not in *applied* are recorded with their Provisioning Session, so that they are paired
+    with it again, but without a desired state, so that they are reconciled again on the next sync.
+
+    :param m1: The M1Session to use to communicate with the AF.
+    :param streams: The streams configuration.
+    :param stream_map: The map of stream identifier to Provisioning Session identifier from the sync.
+    :param journal: The desired-state journal from the last sync.
+    :param current: The streams that were not reconciled because they were unchanged, as returned by `journal_current_streams`.
+    :param concurrency: The maximum number of streams to record at once.
+    :param applied: The streams which were fully configured by the sync, as returned by `apply_plan`, or ``None`` if all
+                    streams in *stream_map* were.
+    :return: the new journal.
+    '''
+    limit = asyncio.Semaphore(max(1, concurrency))
+    new_journal = {cfg_id: journal[cfg_id] for cfg_id in current.keys()}
+    cfg_ids = [cfg_id for cfg_id in stream_map.keys() if cfg_id not in current]
+    entries = await _bounded_gather(limit, [_journal_entry(m1, streams, cfg_id, stream_map[cfg_id]) for cfg_id in cfg_ids])
+    for cfg_id, entry in zip(cfg_ids, entries):
+        if applied is not None and cfg_id not in applied:
+            if entry is None:
+                entry = {'provisioningSessionId': stream_map[cfg_id], 'contentHostingConfiguration': None}
+            entry = dict(entry, digest=None, streamDigest=None)
+        if entry is not None:
+            new_journal[cfg_id] = entry
+    return new_journal
+
 async def get_app_config() -> configparser.ConfigParser:
     global g_sync_config
     config = configparser.ConfigParser()
@@ -649,36 +1355,195 @@ async def get_app_config() -> configparser.ConfigParser:
 m5_authority = 127.0.0.23:7777
 docroot = /var/cache/rt-5gms/as/docroots
 default_docroot = /usr/share/nginx/html
+concurrency = 8
+workers = 1
+m8_precompress =
+certificate_reuse_min_days = 14
 ''', source='defaults')
     async with aiofiles.open(g_sync_config, mode='r') as conffile:
         config.read_string(await conffile.read(), source=g_sync_config)
     return config
 
-async def get_streams_config() -> dict:
+def _check_type(problems: List[str], value: dict, field: str, types, optional: bool = False):
+    if field not in value:
+        if not optional:
+            problems += [f'missing "{field}"']
+    elif not isinstance(value[field], types):
+        names = {dict: 'an object', list: 'an array', str: 'a string'}
+        problems += [f'"{field}" should be ' + ' or '.join(names[t] for t in (types if isinstance(types, tuple) else (types,)))]
+
+def _list_field(value: dict, field: str) -> list:
+    return value[field] if isinstance(value.get(field, None), list) else []
+
+def validate_stream(cfg: Any) -> List[str]:
+    '''Check a stream definition from the streams configuration
+
+    :param cfg: The stream definition.
+    :return: the list of problems found, which is empty if the stream definition is valid.
+    '''
+    if not isinstance(cfg, dict):
+        return ['the stream definition should be an object']
+    problems: List[str] = []
+    _check_type(problems, cfg, 'name', str)
+    _check_type(problems, cfg, 'ingestURL', str)
+    _check_type(problems, cfg, 'distributionConfigurations', list)
+    for i, dc in enumerate(_list_field(cfg, 'distributionConfigurations')):
+        if not isinstance(dc, dict):
+            problems += [f'distributionConfigurations[{i}] should be an object']
+            continue
+        _check_type(problems, dc, 'domainNameAlias', str, optional=True)
+        _check_type(problems, dc, 'certificateId', str, optional=True)
+        _check_type(problems, dc, 'entryPoint', dict, optional=True)
+        if isinstance(dc.get('entryPoint', None), dict):
+            _check_type(problems, dc['entryPoint'], 'relativePath', str)
+            _check_type(problems, dc['entryPoint'], 'contentType', str)
+    _check_type(problems, cfg, 'consumptionReporting', dict, optional=True)
+    _check_type(problems, cfg, 'metricsReporting', list, optional=True)
+    if not all(isinstance(mrc, dict) for mrc in _list_field(cfg, 'metricsReporting')):
+        problems += ['metricsReporting entries should be objects']
+    _check_type(problems, cfg, 'policies', (dict, list), optional=True)
+    return problems
+
+def validate_vod_media(vod: Any) -> List[str]:
+    '''Check a VoD media entry from the streams configuration
+
+    :param vod: The vodMedia entry.
+    :return: the list of problems found, which is empty if the entry is valid.
+    '''
+    if not isinstance(vod, dict):
+        return ['the VoD media entry should be an object']
+    problems: List[str] = []
+    _check_type(problems, vod, 'name', str)
+    _check_type(problems, vod, 'stream', str)
+    _check_type(problems, vod, 'entryPoints', list)
+    for i, vep in enumerate(_list_field(vod, 'entryPoints')):
+        if not isinstance(vep, dict):
+            problems += [f'entryPoints[{i}] should be an object']
+            continue
+        _check_type(problems, vep, 'relativePath', str)
+        _check_type(problems, vep, 'contentType', str)
+    return problems
+
+async def iter_streams_config() -> AsyncIterator[Tuple[JSONPath, Any]]:
+    '''Read the streams configuration file a piece at a time
+
+    The *streams* map and *vodMedia* list are read one entry at a time so that the whole document is never held in memory.
+
+    :return: an asynchronous iterator of the paths and values in the streams configuration, see `JSONMemberParser`.
+    :raise OSError: if the file cannot be read.
+    :raise ValueError: if the file is not a valid JSON object.
+    '''
     global g_streams_config
+    global g_read_size
+    parser = JSONMemberParser(expand=['streams', 'vodMedia'])
     async with aiofiles.open(g_streams_config, mode='r') as infile:
-        streams = json.loads(await infile.read())
+        while True:
+            text = await infile.read(g_read_size)
+            if not text:
+                break
+            for item in parser.feed(text):
+                yield item
+    for item in parser.close():
+        yield item
+
+async def read_streams_config(journal: Optional[Dict[str, dict]] = None, only: Optional[Iterable[str]] = None) -> dict:
+    '''Read the streams configuration
+
+    The streams configuration is parsed incrementally and each stream definition and VoD media entry is checked as it is
+    read. Problems with a definition are logged and the stream is marked invalid, by a ``None`` digest, rather than
+    failing the whole configuration.
+
+    The result has the same layout as the streams.json file, with an extra *digests* map of stream identifier to the
+    `stream_config_digest` of every stream definition, in file order. The *streams* map only holds the definitions that
+    may need reconciling: those whose digest differs from the ``streamDigest`` in their *journal* entry, or those in
+    *only* if it is given.
+
+    :param journal: The desired-state journal from the last sync, if any.
+    :param only: If given, only keep the definitions of these streams.
+    :return: the streams configuration.
+    :raise OSError: if the file cannot be read.
+    :raise ValueError: if the file is not a valid streams configuration.
+    '''
+    global g_streams_config
+    journal = journal or {}
+    if only is not None:
+        only = set(only)
+    streams = {'streams': {}, 'digests': {}, 'vodMedia': []}
+    seen_streams = False
+    async for path, value in iter_streams_config():
+        if path[0] == 'streams' and len(path) == 2:
+            cfg_id = path[1]
+            problems = validate_stream(value)
+            if cfg_id in streams['digests']:
+                log_warn("Stream %r is defined more than once in %s, using the last definition", cfg_id, g_streams_config)
+                streams['streams'].pop(cfg_id, None)
+            if problems:
+                log_error("Stream %r in %s is invalid: %s", cfg_id, g_streams_config, '; '.join(problems))
+                streams['digests'][cfg_id] = None
+                continue
+            digest = stream_config_digest(value)
+            streams['digests'][cfg_id] = digest
+            if only is not None:
+                keep = cfg_id in only
+            else:
+                keep = journal.get(cfg_id, {}).get('streamDigest') != digest
+            if keep:
+                streams['streams'][cfg_id] = value
+        elif path[0] == 'vodMedia' and len(path) == 2:
+            problems = validate_vod_media(value)
+            if problems:
+                log_error("VoD media entry %i in %s is invalid, omitting: %s", path[1], g_streams_config, '; '.join(problems))
+            else:
+                streams['vodMedia'] += [value]
+        elif path[0] == 'streams':
+            if not isinstance(value, dict):
+                raise ValueError(f'"streams" in {g_streams_config} should be an object')
+            seen_streams = True
+        elif path[0] == 'vodMedia':
+            if not isinstance(value, list):
+                raise ValueError(f'"vodMedia" in {g_streams_config} should be an array')
+        else:
+            streams[path[0]] = value
+    if not seen_streams:
+        raise ValueError(f'No "streams" defined in {g_streams_config}')
+    if not isinstance(streams.get('appId', None), str):
+        raise ValueError(f'"appId" in {g_streams_config} should be a string')
     return streams
 
-async def get_m1_session(cfg: Configuration) -> M1Session:
-    data_store = None
-    data_store_dir = cfg.get('data_store')
-    if data_store_dir is not None:
-        data_store = await JSONFileDataStore(data_store_dir)
-    session = await M1Session((cfg.get('m1_address', 'localhost'), cfg.get('m1_port',7777)), data_store, cfg.get('certificate_signing_class'))
+async def get_m1_session(cfg: Configuration, data_store: Optional[DataStore] = None,
+                         reuse_min_days: Optional[str] = None, prepare_signer: bool = False) -> M1Session:
+    cfg_reuse_min_days = cfg.get('certificate_reuse_min_days')
+    if cfg_reuse_min_days is not None and len(cfg_reuse_min_days.strip()) > 0:
+        reuse_min_days = cfg_reuse_min_days
+    session = await M1Session((cfg.get('m1_address', 'localhost'), cfg.get('m1_port',7777)), data_store, cfg.get('certificate_signing_class'),
+                              reuse_min_days, prepare_certificate_signer=prepare_signer)
     return session
 
-async def dump_m8_files(m1: M1Session, stream_map: dict, vod_streams: List[dict], cfg: Configuration, config: configparser.ConfigParser):
+def build_m8(streams: dict, stream_map: Dict[str, ResourceId], chcs: Dict[ResourceId, ContentHostingConfiguration],
+             config: configparser.ConfigParser) -> Tuple[dict, set]:
+    '''Build the M8 data for the configured streams
+
+    This works only from the ContentHostingConfigurations given and does not contact the AF.
+
+    :param streams: The streams configuration.
+    :param stream_map: The map of stream identifier to Provisioning Session identifier from the sync.
+    :param chcs: The ContentHostingConfigurations in the AF, indexed by Provisioning Session identifier.
+    :param config: The af-sync configuration.
+    :return: the M8 data and the set of directories to publish it in.
+    '''
     # Assume M5 and M1 share an interface
     m8_config = {'m5BaseUrl': f'http://{config.get("af-sync", "m5_authority")}/3gpp-m5/v2/', 'serviceList': []}
     publish_dirs = {config.get("af-sync", "default_docroot")}
+    vod_streams = streams.get('vodMedia', [])
     vod_stream_ids = set([v['stream'] for v in vod_streams])
-    vod_ps_ids = set([v for k,v in stream_map.items() if k in vod_stream_ids])
-    for ps_id in await m1.provisioningSessionIds():
-        log_debug("Probing Provisioning Session %s", ps_id)
-        chc = await m1.contentHostingConfigurationGet(ps_id)
+    # Work through the streams in configuration order so that the M8 data is the same each time for the same configuration
+    for cfg_id in streams['digests'].keys():
+        ps_id = stream_map.get(cfg_id)
+        if ps_id is None:
+            continue
+        chc = chcs.get(ps_id)
         if chc is not None:
-            if ps_id not in vod_ps_ids:
+            if cfg_id not in vod_stream_ids:
                 m8_config['serviceList'] += [{'provisioningSessionId': ps_id, 'name': chc['name']}]
             for dc in chc['distributionConfigurations']:
                 for hostfield in ['canonicalDomainName', 'domainNameAlias']:
@@ -687,8 +1552,8 @@ async def dump_m8_files(m1: M1Session, stream_map: dict, vod_streams: List[dict]
         else:
             log_error(f"Provisioning Session {ps_id} was not initialised correctly: omitting")
     for vod in vod_streams:
-        ps_id = stream_map[vod['stream']]
-        chc = await m1.contentHostingConfigurationGet(ps_id)
+        ps_id = stream_map.get(vod['stream'])
+        chc = chcs.get(ps_id)
         if chc is not None:
             entryPoints = []
             for vep in vod['entryPoints']:
@@ -700,31 +1565,348 @@ async def dump_m8_files(m1: M1Session, stream_map: dict, vod_streams: List[dict]
             m8_config['serviceList'] += [{'provisioningSessionId': ps_id, 'name': vod['name'], 'entryPoints': entryPoints}]
         else:
             log_error(f"Provisioning Session {ps_id} not initialised correctly: unable to include '{vod['name']}' in M8 data")
+    return m8_config, publish_dirs
+
+async def dump_m8_files(streams: dict, stream_map: Dict[str, ResourceId], chcs: Dict[ResourceId, ContentHostingConfiguration],
+                        config: configparser.ConfigParser):
+    m8_config, publish_dirs = build_m8(streams, stream_map, chcs, config)
     m8_json = json.dumps(m8_config)
     log_debug("m8_json = %r", m8_json)
-    log_info("Publishing M8 info to: %s", ', '.join(publish_dirs))
-    for pdir in publish_dirs:
-        pfile = os.path.join(pdir, 'm8.json')
-        async with aiofiles.open(pfile, mode='w') as outfile:
-            await outfile.write(m8_json)
+    await publish_m8(publish_dirs, m8_json, config.get('af-sync', 'm8_precompress').split())
+
+def _publish_file(path: str, data: Optional[bytes]) -> bool:
+    '''Atomically replace a file if its contents have changed
+
+    :param path: The file to publish.
+    :param data: The new file contents or ``None`` to remove the file.
+    :return: ``True`` if the file was changed or ``False`` if it already had the contents.
+    '''
+    try:
+        with open(path, 'rb') as infile:
+            if data is not None and infile.read() == data:
+                return False
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        if data is None:
+            return False
+        mode = 0o644
+    if data is None:
+        os.unlink(path)
+        return True
+    dirname, basename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix=f'.{basename}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(data)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return True
 
-async def main():
+async def publish_m8(publish_dirs: Iterable[str], m8_json: str, precompress: Optional[List[str]] = None):
+    '''Publish M8 JSON data in the document root directories
+
+    The ``m8.json`` file in each directory is replaced atomically, so that a web server will never see a partly written file,
+    and is left alone if it already has the same contents. The directories are written to concurrently.
+
+    :param publish_dirs: The directories to publish ``m8.json`` in.
+    :param m8_json: The M8 JSON data.
+    :param precompress: The precompressed siblings to publish alongside ``m8.json``: ``gzip`` for ``m8.json.gz`` and ``br``
+                        for ``m8.json.br``. Siblings for codecs not listed are removed so they cannot become stale.
+    '''
+    precompress = precompress or []
+    for codec in precompress:
+        if codec not in ['gzip', 'br']:
+            log_warn("Unknown M8 precompression codec %r ignored", codec)
+    data = m8_json.encode('utf-8')
+    files = {'m8.json': data,
+             'm8.json.gz': gzip.compress(data, mtime=0) if 'gzip' in precompress else None,
+             'm8.json.br': None}
+    if 'br' in precompress:
+        if brotli is None:
+            log_warn("M8 brotli precompression requested but the brotli module is not available")
+        else:
+            files['m8.json.br'] = brotli.compress(data)
+    loop = asyncio.get_running_loop()
+    publish_dirs = list(publish_dirs)
+    targets = [(os.path.join(pdir, name), content) for pdir in publish_dirs for name, content in files.items()]
+    results = await asyncio.gather(*[loop.run_in_executor(None, _publish_file, path, content) for path, content in targets],
+                                   return_exceptions=True)
+    changed = []
+    for (path, content), result in zip(targets, results):
+        if isinstance(result, Exception):
+            log_error("Failed to publish %s: %s", path, result)
+        elif result:
+            changed += [path]
+    if len(changed) > 0:
+        log_info("Published M8 info to: %s", ', '.join(changed))
+    else:
+        log_info("M8 info unchanged in: %s", ', '.join(publish_dirs))
+
+class _InotifyWatcher:
+    '''Watch files for changes using Linux inotify
+
+    The directories containing the files are watched so that files replaced by renaming, as many editors do, are noticed.
+    '''
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+
+    def __init__(self, paths: List[str]):
+        libc_name = ctypes.util.find_library('c')
+        self.__libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.__fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.__names: Dict[int, set] = {}
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        try:
+            for path in paths:
+                dirname, basename = os.path.split(os.path.abspath(path))
+                wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(dirname), mask)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {dirname}')
+                self.__names.setdefault(wd, set()).add(os.fsencode(basename))
+        except OSError:
+            os.close(self.__fd)
+            raise
+        self.__changed = asyncio.Event()
+        asyncio.get_running_loop().add_reader(self.__fd, self.__readEvents)
+
+    async def wait(self):
+        '''Wait for a change to one of the watched files'''
+        await self.__changed.wait()
+        self.__changed.clear()
+
+    def close(self):
+        asyncio.get_running_loop().remove_reader(self.__fd)
+        os.close(self.__fd)
+
+    def __readEvents(self):
+        try:
+            data = os.read(self.__fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, cookie, name_len = struct.unpack_from('iIII', data, offset)
+            name = data[offset+16:offset+16+name_len].rstrip(b'\0')
+            offset += 16 + name_len
+            if name in self.__names.get(wd, ()):
+                self.__changed.set()
+
+class _PollingWatcher:
+    '''Watch files for changes by polling their status
+    '''
+    def __init__(self, paths: List[str], interval: float):
+        self.__paths = paths
+        self.__interval = interval
+        self.__last = self.__status()
+
+    async def wait(self):
+        '''Wait for a change to one of the watched files'''
+        while True:
+            await asyncio.sleep(self.__interval)
+            status = self.__status()
+            if status != self.__last:
+                self.__last = status
+                return
+
+    def close(self):
+        pass
+
+    def __status(self) -> list:
+        status = []
+        for path in self.__paths:
+            try:
+                st = os.stat(path)
+                status += [(st.st_ino, st.st_size, st.st_mtime_ns)]
+            except OSError:
+                status += [None]
+        return status
+
+def _file_watcher(paths: List[str], poll_interval: float):
+    try:
+        return _InotifyWatcher(paths)
+    except (OSError, AttributeError, TypeError) as err:
+        log_info("inotify not available (%s), polling for changes every %gs", err, poll_interval)
+        return _PollingWatcher(paths, poll_interval)
+
+async def sync_once(session: M1Session, data_store: Optional[DataStore], journal: Dict[str, dict],
+                    verify: bool = True, plan_format: Optional[str] = None) -> Dict[str, dict]:
+    '''Read the configuration files and synchronise the AF with them
+
+    Only the streams which have changed since they were recorded in the *journal* are reconciled.
+
+    :param session: The M1Session to use to communicate with the AF.
+    :param data_store: The DataStore to save the new journal in, if any.
+    :param journal: The desired-state journal from the last sync.
+    :param verify: If ``True`` refresh the AF state and check it for changes to the streams in the *journal*.
+    :param plan_format: If not ``None`` then print the plan in this format (``diff`` or ``json``) instead of applying it.
+    :return: the new journal.
+    '''
+    global g_journal_key
+    global g_streams_config
+    streams = await read_streams_config(journal)
+    config = await get_app_config()
+    concurrency = config.getint('af-sync', 'concurrency')
+    workers = config.getint('af-sync', 'workers') or os.cpu_count() or 1
+
+    # Only reconcile the streams which have changed in the configuration or the AF since the last sync
+    if verify:
+        await refresh_af_state(session, concurrency)
+    current = await journal_current_streams(session, streams, journal, concurrency, verify)
+    if len(current) > 0:
+        log_info("%i of %i streams unchanged since the last sync", len(current), len(streams['digests']))
+    # Leave the Provisioning Sessions of invalid streams as they were until the stream definition is fixed
+    for cfg_id, digest in streams['digests'].items():
+        if digest is None and cfg_id in journal:
+            log_warn("Leaving Provisioning Session %s for invalid stream %r unchanged", journal[cfg_id]['provisioningSessionId'],
+                     cfg_id)
+            current[cfg_id] = journal[cfg_id]['provisioningSessionId']
+    # Fetch the definitions of unchanged streams which have been changed in the AF
+    missing = [cfg_id for cfg_id, digest in streams['digests'].items()
+               if digest is not None and cfg_id not in current and cfg_id not in streams['streams']]
+    if len(missing) > 0:
+        reread = await read_streams_config(only=missing)
+        if any(reread['digests'].get(cfg_id) != streams['digests'][cfg_id] for cfg_id in missing):
+            raise ValueError(f'{g_streams_config} changed while it was being read')
+        streams['streams'].update(reread['streams'])
+    pending = dict(streams, streams={k: v for k, v in streams['streams'].items() if k not in current})
+
+    snapshot = await snapshot_af_state(session, concurrency, exclude=current.values())
+    known = {cfg_id: entry.get('provisioningSessionId') for cfg_id, entry in journal.items()}
+    plan = await compute_plan(pending, snapshot, known, workers)
+    plan['keep'].update(current)
+
+    if plan_format is not None:
+        if plan_format == 'json':
+            print(json.dumps(plan, indent=2))
+        else:
+            print(format_plan(plan))
+        return journal
+
+    stream_map, applied = await apply_plan(session, pending, plan, concurrency)
+
+    journal = await update_journal(session, streams, stream_map, journal, current, concurrency, applied)
+    if data_store is not None:
+        await data_store.set(g_journal_key, journal)
+
+    # The journal holds the ContentHostingConfigurations fetched after the changes were made
+    chcs = {entry['provisioningSessionId']: entry['contentHostingConfiguration'] for entry in journal.values()}
+    await dump_m8_files(streams, stream_map, chcs, config)
+
+    return journal
+
+async def watch(session: M1Session, data_store: Optional[DataStore], journal: Dict[str, dict],
+                debounce: float, poll_interval: float, verify_interval: float):
+    '''Keep the AF synchronised with the configuration files until terminated
+
+    The streams and sync configuration files are watched for changes. Once a burst of changes has been quiet for *debounce*
+    seconds the changed streams are reconciled. Every *verify_interval* seconds the AF is also checked for changes made
+    outside of this tool.
+    '''
+    global g_streams_config
+    global g_sync_config
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(signum, stop.set)
+    watcher = _file_watcher([g_streams_config, g_sync_config], poll_interval)
+    verify_at = loop.time() + verify_interval
+    log_info("Watching %s and %s for changes", g_streams_config, g_sync_config)
+    try:
+        while not stop.is_set():
+            changed = asyncio.ensure_future(watcher.wait())
+            stopping = asyncio.ensure_future(stop.wait())
+            done, _ = await asyncio.wait([changed, stopping], timeout=max(0, verify_at - loop.time()),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            changed.cancel()
+            stopping.cancel()
+            if stop.is_set():
+                break
+            verify = changed not in done
+            if verify:
+                verify_at = loop.time() + verify_interval
+            else:
+                # Wait for the burst of edits to finish
+                while True:
+                    try:
+                        await asyncio.wait_for(watcher.wait(), debounce)
+                    except asyncio.TimeoutError:
+                        break
+                log_info("Configuration changed, synchronising")
+            try:
+                journal = await sync_once(session, data_store, journal, verify=verify)
+            except (OSError, ValueError, configparser.Error) as err:
+                log_error("Unable to read the configuration, waiting for the next change: %s", err)
+            except Exception as err: # pylint: disable=broad-except
+                log_error("Synchronisation failed: %s", err, exc_info=True)
+            if data_store is not None:
+                await data_store.flush()
+    finally:
+        watcher.close()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.remove_signal_handler(signum)
+
+async def main(args: argparse.Namespace):
+    global g_journal_key
     cfg = Configuration()
-    session = await get_m1_session(cfg)
-    streams = await get_streams_config()
+    data_store = await create_data_store(cfg.get('data_store_class'), cfg.get('data_store'))
     config = await get_app_config()
+    # Only a long running watch is worth getting the certificate signer ready for in advance
+    session = await get_m1_session(cfg, data_store, config.get('af-sync', 'certificate_reuse_min_days'),
+                                   prepare_signer=args.watch and args.plan is None)
 
-    stream_map = await sync_configuration(session, streams)
+    journal = {}
+    if data_store is not None and not args.full:
+        journal = await data_store.get(g_journal_key, {}) or {}
 
-    await dump_m8_files(session, stream_map, streams['vodMedia'], cfg, config)
+    try:
+        journal = await sync_once(session, data_store, journal, plan_format=args.plan)
+
+        if args.watch and args.plan is None:
+            await watch(session, data_store, journal, args.debounce, args.poll_interval, args.verify_interval)
+    finally:
+        close_plan_pool()
+        await session.aclose()
+
+    if data_store is not None:
+        await data_store.flush()
 
     return 0
 
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='msaf-configuration', description='5GMS AF configuration sync tool')
+    parser.add_argument('--plan', nargs='?', const='diff', choices=['diff', 'json'],
+                        help='Show the changes that would be made to the AF, as a diff (default) or JSON, without making them')
+    parser.add_argument('--full', action='store_true',
+                        help='Reconcile every stream with the AF, ignoring the record of the last sync. Every stream '
+                             'definition is held in memory while the plan is made')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running and synchronise the AF whenever the configuration files change')
+    parser.add_argument('--debounce', type=float, default=0.2,
+                        help='Seconds to wait for a burst of configuration file changes to finish in --watch mode [default: 0.2]')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='Seconds between checks of the configuration files if inotify is not available [default: 1.0]')
+    parser.add_argument('--verify-interval', type=float, default=300.0,
+                        help='Seconds between checks of the AF for changes made by others in --watch mode [default: 300]')
+    return parser.parse_args()
+
 def app():
     '''
     Application entry point
     '''
-    return asyncio.run(main())
+    return asyncio.run(main(parse_args()))
 
 if __name__ == "__main__":
     sys.exit(app())
@@ -0,0 +1,63 @@
+'''
+License: 5G-MAG Public License (v1.0)
+Author: David Waring
+Copyright: (C) 2023 British Broadcasting Corporation
+For full license terms please see the LICENSE file distributed with this
+program. If this file is missing then the license can be retrieved from
+https://drive.google.com/file/d/1cinCiA778IErENZ3JN52VFW-1ffHpx7Z/view
+'''
+
+import asyncio
+import os.path
+import sys
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from rt_m1_client.certificates import acme_cert_signer
+from rt_m1_client.certificates.acme_cert_signer import ACMECertificateSigner
+
+def _make_csr(common_name, domain_names):
+    key = ec.generate_private_key(ec.SECP256R1())
+    csr = x509.CertificateSigningRequestBuilder().subject_name(
+            x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+            ).add_extension(
+            x509.SubjectAlternativeName([x509.DNSName(name) for name in domain_names]), critical=False
+            ).sign(key, hashes.SHA256())
+    return csr.public_bytes(serialization.Encoding.PEM).decode('utf-8')
+
+def test_challenge_dirs_linked_for_all_sans(tmp_path, monkeypatch):
+    docroots = tmp_path / 'docroots'
+    default_docroot = tmp_path / 'html'
+    (default_docroot / '.well-known').mkdir(parents=True)
+    domain_names = ['af.example.com', 'a.example.com', 'b.example.com', '*.example.com']
+    linked = {}
+
+    async def fake_certbot(cmd_args, timeout=None):
+        for name in domain_names:
+            well_known = docroots / name / '.well-known'
+            linked[name] = well_known.is_symlink() and well_known.resolve() == (default_docroot / '.well-known').resolve()
+        with open(cmd_args[cmd_args.index('--fullchain-path') + 1], 'w') as out:
+            out.write('CERTIFICATE')
+        return 0, b''
+
+    monkeypatch.setattr(acme_cert_signer, '_run_certbot_app', fake_certbot)
+
+    async def run():
+        signer = await ACMECertificateSigner(acme_service='https://acme.example.com/directory', docroots_dir=str(docroots),
+                                             default_docroot_dir=str(default_docroot), consolidate=True)
+        return await signer.signCertificate(_make_csr('af.example.com', domain_names))
+
+    # The docroots must be readable by the web server even with a restrictive umask
+    old_umask = os.umask(0o077)
+    try:
+        assert asyncio.run(run()) == 'CERTIFICATE'
+        assert os.umask(0o077) == 0o077
+    finally:
+        os.umask(old_umask)
+    assert linked == {'af.example.com': True, 'a.example.com': True, 'b.example.com': True, '*.example.com': False}
+    assert all(((docroots / name).stat().st_mode & 0o777) == 0o755 for name in domain_names[:3])
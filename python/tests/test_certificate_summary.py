@@ -0,0 +1,104 @@
+'''
+License: 5G-MAG Public License (v1.0)
+Author: David Waring
+Copyright: (C) 2023 British Broadcasting Corporation
+For full license terms please see the LICENSE file distributed with this
+program. If this file is missing then the license can be retrieved from
+https://drive.google.com/file/d/1cinCiA778IErENZ3JN52VFW-1ffHpx7Z/view
+'''
+
+import asyncio
+import datetime
+import os.path
+import sys
+
+from cryptography.hazmat.primitives.asymmetric import ec
+import OpenSSL
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from rt_m1_client import session as m1_session
+from rt_m1_client.certificates import certificate_summary, pem_digest
+from rt_m1_client.session import M1Session
+from rt_m1_client.types import PROVISIONING_SESSION_TYPE_DOWNLINK
+
+def _make_pem(domain_names, days):
+    key = OpenSSL.crypto.PKey.from_cryptography_key(ec.generate_private_key(ec.SECP256R1()))
+    x509 = OpenSSL.crypto.X509()
+    x509.set_serial_number(42)
+    x509.get_subject().CN = domain_names[0]
+    x509.set_issuer(x509.get_subject())
+    x509.gmtime_adj_notBefore(0)
+    x509.gmtime_adj_notAfter(days * 86400)
+    x509.set_pubkey(key)
+    x509.add_extensions([OpenSSL.crypto.X509Extension(b'subjectAltName', False,
+                                                      ','.join([f'DNS:{name}' for name in domain_names]).encode('utf-8'))])
+    x509.sign(key, 'sha256')
+    return OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, x509).decode('utf-8')
+
+def test_certificate_summary():
+    pem = _make_pem(['af.example.com', 'a.example.com'], 30)
+    summary = certificate_summary(pem)
+    assert summary['digest'] == pem_digest(pem)
+    assert summary['serialNumber'] == 42
+    assert summary['subject'] == 'CN=af.example.com'
+    assert summary['subjectAltNames'] == ['DNS:af.example.com', 'DNS:a.example.com']
+    assert summary['keyType'] == 'EC/secp256r1'
+    assert summary['notAfter'] - summary['notBefore'] == datetime.timedelta(days=30)
+
+class _FakeM1Client:
+    '''Stand-in for M1Client holding a provisioning session with one certificate
+    '''
+    def __init__(self, host_address):
+        self.pem = _make_pem(['af.example.com'], 30)
+
+    async def createProvisioningSession(self, prov_type, app_id, asp_id):
+        return {'ProvisioningSessionId': 'ps1'}
+
+    async def getProvisioningSessionById(self, ps_id):
+        return {'ETag': None, 'Last-Modified': None, 'ProvisioningSessionId': ps_id,
+                'Cache-Until': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1),
+                'ProvisioningSession': {'provisioningSessionId': ps_id, 'serverCertificateIds': ['cert1']}}
+
+    async def retrieveServerCertificate(self, ps_id, cert_id):
+        # Not cacheable, so that the certificate is fetched again on each request
+        return {'ETag': None, 'Last-Modified': None, 'Cache-Until': None, 'ServerCertificateId': cert_id,
+                'ServerCertificate': self.pem}
+
+    async def destroyServerCertificate(self, ps_id, cert_id):
+        return True
+
+def test_session_keeps_summary_with_certificate(monkeypatch):
+    clients = []
+    parsed = []
+
+    def make_client(host_address):
+        clients.append(_FakeM1Client(host_address))
+        return clients[-1]
+
+    def count_summary(pem):
+        parsed.append(pem)
+        return certificate_summary(pem)
+
+    monkeypatch.setattr(m1_session, 'M1Client', make_client)
+    monkeypatch.setattr(m1_session, 'certificate_summary', count_summary)
+
+    async def run():
+        session = await M1Session(('localhost', 7777))
+        ps_id = await session.provisioningSessionCreate(PROVISIONING_SESSION_TYPE_DOWNLINK, 'app')
+        first = await session.certificateSummary(ps_id, 'cert1')
+        # Changing the returned summary does not change the one kept by the session
+        first['subjectAltNames'].append('DNS:changed.example.com')
+        second = await session.certificateSummary(ps_id, 'cert1')
+        assert len(parsed) == 1
+        assert second['subjectAltNames'] == ['DNS:af.example.com']
+        # A new certificate is summarised again
+        clients[0].pem = _make_pem(['af.example.com', 'b.example.com'], 60)
+        third = await session.certificateSummary(ps_id, 'cert1')
+        assert len(parsed) == 2
+        assert third['subjectAltNames'] == ['DNS:af.example.com', 'DNS:b.example.com']
+        # The summary is dropped along with the certificate
+        assert await session.certificateDelete(ps_id, 'cert1')
+        assert await session.certificateSummary(ps_id, 'cert1') is None
+
+    asyncio.run(run())
@@ -0,0 +1,87 @@
+'''
+License: 5G-MAG Public License (v1.0)
+Author: David Waring
+Copyright: (C) 2023 British Broadcasting Corporation
+For full license terms please see the LICENSE file distributed with this
+program. If this file is missing then the license can be retrieved from
+https://drive.google.com/file/d/1cinCiA778IErENZ3JN52VFW-1ffHpx7Z/view
+'''
+
+import asyncio
+import datetime
+import os.path
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from rt_m1_client import session as m1_session
+from rt_m1_client.certificates import CertificateSigner
+from rt_m1_client.session import M1Session
+from rt_m1_client.types import PROVISIONING_SESSION_TYPE_DOWNLINK
+
+_TAG_AND_DATE = {'ETag': None, 'Last-Modified': None,
+                 'Cache-Until': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)}
+
+class _FakeM1Client:
+    '''Stand-in for M1Client which counts the certificate requests in progress
+    '''
+    def __init__(self, host_address):
+        self.uploads = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.__next_cert = 0
+
+    async def __request(self):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0)
+        self.in_flight -= 1
+        self.__next_cert += 1
+        return f'cert{self.__next_cert}'
+
+    async def createProvisioningSession(self, prov_type, app_id, asp_id):
+        return {'ProvisioningSessionId': 'ps1'}
+
+    async def getProvisioningSessionById(self, ps_id):
+        return dict(_TAG_AND_DATE, ProvisioningSessionId=ps_id, ProvisioningSession={'provisioningSessionId': ps_id})
+
+    async def createServerCertificate(self, ps_id):
+        return dict(_TAG_AND_DATE, ServerCertificateId=await self.__request(), ServerCertificate=None)
+
+    async def reserveServerCertificate(self, ps_id, extra_domain_names=None):
+        cert_id = await self.__request()
+        return {'ServerCertificateId': cert_id, 'CertificateSigningRequestPEM': f'csr:{",".join(extra_domain_names)}'}
+
+    async def uploadServerCertificate(self, ps_id, cert_id, pem):
+        await self.__request()
+        self.uploads[cert_id] = pem
+        return True
+
+class _FakeSigner(CertificateSigner):
+    async def signCertificate(self, csr, *args, **kwargs):
+        return f'signed:{csr}'
+
+@pytest.mark.parametrize('concurrency,max_in_flight', [(None, 3), (1, 1), (2, 2)])
+def test_create_with_domain_names(monkeypatch, concurrency, max_in_flight):
+    clients = []
+
+    def make_client(host_address):
+        clients.append(_FakeM1Client(host_address))
+        return clients[-1]
+
+    monkeypatch.setattr(m1_session, 'M1Client', make_client)
+
+    async def run():
+        session = await M1Session(('localhost', 7777), certificate_signer=await _FakeSigner())
+        ps_id = await session.provisioningSessionCreate(PROVISIONING_SESSION_TYPE_DOWNLINK, 'app')
+        return await session.createNewCertificates([(ps_id, None), (ps_id, ['a.example.com']), (ps_id, 'b.example.com')],
+                                                   concurrency=concurrency)
+
+    cert_ids = asyncio.run(run())
+    client = clients[0]
+    assert len(set(cert_ids)) == 3 and None not in cert_ids
+    # Only the certificates with domain names are signed locally and uploaded
+    assert client.uploads == {cert_ids[1]: 'signed:csr:a.example.com', cert_ids[2]: 'signed:csr:b.example.com'}
+    assert client.max_in_flight == max_in_flight
@@ -0,0 +1,125 @@
+'''
+License: 5G-MAG Public License (v1.0)
+Author: David Waring
+Copyright: (C) 2023 British Broadcasting Corporation
+For full license terms please see the LICENSE file distributed with this
+program. If this file is missing then the license can be retrieved from
+https://drive.google.com/file/d/1cinCiA778IErENZ3JN52VFW-1ffHpx7Z/view
+'''
+
+import asyncio
+import os.path
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from rt_m1_client.data_store import InMemoryDataStore, JSONFileDataStore
+
+def test_migration_write_back():
+    async def run():
+        data_store = await InMemoryDataStore()
+        await data_store.set('key', {'v': 1})
+        data_store.registerMigration('key', 0, lambda value: dict(value, migrated=True))
+        assert await data_store.get('key') == {'v': 1, 'migrated': True}
+        await data_store.flush()
+        return data_store.schemaVersion('key'), await data_store.get('key')
+    assert asyncio.run(run()) == (1, {'v': 1, 'migrated': True})
+
+def test_migration_write_back_does_not_replace_newer_value():
+    async def run():
+        data_store = await InMemoryDataStore()
+        await data_store.set('key', {'v': 1})
+        migrating = asyncio.Event()
+        release = asyncio.Event()
+
+        async def slow_migration(value):
+            migrating.set()
+            await release.wait()
+            return dict(value, migrated=True)
+
+        data_store.registerMigration('key', 0, slow_migration)
+        reader = asyncio.ensure_future(data_store.get('key'))
+        await migrating.wait()
+        # Set a new value while the old one is being migrated, there is no write-back to wait for yet
+        await data_store.set('key', {'v': 2})
+        release.set()
+        assert await reader == {'v': 1, 'migrated': True}
+        await data_store.flush()
+        return await data_store.get('key')
+    assert asyncio.run(run()) == {'v': 2}
+
+def test_delete_during_migration():
+    async def run():
+        data_store = await InMemoryDataStore()
+        await data_store.set('key', {'v': 1})
+        migrating = asyncio.Event()
+        release = asyncio.Event()
+
+        async def slow_migration(value):
+            migrating.set()
+            await release.wait()
+            return value
+
+        data_store.registerMigration('key', 0, slow_migration)
+        reader = asyncio.ensure_future(data_store.get('key'))
+        await migrating.wait()
+        await data_store.delete('key')
+        release.set()
+        await reader
+        await data_store.flush()
+        return await data_store.get('key', 'missing')
+    assert asyncio.run(run()) == 'missing'
+
+class _GatedDataStore(InMemoryDataStore):
+    '''InMemoryDataStore which holds back storing values until a gate for the value is opened
+    '''
+    def __init__(self):
+        super().__init__()
+        self.gates = {}
+        self.waiting = asyncio.Event()
+
+    async def _setRecord(self, key, schema, value):
+        gate = self.gates.get(value.get('v'))
+        if gate is not None:
+            self.waiting.set()
+            await gate.wait()
+        return await super()._setRecord(key, schema, value)
+
+def test_migration_write_back_skipped_during_set():
+    async def run():
+        data_store = await _GatedDataStore()
+        await data_store.set('key', {'v': 1})
+        data_store.registerMigration('key', 0, lambda value: dict(value, migrated=True))
+        data_store.gates = {1: asyncio.Event(), 2: asyncio.Event()}
+        # Start a set which has not stored its value by the time the old value is read
+        setter = asyncio.ensure_future(data_store.set('key', {'v': 2}))
+        await data_store.waiting.wait()
+        assert await data_store.get('key') == {'v': 1, 'migrated': True}
+        data_store.gates[2].set()
+        assert await setter
+        # Any write-back of the stale migrated value would now replace the new value
+        data_store.gates[1].set()
+        await data_store.flush()
+        return await data_store.get('key')
+    assert asyncio.run(run()) == {'v': 2}
+
+def test_update_is_atomic_between_stores(tmp_path):
+    async def run():
+        # Two stores on the same directory stand in for two processes sharing it
+        stores = [await JSONFileDataStore(str(tmp_path)), await JSONFileDataStore(str(tmp_path))]
+        await asyncio.gather(*[stores[i % 2].update('counter', lambda value: value + 1, 0) for i in range(40)])
+        return await stores[0].get('counter'), await stores[0].listKeys()
+    assert asyncio.run(run()) == (40, ['counter'])
+
+class _FailingDataStore(InMemoryDataStore):
+    async def _setRecord(self, key, schema, value):
+        return False
+
+def test_update_raises_if_not_stored():
+    async def run():
+        data_store = await _FailingDataStore()
+        with pytest.raises(RuntimeError):
+            await data_store.update('counter', lambda value: value + 1, 0)
+    asyncio.run(run())
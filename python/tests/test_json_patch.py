@@ -0,0 +1,190 @@
+'''
+License: 5G-MAG Public License (v1.0)
+Author: David Waring
+Copyright: (C) 2023 British Broadcasting Corporation
+For full license terms please see the LICENSE file distributed with this
+program. If this file is missing then the license can be retrieved from
+https://drive.google.com/file/d/1cinCiA778IErENZ3JN52VFW-1ffHpx7Z/view
+'''
+
+import asyncio
+import copy
+import datetime
+import json
+import os.path
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from rt_m1_client import session as m1_session
+from rt_m1_client.exceptions import M1ClientError, M1ServerError
+from rt_m1_client.json_patch import make_json_patch
+from rt_m1_client.session import M1Session
+from rt_m1_client.types import PROVISIONING_SESSION_TYPE_DOWNLINK
+
+def _apply_patch(doc, patch):
+    '''Apply a JSON Patch made by make_json_patch, to check that it gives the target document
+    '''
+    doc = copy.deepcopy(doc)
+    for op in patch:
+        steps = [s.replace('~1', '/').replace('~0', '~') for s in op['path'].split('/')[1:]]
+        if len(steps) == 0:
+            doc = op['value']
+            continue
+        parent = doc
+        for step in steps[:-1]:
+            parent = parent[int(step) if isinstance(parent, list) else step]
+        last = steps[-1]
+        if isinstance(parent, list):
+            if op['op'] == 'add' and last == '-':
+                parent.append(op['value'])
+            elif op['op'] == 'remove':
+                del parent[int(last)]
+            else:
+                parent[int(last)] = op['value']
+        elif op['op'] == 'remove':
+            del parent[last]
+        else:
+            parent[last] = op['value']
+    return doc
+
+def test_same_documents():
+    doc = {'a': [1, {'b': None}], 'c': 'x'}
+    assert make_json_patch(doc, copy.deepcopy(doc)) == []
+
+def test_nested_objects():
+    source = {'name': 'n', 'ingest': {'baseURL': 'http://a/', 'pull': True}, 'gone': 1}
+    target = {'name': 'n', 'ingest': {'baseURL': 'http://b/', 'protocol': 'p'}}
+    patch = make_json_patch(source, target)
+    assert patch == [
+            {'op': 'remove', 'path': '/gone'},
+            {'op': 'remove', 'path': '/ingest/pull'},
+            {'op': 'replace', 'path': '/ingest/baseURL', 'value': 'http://b/'},
+            {'op': 'add', 'path': '/ingest/protocol', 'value': 'p'},
+            ]
+    assert _apply_patch(source, patch) == target
+
+def test_list_shorter():
+    source = {'dcs': [{'a': 1}, {'a': 2}, {'a': 3}, {'a': 4}]}
+    target = {'dcs': [{'a': 1}, {'a': 5}]}
+    patch = make_json_patch(source, target)
+    # Elements are compared by index and removed from the end
+    assert patch == [
+            {'op': 'replace', 'path': '/dcs/1/a', 'value': 5},
+            {'op': 'remove', 'path': '/dcs/3'},
+            {'op': 'remove', 'path': '/dcs/2'},
+            ]
+    assert _apply_patch(source, patch) == target
+
+def test_list_longer():
+    source = {'dcs': [1]}
+    target = {'dcs': [2, 3, [4]]}
+    patch = make_json_patch(source, target)
+    assert patch == [
+            {'op': 'replace', 'path': '/dcs/0', 'value': 2},
+            {'op': 'add', 'path': '/dcs/-', 'value': 3},
+            {'op': 'add', 'path': '/dcs/-', 'value': [4]},
+            ]
+    assert _apply_patch(source, patch) == target
+
+def test_type_changes():
+    source = {'a': 1, 'b': [1], 'c': {'x': 1}, 'd': True}
+    target = {'a': 1.0, 'b': {'x': 1}, 'c': [1], 'd': 1}
+    patch = make_json_patch(source, target)
+    assert patch == [
+            {'op': 'replace', 'path': '/a', 'value': 1.0},
+            {'op': 'replace', 'path': '/b', 'value': {'x': 1}},
+            {'op': 'replace', 'path': '/c', 'value': [1]},
+            {'op': 'replace', 'path': '/d', 'value': 1},
+            ]
+
+def test_whole_document_replaced():
+    assert make_json_patch([1], {'a': 1}) == [{'op': 'replace', 'path': '', 'value': {'a': 1}}]
+
+def test_member_name_escaping():
+    source = {'a/b': {'c~d': 1}, '~/': 1}
+    target = {'a/b': {'c~d': 2}, '~1': 1}
+    patch = make_json_patch(source, target)
+    assert patch == [
+            {'op': 'remove', 'path': '/~0~1'},
+            {'op': 'replace', 'path': '/a~1b/c~0d', 'value': 2},
+            {'op': 'add', 'path': '/~01', 'value': 1},
+            ]
+    assert _apply_patch(source, patch) == target
+
+_TAG_AND_DATE = {'ETag': None, 'Last-Modified': None,
+                 'Cache-Until': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)}
+
+class _FakeM1Client:
+    '''Stand-in for M1Client holding a single provisioning session
+    '''
+    patch_error = None
+
+    def __init__(self, host_address):
+        self.chc = {'name': 'stream', 'ingestConfiguration': {'pull': True, 'baseURL': 'http://origin/'},
+                    'distributionConfigurations': [{'canonicalDomainName': 'af.example.com',
+                                                    'baseURL': 'http://af.example.com/m4d/ps1/'}]}
+        self.patches = []
+        self.updates = []
+
+    async def createProvisioningSession(self, prov_type, app_id, asp_id):
+        return {'ProvisioningSessionId': 'ps1'}
+
+    async def getProvisioningSessionById(self, ps_id):
+        return dict(_TAG_AND_DATE, ProvisioningSessionId=ps_id, ProvisioningSession={'provisioningSessionId': ps_id})
+
+    async def retrieveContentHostingConfiguration(self, ps_id):
+        return dict(_TAG_AND_DATE, ProvisioningSessionId=ps_id, ContentHostingConfiguration=copy.deepcopy(self.chc))
+
+    async def patchContentHostingConfiguration(self, ps_id, patch):
+        self.patches += [json.loads(patch)]
+        if self.patch_error is not None:
+            raise self.patch_error
+        self.chc = _apply_patch(self.chc, self.patches[-1])
+        return True
+
+    async def updateContentHostingConfiguration(self, ps_id, chc):
+        self.updates += [chc]
+        self.chc = copy.deepcopy(chc)
+        return True
+
+def _run_chc_patch(monkeypatch, patch_error):
+    clients = []
+
+    def make_client(host_address):
+        client = _FakeM1Client(host_address)
+        client.patch_error = patch_error
+        clients.append(client)
+        return client
+
+    monkeypatch.setattr(m1_session, 'M1Client', make_client)
+
+    async def run():
+        session = await M1Session(('localhost', 7777))
+        ps_id = await session.provisioningSessionCreate(PROVISIONING_SESSION_TYPE_DOWNLINK, 'app')
+        chc = {'name': 'stream', 'ingestConfiguration': {'pull': True, 'baseURL': 'http://new-origin/'},
+               'distributionConfigurations': [{}]}
+        return await session.contentHostingConfigurationPatch(ps_id, chc)
+
+    return asyncio.run(run()), clients[0]
+
+def test_chc_patch(monkeypatch):
+    result, client = _run_chc_patch(monkeypatch, None)
+    assert result
+    # The fields generated by the AF are left alone
+    assert client.patches == [[{'op': 'replace', 'path': '/ingestConfiguration/baseURL', 'value': 'http://new-origin/'}]]
+    assert client.updates == []
+
+@pytest.mark.parametrize('error', [M1ClientError('Unsupported Media Type', 415), M1ServerError('Not Implemented', 501)])
+def test_chc_patch_rejected_falls_back_to_put(monkeypatch, error):
+    result, client = _run_chc_patch(monkeypatch, error)
+    assert result
+    assert len(client.patches) == 1
+    assert client.updates == [{'name': 'stream', 'ingestConfiguration': {'pull': True, 'baseURL': 'http://new-origin/'},
+                               'distributionConfigurations': [{}]}]
+
+def test_chc_patch_server_error_not_retried(monkeypatch):
+    with pytest.raises(M1ServerError):
+        _run_chc_patch(monkeypatch, M1ServerError('Service Unavailable', 503))
@@ -0,0 +1,107 @@
+'''
+License: 5G-MAG Public License (v1.0)
+Author: David Waring
+Copyright: (C) 2023 British Broadcasting Corporation
+For full license terms please see the LICENSE file distributed with this
+program. If this file is missing then the license can be retrieved from
+https://drive.google.com/file/d/1cinCiA778IErENZ3JN52VFW-1ffHpx7Z/view
+'''
+
+import json
+import os.path
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from rt_m1_client.json_stream import JSONMemberParser
+
+EXPAND = ['streams', 'vodMedia']
+
+DOCUMENTS = [
+    '{}',
+    '{"a":1}',
+    '{"vodMedia":[1,2.5]}',
+    '{"a":[1e5]}',
+    '{"vodMedia":[1e5,-2.5E-3,0,-0]}',
+    '{"n":123456,"f":-0.25e+10,"t":true,"f2":false,"z":null}',
+    '{"vodMedia":[true,false,null,12,"x"],"n":7}',
+    '{"streams":{"a":{"x":[1,2.5,null]},"b":{},"c":3.75},"appId":"app"}',
+    '{"streams":{},"vodMedia":[],"e":{},"l":[]}',
+    '{"s":"\\u00e9\\"\\\\ , ] }","streams":{"k\\"ey":"v,}]"}}',
+    '{ "streams" : { "a" : 1 , "b" : [ 1 , 2 ] } , "vodMedia" : [ { } , 10 ] }\n',
+    json.dumps({'aspId': 'asp', 'appId': 'app',
+                'streams': {f's{i}': {'name': f'n{i}', 'v': [i, i / 3, -i * 1e10, None, True]} for i in range(5)},
+                'vodMedia': [{'stream': 's1', 'n': 1.5}, 2.25, 3]}, indent=2),
+    ]
+
+def _rebuild(events):
+    '''Rebuild the document from the parser results
+    '''
+    doc = {}
+    for path, value in events:
+        if len(path) == 1:
+            doc[path[0]] = value
+        elif isinstance(doc[path[0]], dict):
+            doc[path[0]][path[1]] = value
+        else:
+            assert path[1] == len(doc[path[0]])
+            doc[path[0]].append(value)
+    return doc
+
+def _parse(chunks):
+    parser = JSONMemberParser(expand=EXPAND)
+    events = []
+    for chunk in chunks:
+        events += parser.feed(chunk)
+    events += parser.close()
+    return events
+
+@pytest.mark.parametrize('text', DOCUMENTS)
+def test_every_split_point(text):
+    expected = json.loads(text)
+    for split in range(len(text) + 1):
+        assert _rebuild(_parse([text[:split], text[split:]])) == expected, f'split at {split}: {text[:split]!r}'
+
+@pytest.mark.parametrize('text', DOCUMENTS)
+def test_single_characters(text):
+    assert _rebuild(_parse(list(text))) == json.loads(text)
+
+def test_expanded_members_returned_one_at_a_time():
+    events = _parse(['{"appId":"x","streams":{"a":{},"b":{"c":1}},"vodMedia":[1,{"d":2}]}'])
+    assert events == [(('appId',), 'x'), (('streams',), {}), (('streams', 'a'), {}), (('streams', 'b'), {'c': 1}),
+                      (('vodMedia',), []), (('vodMedia', 0), 1), (('vodMedia', 1), {'d': 2})]
+
+def test_numbers_wait_for_a_delimiter():
+    parser = JSONMemberParser(expand=EXPAND)
+    assert parser.feed('{"vodMedia":[1,2') == [(('vodMedia',), []), (('vodMedia', 0), 1)]
+    assert parser.feed('.') == []
+    assert parser.feed('5]') == [(('vodMedia', 1), 2.5)]
+    assert parser.feed(',"n":1') == []
+    assert parser.feed('0}') == [(('n',), 10)]
+    assert parser.close() == []
+
+@pytest.mark.parametrize('text', [
+    '{"a":1,}',
+    '{"a" 1}',
+    '{"a":1}x',
+    '{"a":\n  tru}',
+    '{"streams":{"x":1,,}}',
+    '{"vodMedia":[1 2]}',
+    '{"vodMedia":[1,]}',
+    '{"a":1]',
+    ])
+def test_errors_match_json(text):
+    with pytest.raises(ValueError) as json_err:
+        json.loads(text)
+    for split in range(len(text) + 1):
+        with pytest.raises(ValueError) as err:
+            _parse([text[:split], text[split:]])
+        # Same position as the json module reports
+        assert str(err.value).split(': ', 1)[1] == str(json_err.value).split(': ', 1)[1]
+
+@pytest.mark.parametrize('text', ['[1]', '{"a":1', '{"vodMedia":[1,2', ''])
+def test_not_an_object_or_incomplete(text):
+    with pytest.raises(ValueError):
+        _parse([text])
@@ -0,0 +1,270 @@
+'''
+License: 5G-MAG Public License (v1.0)
+Author: David Waring
+Copyright: (C) 2023 British Broadcasting Corporation
+For full license terms please see the LICENSE file distributed with this
+program. If this file is missing then the license can be retrieved from
+https://drive.google.com/file/d/1cinCiA778IErENZ3JN52VFW-1ffHpx7Z/view
+'''
+
+import asyncio
+import copy
+import datetime
+import os.path
+import sys
+
+from cryptography.hazmat.primitives.asymmetric import ec
+import OpenSSL
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+from rt_m1_client import session as m1_session
+from rt_m1_client.certificates import CertificateSigner
+from rt_m1_client.data_store import InMemoryDataStore
+from rt_m1_client.renewal import CertificateRenewer
+from rt_m1_client.session import M1Session
+from rt_m1_client.types import PROVISIONING_SESSION_TYPE_DOWNLINK
+
+DAY = datetime.timedelta(days=1)
+NOW = datetime.datetime.now(datetime.timezone.utc)
+
+class _StubSession:
+    '''Stand-in for M1Session which keeps the AF state in a DataStore
+
+    The InMemoryDataStore returns a fresh copy of a value on each get, as the AF would, so changes the renewer makes to a
+    ContentHostingConfiguration only take effect when it is updated.
+    '''
+    def __init__(self, store):
+        self.store = store
+        self.events = []
+        self.summaries = 0
+        self.fail_create = False
+        self.fail_update = False
+        self.__next_cert = 0
+
+    async def addSession(self, ps_id, certs):
+        '''Add a provisioning session using the certificates given as (domain name alias or None, expiry) tuples
+        '''
+        dcs = []
+        for alias, not_after in certs:
+            dc = {'canonicalDomainName': 'af.example.com', 'baseURL': f'http://af.example.com/{ps_id}/',
+                  'certificateId': await self.addCertificate(ps_id, not_after)}
+            if alias is not None:
+                dc['domainNameAlias'] = alias
+            dcs += [dc]
+        await self.store.set(f'chcs/{ps_id}', {'name': ps_id, 'distributionConfigurations': dcs})
+
+    async def addCertificate(self, ps_id, not_after):
+        self.__next_cert += 1
+        cert_id = f'cert{self.__next_cert}'
+        await self.store.set(f'certs/{ps_id}/{cert_id}', not_after.isoformat())
+        return cert_id
+
+    async def provisioningSessionIds(self):
+        return [key.split('/', 1)[1] for key in await self.store.listKeys('chcs/')]
+
+    async def contentHostingConfigurationGet(self, ps_id):
+        return await self.store.get(f'chcs/{ps_id}')
+
+    async def certificateSummary(self, ps_id, cert_id):
+        self.summaries += 1
+        not_after = await self.store.get(f'certs/{ps_id}/{cert_id}')
+        if not_after is None:
+            return None
+        return {'notAfter': datetime.datetime.fromisoformat(not_after)}
+
+    async def createNewCertificates(self, requests, reuse=True):
+        self.events += [('create', [domain_names for _, domain_names in requests])]
+        if self.fail_create:
+            return [None] * len(requests)
+        return [await self.addCertificate(ps_id, NOW + 90 * DAY) for ps_id, _ in requests]
+
+    async def contentHostingConfigurationUpdate(self, ps_id, chc):
+        self.events += [('update', [dc.get('certificateId') for dc in chc['distributionConfigurations']])]
+        if self.fail_update:
+            return False
+        assert all('canonicalDomainName' not in dc and 'baseURL' not in dc for dc in chc['distributionConfigurations'])
+        return await self.store.set(f'chcs/{ps_id}', chc)
+
+    async def certificateDelete(self, ps_id, cert_id):
+        self.events += [('delete', cert_id)]
+        return await self.store.delete(f'certs/{ps_id}/{cert_id}')
+
+async def _setup(certs, **kwargs):
+    session = _StubSession(await InMemoryDataStore())
+    for ps_id, ps_certs in certs.items():
+        await session.addSession(ps_id, ps_certs)
+    renewer = CertificateRenewer(session, **kwargs)
+    await renewer.scan()
+    return session, renewer
+
+def test_due_within_window():
+    async def run():
+        session, renewer = await _setup({'ps1': [(None, NOW + 20 * DAY), ('a.example.com', NOW + 5 * DAY)],
+                                         'ps2': [(None, NOW + 40 * DAY)]})
+        assert renewer.dueCertificates(NOW) == [('ps1', 'cert2', NOW + 5 * DAY)]
+        # Checking does not change the index
+        assert renewer.dueCertificates(NOW) == [('ps1', 'cert2', NOW + 5 * DAY)]
+        assert renewer.dueCertificates(NOW + 10 * DAY) == [('ps1', 'cert2', NOW + 5 * DAY), ('ps1', 'cert1', NOW + 20 * DAY)]
+        assert renewer.dueCertificates(NOW - 10 * DAY) == []
+        assert renewer.nextRenewalTime() == NOW + 5 * DAY - renewer.renewalWindow
+    asyncio.run(run())
+
+def test_scan_only_fetches_new_certificates():
+    async def run():
+        session, renewer = await _setup({'ps1': [(None, NOW + 20 * DAY)], 'ps2': [(None, NOW + 5 * DAY)]})
+        assert session.summaries == 2
+        await renewer.scan()
+        assert session.summaries == 2
+        # A certificate which is no longer in use is dropped from the index
+        await session.store.delete('chcs/ps2')
+        await renewer.scan()
+        assert session.summaries == 2
+        assert renewer.dueCertificates(NOW + 30 * DAY) == [('ps1', 'cert1', NOW + 20 * DAY)]
+    asyncio.run(run())
+
+def test_renew_swaps_then_deletes():
+    async def run():
+        session, renewer = await _setup({'ps1': [('a.example.com', NOW + 5 * DAY), (None, NOW + 40 * DAY)]})
+        renewed = await renewer.renewDue(NOW)
+        assert renewed == {'ps1': {'cert1': 'cert3'}}
+        # The old certificate is only deleted once the ContentHostingConfiguration uses the new one
+        assert session.events == [('create', [['a.example.com']]), ('update', ['cert3', 'cert2']), ('delete', 'cert1')]
+        chc = await session.contentHostingConfigurationGet('ps1')
+        assert [dc['certificateId'] for dc in chc['distributionConfigurations']] == ['cert3', 'cert2']
+        # The index now holds the new certificate instead of the old one
+        assert renewer.dueCertificates(NOW + 60 * DAY) == [('ps1', 'cert2', NOW + 40 * DAY)]
+        assert renewer.dueCertificates(NOW + 80 * DAY)[-1] == ('ps1', 'cert3', NOW + 90 * DAY)
+    asyncio.run(run())
+
+def test_failed_update_keeps_old_certificates():
+    async def run():
+        session, renewer = await _setup({'ps1': [(None, NOW + 5 * DAY)]})
+        session.fail_update = True
+        assert await renewer.renew('ps1') == {}
+        # The new certificate is removed and the old one is left in use
+        assert session.events == [('create', [None]), ('update', ['cert2']), ('delete', 'cert2')]
+        assert await session.store.get('certs/ps1/cert1') is not None
+        chc = await session.contentHostingConfigurationGet('ps1')
+        assert chc['distributionConfigurations'][0]['certificateId'] == 'cert1'
+    asyncio.run(run())
+
+def test_retry_backoff():
+    async def run():
+        retry_delay = datetime.timedelta(minutes=1)
+        session, renewer = await _setup({'ps1': [(None, NOW + 5 * DAY)]}, retry_delay=retry_delay,
+                                        max_retry_delay=datetime.timedelta(minutes=3))
+        session.fail_create = True
+        delays = []
+        due_at = NOW
+        for _ in range(4):
+            before = datetime.datetime.now(datetime.timezone.utc)
+            assert await renewer.renewDue(due_at) == {}
+            # Not due again until the retry time
+            assert renewer.dueCertificates(before) == []
+            retry_at = renewer.nextRenewalTime()
+            delays += [round((retry_at - before) / retry_delay)]
+            due_at = retry_at + datetime.timedelta(seconds=1)
+            assert renewer.dueCertificates(due_at) == [('ps1', 'cert1', NOW + 5 * DAY)]
+        # The delay doubles with each failure up to the maximum
+        assert delays == [1, 2, 3, 3]
+        assert len([event for event in session.events if event[0] == 'create']) == 4
+        # A successful renewal clears the back off
+        session.fail_create = False
+        assert await renewer.renewDue(due_at) == {'ps1': {'cert1': 'cert2'}}
+        assert renewer.nextRenewalTime() == NOW + 90 * DAY - renewer.renewalWindow
+    asyncio.run(run())
+
+def _make_pem(domain_names, days):
+    '''Make a self-signed public certificate for the *domain_names* which expires in *days*
+    '''
+    key = OpenSSL.crypto.PKey.from_cryptography_key(ec.generate_private_key(ec.SECP256R1()))
+    x509 = OpenSSL.crypto.X509()
+    x509.set_serial_number(1)
+    x509.get_subject().CN = domain_names[0]
+    x509.set_issuer(x509.get_subject())
+    x509.gmtime_adj_notBefore(0)
+    x509.gmtime_adj_notAfter(days * 86400)
+    x509.set_pubkey(key)
+    x509.add_extensions([OpenSSL.crypto.X509Extension(b'subjectAltName', False,
+                                                      ','.join([f'DNS:{name}' for name in domain_names]).encode('utf-8'))])
+    x509.sign(key, 'sha256')
+    return OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, x509).decode('utf-8')
+
+_TAG_AND_DATE = {'ETag': None, 'Last-Modified': None,
+                 'Cache-Until': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)}
+
+class _FakeM1Client:
+    '''Stand-in for M1Client holding a provisioning session with one certificate using a domain name alias
+    '''
+    def __init__(self, host_address):
+        self.certs = {'cert1': _make_pem(['af.example.com', 'a.example.com'], 5)}
+        self.chc = {'name': 'stream', 'ingestConfiguration': {'pull': True, 'baseURL': 'http://origin/'},
+                    'distributionConfigurations': [{'canonicalDomainName': 'af.example.com', 'domainNameAlias': 'a.example.com',
+                                                    'baseURL': 'https://a.example.com/m4d/ps1/', 'certificateId': 'cert1'}]}
+        self.events = []
+
+    async def createProvisioningSession(self, prov_type, app_id, asp_id):
+        return {'ProvisioningSessionId': 'ps1'}
+
+    async def getProvisioningSessionById(self, ps_id):
+        return dict(_TAG_AND_DATE, ProvisioningSessionId=ps_id,
+                    ProvisioningSession={'provisioningSessionId': ps_id, 'serverCertificateIds': list(self.certs.keys())})
+
+    async def retrieveContentHostingConfiguration(self, ps_id):
+        return dict(_TAG_AND_DATE, ProvisioningSessionId=ps_id, ContentHostingConfiguration=copy.deepcopy(self.chc))
+
+    async def updateContentHostingConfiguration(self, ps_id, chc):
+        self.events += [('update', [dc.get('certificateId') for dc in chc['distributionConfigurations']])]
+        self.chc = copy.deepcopy(chc)
+        return True
+
+    async def retrieveServerCertificate(self, ps_id, cert_id):
+        return dict(_TAG_AND_DATE, ServerCertificateId=cert_id, ServerCertificate=self.certs.get(cert_id))
+
+    async def reserveServerCertificate(self, ps_id, extra_domain_names=None):
+        self.events += [('reserve', extra_domain_names)]
+        cert_id = f'cert{len(self.certs) + 1}'
+        self.certs[cert_id] = None
+        return {'ServerCertificateId': cert_id, 'CertificateSigningRequestPEM': ','.join(extra_domain_names)}
+
+    async def uploadServerCertificate(self, ps_id, cert_id, pem):
+        self.events += [('upload', cert_id)]
+        self.certs[cert_id] = pem
+        return True
+
+    async def destroyServerCertificate(self, ps_id, cert_id):
+        self.events += [('delete', cert_id)]
+        del self.certs[cert_id]
+        return True
+
+class _FakeSigner(CertificateSigner):
+    async def signCertificate(self, csr, *args, **kwargs):
+        return _make_pem(['af.example.com'] + csr.split(','), 90)
+
+def test_renew_with_m1_session(monkeypatch):
+    clients = []
+
+    def make_client(host_address):
+        clients.append(_FakeM1Client(host_address))
+        return clients[-1]
+
+    monkeypatch.setattr(m1_session, 'M1Client', make_client)
+
+    async def run():
+        session = await M1Session(('localhost', 7777), certificate_signer=await _FakeSigner())
+        await session.provisioningSessionCreate(PROVISIONING_SESSION_TYPE_DOWNLINK, 'app')
+        renewer = CertificateRenewer(session)
+        await renewer.scan()
+        assert [due[:2] for due in renewer.dueCertificates()] == [('ps1', 'cert1')]
+        renewed = await renewer.renewDue()
+        return session, renewer, renewed
+
+    session, renewer, renewed = asyncio.run(run())
+    client = clients[0]
+    assert renewed == {'ps1': {'cert1': 'cert2'}}
+    # The new certificate is signed and uploaded, and the old one only deleted once the ContentHostingConfiguration uses it
+    assert client.events == [('reserve', ['a.example.com']), ('upload', 'cert2'), ('update', ['cert2']), ('delete', 'cert1')]
+    assert 'canonicalDomainName' not in client.chc['distributionConfigurations'][0]
+    assert renewer.dueCertificates() == []
+    assert renewer.nextRenewalTime() > NOW + 75 * DAY